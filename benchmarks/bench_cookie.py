@@ -0,0 +1,64 @@
+"""
+Compare ``util.get_session_cookie`` with the ``Cookie.SimpleCookie`` based
+implementation it replaced.
+
+Usage, from the root of the repository:
+
+    PYTHONPATH=. python benchmarks/bench_cookie.py [number]
+"""
+
+import Cookie
+import sys
+import timeit
+
+from sockjs_gevent import util
+
+
+HEADERS = [
+    ('none', None),
+    ('session only', 'JSESSIONID=7f3a9c21d0e84b56'),
+    ('typical', '_ga=GA1.2.1234567890.1400000000; '
+                'JSESSIONID=7f3a9c21d0e84b56; lang=en-GB'),
+    ('large', '; '.join(
+        ['tracker%d=%s' % (i, 'x' * 64) for i in xrange(40)] +
+        ['JSESSIONID=7f3a9c21d0e84b56']
+    )),
+    ('quoted', 'JSESSIONID="7f3a 9c21"; lang=en-GB'),
+]
+
+
+def simple_cookie(header):
+    cookies = Cookie.SimpleCookie(header)
+
+    c = cookies.get('JSESSIONID')
+
+    if not c:
+        cookies['JSESSIONID'] = 'dummy'
+
+        c = cookies.get('JSESSIONID')
+
+    c['path'] = '/'
+
+    return cookies.output(header='').strip()
+
+
+def bench(func, header, number):
+    return min(timeit.repeat(
+        lambda: func(header),
+        repeat=3,
+        number=number
+    )) / number * 1e6
+
+
+def main(number=20000):
+    print '%-14s %14s %14s %8s' % ('header', 'SimpleCookie', 'scanner', 'x')
+
+    for label, header in HEADERS:
+        old = bench(simple_cookie, header, number)
+        new = bench(util.get_session_cookie, header, number)
+
+        print '%-14s %12.2fus %12.2fus %7.1fx' % (label, old, new, old / new)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,117 @@
+"""
+Compare ``protocol.escape_js`` with the escaping the htmlfile and jsonp
+transports used before it, and with a regular expression driven by a
+translation table.
+
+The ``safe`` column shows whether each escaper got every hostile sample
+right. An escaped frame is correct when the html parser can not end the
+script block inside it and the JavaScript string literal decodes back to the
+frame.
+
+Usage, from the root of the repository:
+
+    PYTHONPATH=. python benchmarks/bench_escape.py [number]
+"""
+
+import json
+import re
+import sys
+import timeit
+
+from sockjs_gevent import protocol
+
+
+FRAMES = [
+    ('short', protocol.message_frame('hello world')),
+    ('chat', protocol.message_frame(*[
+        {'user': 'user%d' % (i,), 'text': 'a "quoted" message %d' % (i,)}
+        for i in xrange(10)
+    ])),
+    ('no quotes', protocol.message_frame(*range(200))),
+    ('large', protocol.message_frame(*['x' * 1024] * 16)),
+]
+
+HOSTILE = [
+    protocol.message_frame('\\"'),
+    protocol.message_frame('</script><script>alert(1)</script>'),
+    protocol.message_frame('<!--<script>'),
+    protocol.message_frame(u'\u2028\u2029'),
+    '\xe2\x80\xa8',
+    'a["\n"]',
+]
+
+
+def htmlfile(data):
+    # ``HTMLFile.frame_parts`` as it was
+    return data.replace('"', '\\"')
+
+
+def jsonp(data):
+    # ``JSONPolling.frame_parts`` as it was, without the quotes
+    return json.dumps(data)[1:-1]
+
+
+TABLE = {
+    '\\': '\\\\',
+    '"': '\\"',
+    '<': '\\u003c',
+    '\xe2\x80\xa8': '\\u2028',
+    '\xe2\x80\xa9': '\\u2029',
+}
+
+TABLE.update(('%c' % (i,), '\\u%04x' % (i,)) for i in xrange(0x20))
+
+TABLE_RE = re.compile(r'[\x00-\x1f"\\<]|\xe2\x80[\xa8\xa9]')
+
+
+def table(data):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+
+    return TABLE_RE.sub(lambda match: TABLE[match.group()], data)
+
+
+def is_safe(escape, data):
+    escaped = escape(data)
+
+    if '</' in escaped or '<!--' in escaped:
+        return False
+
+    if u'\u2028' in escaped or '\xe2\x80\xa8' in escaped:
+        return False
+
+    if isinstance(data, str):
+        data = data.decode('utf-8')
+
+    try:
+        return json.loads('"' + escaped + '"') == data
+    except ValueError:
+        return False
+
+
+def bench(func, data, number):
+    return min(timeit.repeat(
+        lambda: func(data),
+        repeat=3,
+        number=number
+    )) / number * 1e6
+
+
+def main(number=20000):
+    escapers = [htmlfile, jsonp, table, protocol.escape_js]
+
+    print '%-10s %5s' % ('escaper', 'safe'),
+    print ' '.join('%10s' % (label,) for label, data in FRAMES)
+
+    for escape in escapers:
+        safe = all(is_safe(escape, data) for data in HOSTILE)
+
+        print '%-10s %5s' % (escape.__name__, safe and 'yes' or 'no'),
+        print ' '.join(
+            '%8.2fus' % (bench(escape, data, number),)
+            for label, data in FRAMES
+        )
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,133 @@
+"""
+Compare building message frames in pieces, ``transport.queue_message_frame``,
+with building the whole frame first and wrapping it with
+``transport.frame_parts``, as the transports used to.
+
+For each frame it reports the time taken and the bytes copied into
+intermediate and final strings. The messages are broadcasts
+(``EncodedMessage``), so the per-transport escaping of every message is
+shared between sessions.
+
+Usage, from the root of the repository:
+
+    PYTHONPATH=. python benchmarks/bench_frames.py [number]
+"""
+
+import sys
+import timeit
+
+import mock
+
+from sockjs_gevent import protocol, transport
+
+
+def make_messages(count):
+    return [
+        protocol.EncodedMessage({
+            'user': 'user%d' % (i,),
+            'text': 'a "quoted" message number %d' % (i,),
+        })
+        for i in xrange(count)
+    ]
+
+
+def make_transport(klass):
+    session = mock.Mock()
+    session.conn = None
+
+    tport = klass(session, mock.Mock(), {})
+    tport.callback = 'cb'
+
+    return tport
+
+
+def old_message_frame(chunks):
+    # ``protocol.message_frame`` as it was
+    for chunk in chunks:
+        if isinstance(chunk, protocol.EncodedMessage):
+            break
+    else:
+        return protocol.MESSAGE + protocol.encode(chunks)
+
+    encoded = [
+        chunk.json if isinstance(chunk, protocol.EncodedMessage)
+        else protocol.encode(chunk)
+        for chunk in chunks
+    ]
+
+    return protocol.MESSAGE + '[' + ','.join(encoded) + ']'
+
+
+def old(tport, messages):
+    frames = []
+    frames.extend(tport.frame_parts(old_message_frame(messages)))
+
+    return ''.join(frames)
+
+
+def new(tport, messages):
+    frames = []
+    tport.message_frame_parts(messages, frames)
+
+    return ''.join(frames)
+
+
+def old_copied(tport, messages):
+    """
+    The bytes copied by ``old``: the joined messages, the frame built from
+    them with two concatenations, the escaped frame and the final join.
+    """
+    joined = len(','.join([message.json for message in messages]))
+    frame = old_message_frame(messages)
+    wrapped = tport.frame_parts(frame)
+    copied = joined + (joined + 2) + (joined + 3) + len(''.join(wrapped))
+
+    if wrapped[1] is not frame:
+        copied += len(wrapped[1])
+
+    return copied
+
+
+def new_copied(tport, messages):
+    """
+    The bytes copied by ``new`` once the escaped messages, or the whole frame
+    of a single message, are cached: the frame opener and the final join.
+    """
+    if len(messages) == 1 and tport.get_frame_key() is not None:
+        return 0
+
+    return 2 + len(new(tport, messages))
+
+
+def bench(func, tport, messages, number):
+    return min(timeit.repeat(
+        lambda: func(tport, messages),
+        repeat=3,
+        number=number
+    )) / number * 1e6
+
+
+def main(number=20000):
+    print '%-14s %5s %10s %10s %9s %9s' % (
+        'transport', 'msgs', 'old', 'new', 'old B', 'new B')
+
+    for klass in (transport.XHRStreaming, transport.EventSource,
+                  transport.JSONPolling, transport.HTMLFile):
+        for count in (1, 10, 100):
+            tport = make_transport(klass)
+            messages = make_messages(count)
+
+            assert old(tport, messages) == new(tport, messages)
+
+            print '%-14s %5d %8.2fus %8.2fus %9d %9d' % (
+                klass.__name__,
+                count,
+                bench(old, tport, messages, number // count),
+                bench(new, tport, messages, number // count),
+                old_copied(tport, messages),
+                new_copied(tport, messages),
+            )
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
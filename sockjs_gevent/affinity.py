@@ -0,0 +1,426 @@
+"""
+Session affinity for multi-process deployments.
+
+A SockJS transport url has the form ``/<server_id>/<session_id>/<transport>``
+and every request for a session carries the same ``server_id``. An
+``Affinity`` maps each ``server_id`` to the worker process that owns it.
+Requests that arrive on a different worker are proxied over a unix socket to
+the owner, so all the requests for a session reach the process that holds it
+without sticky load balancer cookies.
+"""
+
+import errno
+import hmac
+import os
+import zlib
+
+import gevent
+from gevent import server, socket
+
+from . import transport
+
+
+def get_content_length(environ):
+    """
+    Return the declared length of the request body, or ``None`` if it is not
+    known up front, e.g. a chunked body.
+    """
+    try:
+        return int(environ['CONTENT_LENGTH'])
+    except (KeyError, ValueError):
+        return None
+
+
+class Affinity(object):
+    """
+    Routes requests to the worker that owns their ``server_id``.
+
+    Each worker serves its own ``server.Server`` on a unix stream socket in
+    ``path`` so that its siblings can proxy requests to it.
+
+    :ivar path: The directory that holds the sockets of the workers.
+    :ivar worker_id: The id of this worker, ``0 <= worker_id < num_workers``.
+    :ivar num_workers: The total number of workers.
+    :ivar secret: Sent in the ``header`` of every proxied request so that the
+        owner can tell it from a client that sets the header itself. Every
+        worker must be given the same secret.
+    :ivar claims: A mapping of server_id prefix -> worker id for explicitly
+        claimed prefixes. Checked before the default hash based mapping.
+    :ivar app: The ``server.Server`` that this affinity is bound to.
+    """
+
+    # set on proxied requests so they are never proxied a second time
+    header = 'X-SockJS-Affinity'
+    environ_key = 'HTTP_X_SOCKJS_AFFINITY'
+
+    # request headers that are replaced when proxying
+    skip_headers = frozenset([
+        'connection',
+        'content-length',
+        'keep-alive',
+        'transfer-encoding',
+        header.lower(),
+    ])
+
+    # response headers that are replaced by the handler of the client
+    skip_response_headers = frozenset([
+        'connection',
+        'keep-alive',
+        'transfer-encoding',
+    ])
+
+    suffix = '.sock'
+    buffer_size = 64 * 1024
+
+    def __init__(self, path, worker_id, num_workers, secret=None):
+        self.path = path
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.secret = secret or os.urandom(16).encode('hex')
+
+        self.claims = {}
+        self.claim_lengths = []
+
+        self.app = None
+        self.server = None
+
+    def bind(self, app):
+        """
+        Bind this affinity to the local server.
+        """
+        self.app = app
+
+    def get_address(self, worker_id):
+        return os.path.join(self.path, 'worker-%d%s' % (worker_id, self.suffix))
+
+    def start(self):
+        """
+        Start accepting proxied requests from sibling workers.
+        """
+        if self.server:
+            return
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        address = self.get_address(self.worker_id)
+
+        if os.path.exists(address):
+            # left over from a previous incarnation of this worker
+            os.unlink(address)
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(address)
+        listener.listen(128)
+
+        self.server = server.StreamServer(listener, self.app.handle)
+        self.server.start()
+
+    def stop(self):
+        if not self.server:
+            return
+
+        self.server.close()
+        self.server = None
+
+        try:
+            os.unlink(self.get_address(self.worker_id))
+        except OSError:
+            pass
+
+    def claim(self, prefix, worker_id=None):
+        """
+        Route all server_id values starting with ``prefix`` to ``worker_id``
+        (defaults to this worker). Every worker must make the same claims.
+        """
+        if worker_id is None:
+            worker_id = self.worker_id
+
+        self.claims[prefix] = worker_id
+        self.claim_lengths = sorted(
+            set(len(key) for key in self.claims),
+            reverse=True
+        )
+
+    def get_owner(self, server_id):
+        """
+        Return the id of the worker that owns ``server_id``.
+
+        SockJS clients pick a random three digit ``server_id`` so numeric ids
+        are spread by value, anything else by its crc32.
+        """
+        for length in self.claim_lengths:
+            worker_id = self.claims.get(server_id[:length], None)
+
+            if worker_id is not None:
+                return worker_id
+
+        if server_id.isdigit():
+            return int(server_id) % self.num_workers
+
+        return (zlib.crc32(server_id) & 0xffffffff) % self.num_workers
+
+    def is_proxied(self, environ):
+        """
+        Whether the request was proxied by a sibling worker.
+        """
+        token = environ.get(self.environ_key, None)
+
+        if not token:
+            return False
+
+        return hmac.compare_digest(token, self.secret)
+
+    def is_local(self, server_id, environ):
+        """
+        Whether the request should be handled by this worker.
+        """
+        if self.num_workers <= 1 or self.is_proxied(environ):
+            return True
+
+        return self.get_owner(server_id) == self.worker_id
+
+    def build_request(self, handler, environ, content_length=None):
+        """
+        Rebuild the head of the request for the owning worker.
+
+        Plain requests are sent as HTTP/1.0 so that the owner does not chunk
+        its response, the handler of the client frames it again.
+        """
+        upgrade = bool(environ.get('HTTP_UPGRADE'))
+        requestline = handler.requestline
+
+        if not upgrade:
+            requestline = requestline.rsplit(' ', 1)[0] + ' HTTP/1.0'
+
+        lines = [requestline]
+        skip = False
+
+        for line in handler.headers.headers:
+            if line[:1] in ' \t':
+                # continuation of the previous header
+                if not skip:
+                    lines.append(line.rstrip('\r\n'))
+
+                continue
+
+            name = line.split(':', 1)[0].strip().lower()
+            skip = name in self.skip_headers
+
+            if not skip:
+                lines.append(line.rstrip('\r\n'))
+
+        if upgrade:
+            lines.append('Connection: Upgrade')
+        else:
+            lines.append('Connection: close')
+            lines.append('Content-Length: %d' % (content_length or 0,))
+
+        lines.append('%s: %s' % (self.header, self.secret))
+
+        remote_addr = environ.get('REMOTE_ADDR', None)
+
+        if remote_addr and 'HTTP_X_FORWARDED_FOR' not in environ:
+            lines.append('X-Forwarded-For: %s' % (remote_addr,))
+
+        return '\r\n'.join(lines) + '\r\n\r\n'
+
+    def reject_payload(self, handler, max_size):
+        handler.write_response(
+            'Payload larger than %d bytes' % (max_size,),
+            status='413 Request Entity Too Large',
+            content_type='text/plain'
+        )
+
+    def proxy(self, handler, environ, server_id, max_size=None):
+        """
+        Pass the request to the worker that owns ``server_id`` and pipe its
+        response back to the client.
+
+        :param max_size: The ``max_payload_size`` of the endpoint. Larger
+            request bodies are answered with a 413 and never proxied.
+        """
+        owner = self.get_owner(server_id)
+        upgrade = bool(environ.get('HTTP_UPGRADE'))
+        reader = None
+        length = None
+        body = None
+
+        if not upgrade:
+            reader = transport.PayloadReader(
+                environ['wsgi.input'].read,
+                max_size
+            )
+            length = get_content_length(environ)
+
+            if length is None:
+                # the owner is sent a Content-Length, so a body of an unknown
+                # length is read up front, up to the limit
+                try:
+                    body = reader.read()
+                except transport.PayloadTooLarge:
+                    self.reject_payload(handler, max_size)
+
+                    return
+
+                length = len(body)
+            elif max_size and length > max_size:
+                self.reject_payload(handler, max_size)
+
+                return
+
+        upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            upstream.connect(self.get_address(owner))
+        except socket.error:
+            upstream.close()
+
+            handler.write_response(
+                'Worker %d is unavailable' % (owner,),
+                status='503 Service Unavailable',
+                content_type='text/plain'
+            )
+
+            return
+
+        pump = None
+
+        try:
+            upstream.sendall(self.build_request(handler, environ, length))
+
+            if upgrade:
+                # the connection is handed over to the owner, its response
+                # is sent verbatim
+                handler.close_connection = True
+                pump = gevent.spawn(self.pipe_upgrade, handler, upstream)
+
+                self.pipe(upstream.recv, handler.socket.sendall)
+
+                return
+
+            if body is None:
+                self.pipe(reader.read, upstream.sendall)
+            else:
+                upstream.sendall(body)
+
+            self.pipe_response(handler, upstream)
+        finally:
+            if pump:
+                pump.kill()
+
+            upstream.close()
+
+    def read_response_head(self, upstream):
+        """
+        Read the head of the response from the owner.
+
+        :returns: A tuple of ``(head, rest)`` where ``rest`` is the start of
+            the body. ``head`` is ``None`` if the response is invalid.
+        """
+        data = ''
+
+        while True:
+            index = data.find('\r\n\r\n')
+
+            if index >= 0:
+                return data[:index], data[index + 4:]
+
+            if len(data) > self.buffer_size:
+                return None, ''
+
+            chunk = upstream.recv(self.buffer_size)
+
+            if not chunk:
+                return None, ''
+
+            data += chunk
+
+    def parse_response_head(self, head):
+        """
+        Return the status and the end to end headers of a response head.
+
+        :raises ValueError: The head is invalid.
+        """
+        lines = head.split('\r\n')
+        status = lines[0].split(' ', 1)[1]
+        headers = []
+
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            name = name.strip()
+
+            if not sep or not name:
+                raise ValueError('Invalid header %r' % (line,))
+
+            if name.lower() in self.skip_response_headers:
+                continue
+
+            headers.append((name, value.strip()))
+
+        return status, headers
+
+    def pipe_response(self, handler, upstream):
+        """
+        Relay the response from the owner through the handler of the client.
+        """
+        head, rest = self.read_response_head(upstream)
+
+        try:
+            if head is None:
+                raise ValueError('Incomplete response')
+
+            status, headers = self.parse_response_head(head)
+        except (ValueError, IndexError):
+            handler.write_response(
+                'Invalid response from the owning worker',
+                status='502 Bad Gateway',
+                content_type='text/plain'
+            )
+
+            return
+
+        writer = handler.start_response(status, headers)
+        writer(rest)
+
+        self.pipe(upstream.recv, writer)
+
+    def pipe(self, read, write):
+        """
+        Copy bytes from ``read`` to ``write`` until EOF or a socket error.
+        """
+        size = self.buffer_size
+
+        try:
+            while True:
+                data = read(size)
+
+                if not data:
+                    break
+
+                write(data)
+        except socket.error, exc:
+            if exc.args[0] not in (errno.EPIPE, errno.ECONNRESET, errno.EBADF):
+                raise
+
+    def pipe_upgrade(self, handler, upstream):
+        """
+        Copy the client half of an upgraded (websocket) connection upstream.
+        """
+        # bytes the client sent after the handshake may already be buffered
+        buffered = getattr(handler.rfile, '_rbuf', None)
+
+        if buffered is not None:
+            data = buffered.getvalue()
+
+            if data:
+                buffered.seek(0)
+                buffered.truncate()
+                upstream.sendall(data)
+
+        self.pipe(handler.socket.recv, upstream.sendall)
+
+        try:
+            upstream.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
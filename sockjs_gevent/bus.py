@@ -0,0 +1,240 @@
+"""
+Message buses relay broadcasts and channel publishes to the SockJS
+applications running in sibling processes, e.g. the workers of a multi-process
+deployment.
+"""
+
+import errno
+import logging
+import os
+import time
+
+import gevent
+from gevent import socket
+
+from . import protocol
+
+
+logger = logging.getLogger(__name__)
+
+
+class BusError(Exception):
+    """
+    Raised when a message cannot be published on the bus.
+    """
+
+
+class Bus(object):
+    """
+    Base class for message buses.
+
+    A bus is bound to an ``Application``. Each message published on the bus is
+    delivered to ``Application.receive_from_bus`` in every *other* process
+    connected to the bus.
+
+    Subclasses must implement ``publish`` and call ``receive`` for each message
+    that arrives from a sibling process.
+
+    :ivar app: The ``Application`` that this bus is bound to.
+    """
+
+    def __init__(self):
+        self.app = None
+
+    def bind(self, app):
+        """
+        Bind this bus to the application.
+        """
+        self.app = app
+
+    def start(self):
+        """
+        Connect to the bus.
+        """
+
+    def stop(self):
+        """
+        Disconnect from the bus.
+        """
+
+    def publish(self, endpoint_name, channel_name, data):
+        """
+        Send a message to all sibling processes.
+
+        :param endpoint_name: The name of the endpoint the message was sent on.
+        :param channel_name: The channel the message was published to, or
+            ``None`` for an endpoint wide broadcast.
+        :param data: The JSON encoded message.
+        """
+        raise NotImplementedError
+
+    def receive(self, endpoint_name, channel_name, data):
+        """
+        Deliver a message from a sibling process to the application.
+        """
+        if not self.app:
+            return
+
+        self.app.receive_from_bus(endpoint_name, channel_name, data)
+
+    def encode_packet(self, endpoint_name, channel_name, data):
+        """
+        Serialise a message for the wire.
+
+        The header is a JSON array which can not contain a raw newline, so the
+        data follows the first newline untouched.
+        """
+        return protocol.encode([endpoint_name, channel_name]) + '\n' + data
+
+    def decode_packet(self, packet):
+        """
+        The inverse of ``encode_packet``.
+
+        :returns: A tuple of ``(endpoint_name, channel_name, data)``.
+        """
+        header, _, data = packet.partition('\n')
+        endpoint_name, channel_name = protocol.decode(header)
+
+        return endpoint_name, channel_name, data
+
+
+class UnixSocketBus(Bus):
+    """
+    A bus for the processes on a single host.
+
+    Each process binds a unix datagram socket in a shared directory. A message
+    is published by sending one datagram to every other socket in that
+    directory.
+
+    :ivar path: The directory that holds the sockets of the processes on the
+        bus.
+    :ivar name: The name of the socket of this process. Defaults to the pid.
+    :ivar max_size: The largest packet (header plus JSON) that can be sent.
+    :ivar peer_refresh: The number of seconds between scans of ``path`` for
+        sibling sockets.
+    """
+
+    max_size = 64 * 1024
+    peer_refresh = 1.0
+    suffix = '.sock'
+
+    def __init__(self, path, name=None):
+        super(UnixSocketBus, self).__init__()
+
+        self.path = path
+        self.name = name or str(os.getpid())
+
+        self.socket = None
+        self.thread = None
+
+        self.peers = []
+        self.peers_checked = 0
+
+    @property
+    def address(self):
+        return os.path.join(self.path, self.name + self.suffix)
+
+    def start(self):
+        if self.socket:
+            return
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        address = self.address
+
+        if os.path.exists(address):
+            # left over from a previous process with the same name
+            os.unlink(address)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(address)
+
+        self.socket = sock
+        self.thread = gevent.spawn(self._recv_packets)
+
+    def stop(self):
+        if not self.socket:
+            return
+
+        self.thread.kill()
+        self.socket.close()
+
+        self.thread = None
+        self.socket = None
+
+        try:
+            os.unlink(self.address)
+        except OSError:
+            pass
+
+    def get_peers(self, time_func=time.time):
+        """
+        Return the addresses of the sibling sockets on the bus.
+        """
+        now = time_func()
+
+        if now - self.peers_checked < self.peer_refresh:
+            return self.peers
+
+        own = self.address
+        peers = []
+
+        for name in os.listdir(self.path):
+            if not name.endswith(self.suffix):
+                continue
+
+            address = os.path.join(self.path, name)
+
+            if address != own:
+                peers.append(address)
+
+        self.peers = peers
+        self.peers_checked = now
+
+        return peers
+
+    def publish(self, endpoint_name, channel_name, data):
+        if not self.socket:
+            return
+
+        packet = self.encode_packet(endpoint_name, channel_name, data)
+
+        if len(packet) > self.max_size:
+            raise BusError('Message too large for the bus (%d bytes)' % (
+                len(packet),))
+
+        for address in self.get_peers():
+            try:
+                self.socket.sendto(packet, address)
+            except socket.error, exc:
+                if exc.args[0] not in (errno.ECONNREFUSED, errno.ENOENT):
+                    raise
+
+                # the sibling has gone away
+                self.peers = [peer for peer in self.peers if peer != address]
+
+    def _recv_packets(self):
+        while True:
+            try:
+                packet = self.socket.recv(self.max_size)
+            except socket.error, exc:
+                if exc.args[0] == errno.EBADF:
+                    # the socket has been closed
+                    return
+
+                logger.exception('Failed to read from the bus')
+
+                continue
+
+            try:
+                message = self.decode_packet(packet)
+            except (protocol.InvalidJSON, ValueError, IndexError):
+                logger.warning('Dropped an invalid packet from the bus')
+
+                continue
+
+            try:
+                self.receive(*message)
+            except Exception:
+                logger.exception('Failed to deliver a message from the bus')
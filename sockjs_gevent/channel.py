@@ -0,0 +1,172 @@
+"""
+Topic based fan-out for SockJS connections.
+"""
+
+from . import protocol
+
+
+class Channel(object):
+    """
+    A named group of subscribed connections.
+
+    :ivar name: The name of the channel.
+    :ivar subscribers: The set of subscribed ``Connection`` objects.
+    :ivar published: The number of messages published to this channel.
+    :ivar delivered: The number of messages queued for subscribers.
+    """
+
+    __slots__ = (
+        'name',
+        'subscribers',
+        'published',
+        'delivered',
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.subscribers = set()
+
+        self.published = 0
+        self.delivered = 0
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def __repr__(self):
+        return '<%s %r (%d subscribers) at 0x%x>' % (
+            self.__class__.__name__,
+            self.name,
+            len(self.subscribers),
+            id(self)
+        )
+
+    def deliver(self, encoded):
+        """
+        Queue an already encoded message on the session of every subscriber.
+
+        All subscribers share the same ``protocol.EncodedMessage`` instance.
+        A full session never holds up the others, see ``offer_messages``.
+
+        :returns: The number of sessions the message was queued on.
+        """
+        count = 0
+
+        # adding messages may close a session which unsubscribes it
+        for conn in list(self.subscribers):
+            session = conn.session
+
+            if not session:
+                continue
+
+            session.offer_messages(encoded)
+            count += 1
+
+        self.published += 1
+        self.delivered += count
+
+        return count
+
+    def get_stats(self):
+        return {
+            'subscribers': len(self.subscribers),
+            'published': self.published,
+            'delivered': self.delivered,
+        }
+
+
+class Registry(object):
+    """
+    Maps channel names to the connections subscribed to them.
+
+    :ivar channels: A mapping of name -> ``Channel``. Channels are created on
+        the first subscription and discarded with the last.
+    :ivar subscriptions: A mapping of ``Connection`` -> set of channel names.
+    """
+
+    channel_class = Channel
+
+    def __init__(self):
+        self.channels = {}
+        self.subscriptions = {}
+
+    def __contains__(self, name):
+        return name in self.channels
+
+    def get_channel(self, name):
+        return self.channels.get(name, None)
+
+    def subscribe(self, conn, name):
+        """
+        Subscribe ``conn`` to the channel ``name``.
+        """
+        channel = self.channels.get(name, None)
+
+        if not channel:
+            channel = self.channels[name] = self.channel_class(name)
+
+        channel.subscribers.add(conn)
+        self.subscriptions.setdefault(conn, set()).add(name)
+
+    def unsubscribe(self, conn, name=None):
+        """
+        Unsubscribe ``conn`` from the channel ``name``, or from all of its
+        channels if ``name`` is ``None``.
+        """
+        if name is None:
+            names = self.subscriptions.pop(conn, None) or ()
+        else:
+            names = self.subscriptions.get(conn, None)
+
+            if not names or name not in names:
+                return
+
+            names.discard(name)
+
+            if not names:
+                del self.subscriptions[conn]
+
+            names = (name,)
+
+        for name in names:
+            channel = self.channels.get(name, None)
+
+            if not channel:
+                continue
+
+            channel.subscribers.discard(conn)
+
+            if not channel.subscribers:
+                del self.channels[name]
+
+    def get_subscriptions(self, conn):
+        """
+        Return the set of channel names ``conn`` is subscribed to.
+        """
+        return set(self.subscriptions.get(conn, ()))
+
+    def publish(self, name, message):
+        """
+        Publish a message to all subscribers of the channel ``name``. The
+        message is encoded to JSON once, regardless of the number of
+        subscribers.
+
+        :returns: The number of sessions the message was queued on.
+        """
+        channel = self.channels.get(name, None)
+
+        if not channel:
+            return 0
+
+        if not isinstance(message, protocol.EncodedMessage):
+            message = protocol.EncodedMessage(message)
+
+        return channel.deliver(message)
+
+    def get_stats(self):
+        """
+        Return a mapping of channel name -> stats.
+        """
+        return dict(
+            (name, channel.get_stats())
+            for name, channel in self.channels.iteritems()
+        )
@@ -0,0 +1,374 @@
+"""
+JSON codecs.
+
+Every JSON implementation that is installed is registered under its module
+name (``json`` is always available, ``simplejson`` and ``ujson`` when they
+can be imported) and more can be added with ``register``. Endpoints pick one
+with the ``codec`` option, everything else uses ``default``.
+
+Binary codecs (``msgpack`` and ``cbor`` when installed) live in a registry of
+their own, see ``register_binary``. The ``rawwebsocket`` transport offers
+those listed in the ``binary_protocols`` endpoint option as websocket
+subprotocols named after the codec.
+
+``python -m sockjs_gevent.codec`` benchmarks the registered codecs on typical
+SockJS frames and reports the fastest correct one.
+"""
+
+import json as stdlib_json
+import sys
+import timeit
+
+
+class Codec(object):
+    """
+    A JSON implementation.
+
+    :ivar name: The name the codec is registered under.
+    :ivar encode: Called with a message, returns the JSON encoded ``str``.
+    :ivar decode: Called with a ``str`` or ``unicode`` JSON document, returns
+        the message. Must raise ``ValueError`` on invalid input.
+    :ivar raw_decode: Optional. Called with a document and a position, returns
+        ``(message, end)`` for the JSON value that starts there, like
+        ``json.JSONDecoder.raw_decode``. Request bodies are decoded as they
+        are read with it, without it they are read whole first.
+    """
+
+    __slots__ = (
+        'name',
+        'encode',
+        'decode',
+        'raw_decode',
+    )
+
+    def __init__(self, name, encode, decode, raw_decode=None):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+        self.raw_decode = raw_decode
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.name)
+
+
+# name -> Codec
+registry = {}
+
+# the codec used when an endpoint does not set one
+default = None
+
+# name -> binary Codec, the name doubles as the websocket subprotocol
+binary_registry = {}
+
+
+def register(codec):
+    """
+    Add a ``Codec`` to the registry, replacing any with the same name.
+    """
+    registry[codec.name] = codec
+
+    return codec
+
+
+def get_codec(codec):
+    """
+    Return the ``Codec`` for ``codec``, either a registered name, ``fastest``
+    to benchmark the registered codecs or a ``Codec`` instance.
+
+    :raises ValueError: ``codec`` is not registered.
+    """
+    if isinstance(codec, Codec):
+        return codec
+
+    if codec == 'fastest':
+        return get_fastest()
+
+    try:
+        return registry[codec]
+    except KeyError:
+        raise ValueError('Unknown JSON codec %r' % (codec,))
+
+
+def register_binary(codec):
+    """
+    Add a binary ``Codec``, one whose ``encode`` returns a ``str`` that is
+    sent in a binary websocket frame, to the binary registry.
+    """
+    binary_registry[codec.name] = codec
+
+    return codec
+
+
+def get_binary_codec(codec):
+    """
+    Return the binary ``Codec`` for ``codec``, a registered name or a
+    ``Codec`` instance.
+
+    :raises ValueError: ``codec`` is not registered.
+    """
+    if isinstance(codec, Codec):
+        return codec
+
+    try:
+        return binary_registry[codec]
+    except KeyError:
+        raise ValueError('Unknown binary codec %r' % (codec,))
+
+
+def set_default(codec):
+    """
+    Set the codec used when an endpoint does not set one.
+    """
+    global default
+
+    default = get_codec(codec)
+
+    return default
+
+
+def make_stdlib_codec():
+    return Codec(
+        'json',
+        stdlib_json.dumps,
+        stdlib_json.loads,
+        stdlib_json.JSONDecoder().raw_decode
+    )
+
+
+def make_simplejson_codec():
+    import simplejson
+
+    return Codec(
+        'simplejson',
+        simplejson.dumps,
+        simplejson.loads,
+        simplejson.JSONDecoder().raw_decode
+    )
+
+
+def make_ujson_codec():
+    import ujson
+
+    return Codec('ujson', ujson.dumps, ujson.loads)
+
+
+def strict_decoder(loads):
+    """
+    Wrap ``loads`` so that any error raised on invalid input is a
+    ``ValueError``, the binary libraries have exception types of their own.
+    """
+    def decode(data):
+        try:
+            return loads(data)
+        except ValueError:
+            raise
+        except Exception, exc:
+            raise ValueError(str(exc))
+
+    return decode
+
+
+def decode_strings(message):
+    """
+    Return ``message`` with every ``str`` decoded from UTF-8, as the JSON
+    encoders do, so that the binary libraries send it as text rather than as
+    a byte string.
+    """
+    if isinstance(message, str):
+        return message.decode('utf-8')
+
+    if isinstance(message, (list, tuple)):
+        return [decode_strings(item) for item in message]
+
+    if isinstance(message, dict):
+        return dict(
+            (decode_strings(key), decode_strings(value))
+            for key, value in message.iteritems()
+        )
+
+    return message
+
+
+def make_msgpack_codec():
+    import msgpack
+
+    if getattr(msgpack, 'version', (0,)) >= (0, 5, 2):
+        unpack_options = {'raw': False}
+    else:
+        unpack_options = {'encoding': 'utf-8'}
+
+    def encode(message):
+        # without the bin type a ``str`` is packed as text, like ``unicode``
+        return msgpack.packb(message, use_bin_type=False)
+
+    def decode(data):
+        return msgpack.unpackb(data, **unpack_options)
+
+    return Codec('msgpack', encode, strict_decoder(decode))
+
+
+def make_cbor_codec():
+    try:
+        import cbor2 as cbor
+    except ImportError:
+        import cbor
+
+    def encode(message):
+        return cbor.dumps(decode_strings(message))
+
+    return Codec('cbor', encode, strict_decoder(cbor.loads))
+
+
+def register_builtins():
+    """
+    Register the installed JSON implementations and make the fastest of them,
+    by reputation, the default.
+    """
+    register(make_stdlib_codec())
+
+    for factory in (make_simplejson_codec, make_ujson_codec):
+        try:
+            register(factory())
+        except ImportError:
+            pass
+
+    for name in ('ujson', 'simplejson', 'json'):
+        if name in registry:
+            return set_default(name)
+
+
+def register_binary_builtins():
+    """
+    Register the installed binary implementations.
+    """
+    for factory in (make_msgpack_codec, make_cbor_codec):
+        try:
+            register_binary(factory())
+        except ImportError:
+            pass
+
+
+# representative SockJS traffic, a chat message, a structured event, text
+# that needs escaping and a batch of messages
+SAMPLES = [
+    ['hello world'],
+    [{
+        'type': 'update',
+        'id': 12345678901234,
+        'ratio': 0.1,
+        'tiny': 1e-7,
+        'ok': True,
+        'missing': None,
+        'tags': ['a', 'b', 'c'],
+    }],
+    [u'caf\xe9 \u2028 </script> "quoted" \\ \n\t\x01'],
+    [{'user': 'user%d' % (i,), 'text': 'message %d' % (i,)}
+     for i in xrange(50)],
+]
+
+
+def is_correct(codec, samples=SAMPLES):
+    """
+    Whether ``codec`` round trips ``samples`` and agrees with the standard
+    library on them.
+    """
+    try:
+        for sample in samples:
+            data = codec.encode(sample)
+
+            if not isinstance(data, str):
+                return False
+
+            if stdlib_json.loads(data) != sample:
+                return False
+
+            if codec.decode(data) != sample:
+                return False
+
+            if codec.decode(stdlib_json.dumps(sample)) != sample:
+                return False
+    except Exception:
+        return False
+
+    return True
+
+
+def time_codec(codec, samples=SAMPLES, number=1000, repeat=3):
+    """
+    Return the best time, in seconds, to encode and decode ``samples``
+    ``number`` times.
+    """
+    encoded = [codec.encode(sample) for sample in samples]
+    encode = codec.encode
+    decode = codec.decode
+
+    def run():
+        for sample in samples:
+            encode(sample)
+
+        for data in encoded:
+            decode(data)
+
+    return min(timeit.repeat(run, repeat=repeat, number=number))
+
+
+def benchmark(codecs=None, number=1000):
+    """
+    Time the correct codecs in ``codecs`` (default: the registry).
+
+    :returns: A list of ``(seconds, codec)``, fastest first.
+    """
+    if codecs is None:
+        codecs = registry.values()
+
+    return sorted(
+        (time_codec(codec, number=number), codec)
+        for codec in codecs
+        if is_correct(codec)
+    )
+
+
+# the result of ``get_fastest``
+fastest = None
+
+
+def get_fastest(number=200):
+    """
+    Return the fastest correct codec in the registry, benchmarking them the
+    first time it is called.
+    """
+    global fastest
+
+    if fastest is None:
+        results = benchmark(number=number)
+
+        if results:
+            fastest = results[0][1]
+        else:
+            fastest = registry['json']
+
+    return fastest
+
+
+register_builtins()
+register_binary_builtins()
+
+
+def main(number=1000):
+    results = benchmark(number=number)
+    passed = set(codec.name for seconds, codec in results)
+
+    for seconds, codec in results:
+        print '%-12s %10.2fus' % (codec.name, seconds / number * 1e6)
+
+    for name in sorted(registry):
+        if name not in passed:
+            print '%-12s %12s' % (name, 'incorrect')
+
+    if results:
+        print
+        print 'fastest: %s' % (results[0][1].name,)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,344 @@
+"""
+Pre-forking multi-process server.
+
+The master process forks a number of worker processes, each running its own
+gevent hub and ``server.Server``. The workers either share a single listening
+socket inherited from the master or each bind their own with
+``SO_REUSEPORT``. Workers that die are restarted. With an affinity directory
+each worker also proxies transport requests for sessions owned by a sibling
+(see ``affinity.Affinity``). On ``SIGTERM`` (or
+``SIGINT``) the master asks every worker to stop, which closes the listener
+and calls ``Application.stop`` so open sessions are drained.
+
+Usage::
+
+    python -m sockjs_gevent.prefork --port 8081 --workers 4 myapp:make_server
+
+where ``make_server(listener, worker_id)`` returns a ``server.Server`` bound
+to ``listener``.
+"""
+
+import errno
+import optparse
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import gevent
+
+from . import affinity
+
+
+DEFAULT_BACKLOG = 1024
+
+# not exposed by the socket module on older Pythons
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+
+if SO_REUSEPORT is None and sys.platform.startswith('linux'):
+    SO_REUSEPORT = 15
+
+
+def get_cpu_count():
+    try:
+        import multiprocessing
+
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def make_listener(address, reuse_port=False, backlog=DEFAULT_BACKLOG):
+    """
+    Return a non-blocking listening TCP socket bound to ``address``.
+
+    :param reuse_port: Set ``SO_REUSEPORT`` so that several processes can bind
+        the same address and have the kernel balance connections between them.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    if reuse_port:
+        if SO_REUSEPORT is None:
+            raise RuntimeError('SO_REUSEPORT is not supported on %s' % (
+                sys.platform,))
+
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.setblocking(0)
+
+    return sock
+
+
+def import_factory(path):
+    """
+    Import a server factory given in the form ``package.module:callable``.
+    """
+    module_name, _, attr = path.partition(':')
+
+    if not module_name or not attr:
+        raise ValueError('Expected module:callable, got %r' % (path,))
+
+    __import__(module_name)
+
+    return getattr(sys.modules[module_name], attr)
+
+
+class Master(object):
+    """
+    Forks and supervises the worker processes.
+
+    :ivar factory: A callable ``factory(listener, worker_id)`` that returns a
+        ``server.Server`` instance. Called in each worker process after the
+        fork.
+    :ivar address: The ``(host, port)`` to listen on.
+    :ivar num_workers: The number of worker processes.
+    :ivar reuse_port: Whether each worker binds its own socket with
+        ``SO_REUSEPORT`` instead of sharing the socket of the master.
+    :ivar shutdown_timeout: The number of seconds a worker has to drain its
+        sessions before it is killed.
+    :ivar affinity_path: A directory for the unix sockets used to route
+        requests to the worker that owns their session, or ``None`` to
+        disable routing.
+    :ivar affinity_secret: Shared by the workers so that they recognise the
+        requests proxied by their siblings.
+    :ivar workers: A mapping of pid -> worker id of the running workers.
+    """
+
+    # the minimum number of seconds between restarts of the same worker
+    restart_delay = 1.0
+
+    def __init__(self, factory, address, workers=None, reuse_port=False,
+                 shutdown_timeout=10.0, backlog=DEFAULT_BACKLOG,
+                 affinity_path=None):
+        self.factory = factory
+        self.address = address
+        self.num_workers = workers or get_cpu_count()
+        self.reuse_port = reuse_port
+        self.shutdown_timeout = shutdown_timeout
+        self.backlog = backlog
+        self.affinity_path = affinity_path
+        self.affinity_secret = os.urandom(16).encode('hex')
+
+        self.listener = None
+        self.workers = {}
+        self.started_at = {}
+        self.stopping = False
+
+    def run(self):
+        """
+        Fork the workers and supervise them until told to stop.
+        """
+        if not self.reuse_port:
+            self.listener = make_listener(self.address, backlog=self.backlog)
+
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+
+        for worker_id in xrange(self.num_workers):
+            self.spawn(worker_id)
+
+        while self.workers and not self.stopping:
+            try:
+                pid, status = os.wait()
+            except OSError, exc:
+                if exc.errno == errno.EINTR:
+                    continue
+
+                if exc.errno == errno.ECHILD:
+                    break
+
+                raise
+
+            self.reap(pid, status)
+
+        self.shutdown()
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def spawn(self, worker_id):
+        """
+        Fork a new worker process.
+
+        :returns: The pid of the worker.
+        """
+        self.started_at[worker_id] = time.time()
+
+        pid = os.fork()
+
+        if pid:
+            self.workers[pid] = worker_id
+
+            return pid
+
+        exit_code = 1
+
+        try:
+            self.run_worker(worker_id)
+            exit_code = 0
+        except SystemExit, exc:
+            exit_code = exc.code
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(exit_code or 0)
+
+    def reap(self, pid, status):
+        """
+        Called when a worker process has exited. Restarts the worker unless the
+        master is stopping.
+        """
+        worker_id = self.workers.pop(pid, None)
+
+        if worker_id is None or self.stopping:
+            return
+
+        # throttle workers that die immediately after starting
+        elapsed = time.time() - self.started_at.get(worker_id, 0)
+
+        if elapsed < self.restart_delay:
+            time.sleep(self.restart_delay - elapsed)
+
+        self.spawn(worker_id)
+
+    def kill_workers(self, signum):
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError, exc:
+                if exc.errno == errno.ESRCH:
+                    self.workers.pop(pid, None)
+                else:
+                    raise
+
+    def shutdown(self):
+        """
+        Ask all the workers to stop and wait up to ``shutdown_timeout`` seconds
+        for them to drain before killing them.
+        """
+        self.stopping = True
+        self.kill_workers(signal.SIGTERM)
+
+        deadline = time.time() + self.shutdown_timeout
+
+        while self.workers and time.time() < deadline:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, exc:
+                if exc.errno == errno.EINTR:
+                    continue
+
+                if exc.errno == errno.ECHILD:
+                    break
+
+                raise
+
+            if not pid:
+                time.sleep(0.1)
+
+                continue
+
+            self.reap(pid, status)
+
+        if self.workers:
+            self.kill_workers(signal.SIGKILL)
+
+        self.workers.clear()
+
+        if self.listener:
+            self.listener.close()
+
+    def run_worker(self, worker_id):
+        """
+        The body of a worker process.
+        """
+        # the master handles ^C and tells the workers to stop
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        gevent.reinit()
+
+        listener = self.listener
+
+        if not listener:
+            listener = make_listener(
+                self.address,
+                reuse_port=True,
+                backlog=self.backlog
+            )
+
+        server = self.factory(listener, worker_id)
+
+        if self.affinity_path:
+            server.set_affinity(affinity.Affinity(
+                self.affinity_path,
+                worker_id,
+                self.num_workers,
+                secret=self.affinity_secret
+            ))
+
+        gevent.signal(signal.SIGTERM, server.stop, self.shutdown_timeout)
+
+        server.serve_forever()
+
+
+def serve(factory, address, workers=None, reuse_port=False,
+          shutdown_timeout=10.0, affinity_path=None):
+    """
+    Run a pre-forked server until it receives ``SIGTERM`` or ``SIGINT``.
+
+    See ``Master`` for a description of the arguments.
+    """
+    master = Master(
+        factory,
+        address,
+        workers=workers,
+        reuse_port=reuse_port,
+        shutdown_timeout=shutdown_timeout,
+        affinity_path=affinity_path
+    )
+
+    master.run()
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] module:factory',
+        description='Run a pre-forked SockJS server. factory(listener, '
+                    'worker_id) must return a sockjs_gevent.server.Server.'
+    )
+
+    parser.add_option('--host', default='0.0.0.0')
+    parser.add_option('--port', type='int', default=8081)
+    parser.add_option('--workers', type='int', default=None,
+                      help='Number of worker processes [default: cpu count]')
+    parser.add_option('--reuse-port', action='store_true', default=False,
+                      help='Bind each worker with SO_REUSEPORT')
+    parser.add_option('--shutdown-timeout', type='float', default=10.0,
+                      help='Seconds to wait for workers to drain')
+    parser.add_option('--affinity-dir', default=None,
+                      help='Route requests to the worker owning the session '
+                           'via unix sockets in this directory')
+
+    options, args = parser.parse_args(args)
+
+    if len(args) != 1:
+        parser.error('Exactly one module:factory is required')
+
+    serve(
+        import_factory(args[0]),
+        (options.host, options.port),
+        workers=options.workers,
+        reuse_port=options.reuse_port,
+        shutdown_timeout=options.shutdown_timeout,
+        affinity_path=options.affinity_dir
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,7 @@
-# try and use the fastest json implementation
-try:
-    import ujson as json
+import re
+from json.encoder import encode_basestring_ascii
 
-    def dumps(obj, *args, **kwargs):
-        """
-        ujson.dumps does not accept the separators arg
-        """
-        return json.dumps(obj)
-except ImportError:
-    try:
-        import simplejson as json
-    except ImportError:
-        import json
-
-    def dumps(obj, *args, **kwargs):
-        return json.dumps(obj, separators=(',', ':'), indent=0)
+from . import codec as codecs
 
 
 OPEN = "o"
@@ -26,6 +13,11 @@ HEARTBEAT = "h"
 CONN_INTERRUPTED = (1002, "Connection interrupted")
 CONN_ALREADY_OPEN = (2010, "Another connection still open")
 CONN_CLOSED = (3000, "Go away!")
+CONN_QUEUE_OVERFLOW = (3001, "Message queue overflow")
+
+
+# placeholder for the message of an ``EncodedMessage`` that is yet to be decoded
+NOT_DECODED = object()
 
 
 class InvalidJSON(Exception):
@@ -34,30 +26,305 @@ class InvalidJSON(Exception):
     """
 
 
-def encode(message):
+class EncodedMessage(object):
+    """
+    A message that has already been encoded to JSON. ``message_frame`` splices
+    ``json`` straight into the frame so that a message sent to many sessions
+    is only encoded once.
+
+    :ivar message: The original message. Decoded on first access for
+        messages built with ``from_json``.
+    :ivar json: The JSON encoded message.
+    :ivar codec: The ``codec.Codec`` the message was encoded with, ``None``
+        for the default.
+    :ivar cache: Transport specific encodings of this message shared between
+        sessions, see ``get_cached``.
+    """
+
+    __slots__ = (
+        '_message',
+        'json',
+        'codec',
+        'cache',
+    )
+
+    def __init__(self, message, data=None, codec=None):
+        self._message = message
+        self.codec = codec
+
+        if data is None:
+            data = encode(message, codec)
+
+        self.json = data
+        self.cache = None
+
+    @classmethod
+    def from_json(cls, data, codec=None):
+        """
+        Wrap an already JSON encoded message, e.g. one received from another
+        process.
+        """
+        return cls(NOT_DECODED, data, codec)
+
+    @property
+    def message(self):
+        if self._message is NOT_DECODED:
+            self._message = (self.codec or codecs.default).decode(self.json)
+
+        return self._message
+
+    def get_cached(self, key, func):
+        """
+        Return ``func(self)``, calling it only once for each ``key``.
+        """
+        cache = self.cache
+
+        if cache is None:
+            cache = self.cache = {}
+
+        try:
+            return cache[key]
+        except KeyError:
+            value = cache[key] = func(self)
+
+            return value
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.json)
+
+
+def encode(message, codec=None):
     """
     Python to JSON
+
+    :param codec: The ``codec.Codec`` to use, defaults to ``codec.default``.
     """
-    return json.dumps(message)
+    return (codec or codecs.default).encode(message)
 
 
-def decode(data):
+def decode(data, codec=None):
     """
     JSON to Python
     """
-    if isinstance(data, unicode):
-        data = data.encode('utf-8')
-
     # quick check to make sure we're going to decode a list
-    if data[0] != '[':
+    if data[:1] != '[':
         raise InvalidJSON(data)
 
     try:
-        return json.loads(data)
+        return (codec or codecs.default).decode(data)
     except ValueError:
         raise InvalidJSON(data)
 
 
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# characters that could continue a number, e.g. the exponent of ``1.5``
+NUMBER_TAIL = re.compile(r'[0-9eE.+\-]*')
+
+
+class StreamDecoder(object):
+    """
+    Decodes a JSON array from a file like object one element at a time, so
+    that each message can be dispatched as soon as it has been read instead
+    of holding the whole payload and its decoded form in memory.
+
+    Iterating yields the elements of the array. Elements that were yielded
+    before an error is found in the rest of the payload stay yielded.
+
+    Decoding part of a string at a time needs the ``raw_decode`` of the codec.
+    With a codec that has none, e.g. ``ujson``, the whole payload is read and
+    then decoded.
+
+    :ivar length: The number of bytes read so far.
+    """
+
+    __slots__ = (
+        'read',
+        'chunk_size',
+        'codec',
+        'raw_decode',
+        'buffer',
+        'eof',
+        'length',
+    )
+
+    def __init__(self, read, chunk_size=8192, codec=None):
+        """
+        :param read: Called with a size, returns at most that many bytes or an
+            empty string once the payload is exhausted.
+        :param codec: The ``codec.Codec`` to use, defaults to
+            ``codec.default``.
+        """
+        self.read = read
+        self.chunk_size = chunk_size
+        self.codec = codec or codecs.default
+        self.raw_decode = self.codec.raw_decode
+        self.buffer = ''
+        self.eof = False
+        self.length = 0
+
+    def more(self, pos, size):
+        """
+        Drop the consumed ``buffer[:pos]`` and read up to ``size`` more bytes.
+
+        :returns: Whether any bytes were read.
+        """
+        if self.eof:
+            return False
+
+        data = self.read(size)
+
+        if not data:
+            self.eof = True
+
+            return False
+
+        self.length += len(data)
+        self.buffer = self.buffer[pos:] + data
+
+        return True
+
+    def skip(self, pos):
+        """
+        Skip whitespace from ``pos``, reading more as required.
+
+        :returns: The position of the next character, ``len(buffer)`` at the
+            end of the payload.
+        """
+        while True:
+            pos = WHITESPACE.match(self.buffer, pos).end()
+
+            if pos < len(self.buffer):
+                return pos
+
+            if not self.more(pos, self.chunk_size):
+                return pos
+
+            pos = 0
+
+    def expect(self, pos):
+        """
+        Return the position of the next token, which must exist.
+        """
+        pos = self.skip(pos)
+
+        if pos >= len(self.buffer):
+            raise InvalidJSON(self.buffer)
+
+        return pos
+
+    def decode_value(self, pos):
+        """
+        Decode the value at ``pos``.
+
+        :returns: ``(value, end)``.
+        """
+        size = self.chunk_size
+
+        while True:
+            buf = self.buffer
+
+            try:
+                value, end = self.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+
+            # a number at the end of the buffer may continue in the next read
+            if end is not None:
+                if self.eof or NUMBER_TAIL.match(buf, end).end() < len(buf):
+                    return value, end
+
+            if not self.more(pos, size):
+                if end is not None:
+                    return value, end
+
+                raise InvalidJSON(buf[pos:])
+
+            pos = 0
+            # read as much again as is buffered so that a large value is only
+            # parsed a logarithmic number of times
+            size = max(size, len(self.buffer))
+
+    def read_all(self):
+        """
+        Read the rest of the payload into ``buffer``.
+        """
+        chunks = [self.buffer]
+        size = self.chunk_size
+
+        # ``more`` replaces the buffer with each new chunk
+        while self.more(len(self.buffer), size):
+            chunks.append(self.buffer)
+            size = max(size, self.length)
+
+        self.buffer = ''.join(chunks)
+
+    def decode_all(self):
+        """
+        Decode the whole payload with the codec, for codecs without a
+        ``raw_decode``.
+        """
+        self.read_all()
+
+        data = self.buffer.strip(' \t\n\r')
+
+        if not data:
+            if self.length:
+                # whitespace only
+                raise InvalidJSON(self.buffer)
+
+            return []
+
+        messages = decode(data, self.codec)
+
+        if not isinstance(messages, list):
+            raise InvalidJSON(self.buffer)
+
+        return messages
+
+    def __iter__(self):
+        if not self.raw_decode:
+            for message in self.decode_all():
+                yield message
+
+            return
+
+        pos = self.skip(0)
+
+        if pos >= len(self.buffer):
+            if self.length:
+                # whitespace only
+                raise InvalidJSON(self.buffer)
+
+            return
+
+        if self.buffer[pos] != '[':
+            raise InvalidJSON(self.buffer)
+
+        pos = self.expect(pos + 1)
+
+        if self.buffer[pos] != ']':
+            while True:
+                value, pos = self.decode_value(pos)
+
+                yield value
+
+                pos = self.expect(pos)
+                char = self.buffer[pos]
+
+                if char == ']':
+                    break
+
+                if char != ',':
+                    raise InvalidJSON(self.buffer)
+
+                pos = self.expect(pos + 1)
+
+        pos = self.skip(pos + 1)
+
+        if pos < len(self.buffer):
+            raise InvalidJSON(self.buffer)
+
+
 def close_frame(code, reason):
     if not isinstance(reason, basestring):
         reason = unicode(reason)
@@ -65,5 +332,97 @@ def close_frame(code, reason):
     return '%s[%d,"%s"]' % (CLOSE, code, reason)
 
 
-def message_frame(*chunks):
-    return MESSAGE + encode(chunks)
+def escape_js(data):
+    """
+    Escape ``data`` as the contents of a JavaScript string literal that is
+    safe inside an html ``<script>`` block.
+
+    Backslashes, quotes, control characters and everything outside of ASCII,
+    U+2028 and U+2029 included, become escape sequences in a single pass of
+    the (C accelerated) JSON string encoder. ``<`` becomes ``\\u003c`` so
+    that neither ``</script>`` nor ``<!--`` reach the html parser.
+    """
+    data = encode_basestring_ascii(data)[1:-1]
+
+    if '<' in data:
+        data = data.replace('<', '\\u003c')
+
+    return data
+
+
+def message_frame_parts(chunks, codec=None, escape=None, parts=None):
+    """
+    Append the buffers that make up the frame for ``chunks`` to ``parts`` so
+    that the caller can join them, along with whatever wraps the frame, in a
+    single pass. Pre-encoded messages are appended as is rather than copied
+    into an intermediate frame.
+
+    :param codec: The ``codec.Codec`` to encode plain messages with.
+    :param escape: Called with each encoded message, returns it escaped for
+        the transport. The result is cached on ``EncodedMessage`` chunks. The
+        ``a[``, ``,`` and ``]`` around the messages are never escaped.
+    :param parts: The list to append to, a new one by default.
+    :returns: ``parts``
+    """
+    if parts is None:
+        parts = []
+
+    for chunk in chunks:
+        if isinstance(chunk, EncodedMessage):
+            break
+    else:
+        if not isinstance(chunks, (list, tuple)):
+            # e.g. the deque of a ``DequeSession``, which the codecs can not
+            # serialise
+            chunks = list(chunks)
+
+        data = MESSAGE + encode(chunks, codec)
+
+        if escape:
+            data = escape(data)
+
+        parts.append(data)
+
+        return parts
+
+    if escape:
+        def escape_chunk(chunk):
+            if not isinstance(chunk, EncodedMessage):
+                return escape(encode(chunk, codec))
+
+            try:
+                # ``get_cached`` without the call, for every session after
+                # the first
+                return chunk.cache[escape]
+            except (TypeError, KeyError):
+                return chunk.get_cached(escape, escape_encoded)
+
+        def escape_encoded(encoded):
+            return escape(encoded.json)
+
+        pieces = [escape_chunk(chunk) for chunk in chunks]
+    else:
+        pieces = [
+            chunk.json if isinstance(chunk, EncodedMessage)
+            else encode(chunk, codec)
+            for chunk in chunks
+        ]
+
+    # interleave the separators without a python level loop
+    frame = [','] * (len(pieces) * 2 - 1)
+    frame[::2] = pieces
+
+    parts.append(MESSAGE + '[')
+    parts.extend(frame)
+    parts.append(']')
+
+    return parts
+
+
+def message_frame(*chunks, **kwargs):
+    """
+    Build the frame for ``chunks``.
+
+    :param codec: The ``codec.Codec`` to encode plain messages with.
+    """
+    return ''.join(message_frame_parts(chunks, kwargs.pop('codec', None)))
@@ -27,6 +27,17 @@ IFRAME_HTML = """
 """.strip()
 
 
+def make_iframe(client_url):
+    """
+    Render the iframe page that loads the SockJS client from ``client_url``.
+
+    :returns: ``(html, etag)``.
+    """
+    content = IFRAME_HTML % (client_url,)
+
+    return content, hashlib.md5(content).hexdigest()
+
+
 class RequestHandler(util.BaseHandler):
     def do_greeting(self):
         """
@@ -40,8 +51,7 @@ class RequestHandler(util.BaseHandler):
         if self.handle_options('GET'):
             return
 
-        content = IFRAME_HTML % (endpoint.client_url,)
-        our_etag = hashlib.md5(content).hexdigest()
+        content, our_etag = endpoint.get_iframe()
 
         cached = self.environ.get('HTTP_IF_NONE_MATCH', None)
 
@@ -62,9 +72,7 @@ class RequestHandler(util.BaseHandler):
         if self.handle_options('GET'):
             return
 
-        info = endpoint.get_info()
-
-        self.write_js(info, cors=True, cache=False)
+        self.write_js(endpoint.get_info_json(), cors=True, cache=False)
 
     def do_transport(self, endpoint, server_id, session_id, transport_type):
         # check if the transport is disabled for this endpoint
@@ -183,7 +191,7 @@ def route_request(app, environ, handler):
         return handler.do_iframe()
 
     if path == 'websocket':
-        handler.do_transport(None, None, 'rawwebsocket')
+        handler.do_transport(endpoint, None, None, 'rawwebsocket')
 
         return
 
@@ -221,4 +229,17 @@ def route_request(app, environ, handler):
 
         return
 
+    # in a multi-process deployment the session may live in a sibling worker
+    affinity = getattr(app, 'affinity', None)
+
+    if affinity and not affinity.is_local(server_id, environ):
+        affinity.proxy(
+            handler,
+            environ,
+            server_id,
+            endpoint.max_payload_size
+        )
+
+        return
+
     handler.do_transport(endpoint, server_id, session_id, transport)
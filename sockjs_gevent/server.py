@@ -1,22 +1,40 @@
+import logging
 import warnings
 import random
 
 from gevent import pywsgi
 
-from . import session, transport, handler
+from . import channel, protocol, session, transport, handler, websocket
+from . import codec, router
 
 # this url is used by SockJS-node, maintained by the creator of SockJS
 DEFAULT_CLIENT_URL = 'https://d1fxtkz8shb9d2.cloudfront.net/sockjs-0.3.min.js'
 HEARTBEAT_INTERVAL = 25.0  # seconds
 MAX_ENTROPY = 2 ** 32
 
+logger = logging.getLogger(__name__)
+
 
 DEFAULT_OPTIONS = {
     'use_cookie': False,
     'trace': False,
     'client_url': DEFAULT_CLIENT_URL,
     'disabled_transports': None,
-    'heartbeat_interval': HEARTBEAT_INTERVAL
+    'heartbeat_interval': HEARTBEAT_INTERVAL,
+    'max_queue_messages': None,
+    'max_queue_bytes': None,
+    'queue_policy': session.QueueLimits.DROP_OLDEST,
+    'queue_timeout': 5.0,
+    'coalesce_window': None,
+    'coalesce_messages': None,
+    'permessage_deflate': False,
+    'deflate_window_bits': 15,
+    'deflate_no_context_takeover': False,
+    'deflate_shared_frames': False,
+    'gzip_streaming': False,
+    'max_payload_size': None,
+    'codec': None,
+    'binary_protocols': None,
 }
 
 
@@ -28,17 +46,32 @@ class Application(object):
         as part of the SockJS url routing.
     :ivar default_options: A key -> value mapping of default options for the
         application. Can be overridden by the Endpoint.
+    :ivar bus: An optional ``bus.Bus`` that relays broadcasts and channel
+        publishes to applications in sibling processes.
+    :ivar affinity: An optional ``affinity.Affinity`` that routes transport
+        requests to the sibling process that owns their session.
     """
 
-    def __init__(self, endpoints=None, **options):
+    bus = None
+    affinity = None
+
+    def __init__(self, endpoints=None, bus=None, affinity=None, **options):
         """
         Builds a SockJS Application object.
 
         :param endpoints: A dict of name -> Endpoint instances. The key of the
             dict will be used in the path of the SockJS url.
+        :param bus: A ``bus.Bus`` instance.
+        :param affinity: An ``affinity.Affinity`` instance.
         """
         self.endpoints = {}
 
+        if bus:
+            self.set_bus(bus)
+
+        if affinity:
+            self.set_affinity(affinity)
+
         self.default_options = DEFAULT_OPTIONS.copy()
         self.default_options.update(options)
 
@@ -62,11 +95,23 @@ class Application(object):
         for endpoint in self.endpoints.values():
             endpoint.start()
 
+        if self.bus:
+            self.bus.start()
+
+        if self.affinity:
+            self.affinity.start()
+
     def stop(self):
         """
         Shutdown the application, block to inform the endpoints that they are
         closing.
         """
+        if self.affinity:
+            self.affinity.stop()
+
+        if self.bus:
+            self.bus.stop()
+
         for endpoint in self.endpoints.values():
             endpoint.stop()
 
@@ -82,6 +127,7 @@ class Application(object):
             raise NameError('%r endpoint already exists' % (name,))
 
         self.endpoints[name] = endpoint
+        endpoint.name = name
 
         endpoint.bind_to_application(self)
 
@@ -98,6 +144,53 @@ class Application(object):
     def get_endpoint(self, name):
         return self.endpoints.get(name, None)
 
+    def set_bus(self, bus):
+        """
+        Connect this application to a message bus.
+        """
+        self.bus = bus
+
+        bus.bind(self)
+
+    def set_affinity(self, affinity):
+        """
+        Route transport requests by server_id between sibling processes.
+        """
+        self.affinity = affinity
+
+        affinity.bind(self)
+
+    def relay(self, endpoint, channel_name, encoded):
+        """
+        Forward a broadcast or channel publish to sibling processes.
+
+        :param endpoint: The ``Endpoint`` the message was sent on.
+        :param channel_name: The channel name or ``None`` for a broadcast.
+        :param encoded: A ``protocol.EncodedMessage``.
+        """
+        if not self.bus or not endpoint.name:
+            return
+
+        try:
+            self.bus.publish(endpoint.name, channel_name, encoded.json)
+        except Exception:
+            # the message has already been delivered locally
+            logger.exception('Failed to relay a message for %r on the bus',
+                             endpoint.name)
+
+    def receive_from_bus(self, endpoint_name, channel_name, data):
+        """
+        Called by the bus with a message from a sibling process.
+        """
+        endpoint = self.get_endpoint(endpoint_name)
+
+        if not endpoint:
+            return
+
+        message = protocol.EncodedMessage.from_json(data, endpoint.codec)
+
+        endpoint.deliver(channel_name, message)
+
 
 class Connection(object):
     """
@@ -157,6 +250,25 @@ class Connection(object):
 
         self.session.add_messages(message)
 
+    def subscribe(self, name):
+        """
+        Subscribe this connection to the channel ``name`` on the endpoint.
+        """
+        if not self.endpoint:
+            return
+
+        self.endpoint.subscribe(self, name)
+
+    def unsubscribe(self, name=None):
+        """
+        Unsubscribe this connection from the channel ``name``, or from all
+        channels if ``name`` is ``None``.
+        """
+        if not self.endpoint:
+            return
+
+        self.endpoint.unsubscribe(self, name)
+
     def close(self):
         """
         Close this session
@@ -193,10 +305,19 @@ class Endpoint(object):
     to each Session.
 
     Builds and receives events from ``Connection`` objects.
+
+    :ivar name: The name this endpoint was added to the application with.
+    :ivar connections: The set of open ``Connection`` objects.
+    :ivar channels: The ``channel.Registry`` of channel subscriptions.
+    :ivar iframe: The ``(html, etag)`` of the iframe page, see ``get_iframe``.
+    :ivar info_template: The info response with a placeholder for the
+        entropy, see ``get_info_json``.
     """
 
     pool_class = session.Pool
     session_class = session.MemorySession
+    heartbeat_class = session.HeartbeatScheduler
+    registry_class = channel.Registry
 
     def __init__(self, connection_class=Connection, **options):
         """
@@ -208,8 +329,15 @@ class Endpoint(object):
         """
         self.connection_class = connection_class
         self.app = None
+        self.name = None
         self.started = False
         self.session_pool = None
+        self.heartbeat = None
+        self.queue_limits = None
+        self.connections = set()
+        self.channels = self.registry_class()
+        self.iframe = None
+        self.info_template = None
 
         self.init_options()
 
@@ -247,6 +375,29 @@ class Endpoint(object):
         get_option('client_url')
         get_option('trace')
         get_option('heartbeat_interval')
+        get_option('max_queue_messages')
+        get_option('max_queue_bytes')
+        get_option('queue_policy')
+        get_option('queue_timeout')
+        get_option('coalesce_window')
+        get_option('coalesce_messages')
+        get_option('permessage_deflate')
+        get_option('deflate_window_bits')
+        get_option('deflate_no_context_takeover')
+        get_option('deflate_shared_frames')
+        get_option('gzip_streaming')
+        get_option('max_payload_size')
+        get_option('codec')
+        get_option('binary_protocols')
+
+        if isinstance(self.codec, basestring):
+            self.codec = codec.get_codec(self.codec)
+
+        if self.binary_protocols:
+            self.binary_protocols = [
+                codec.get_binary_codec(binary_codec)
+                for binary_codec in self.binary_protocols
+            ]
 
         # disabled transports is a special case in that values are additive
         disabled_transports = options.pop('disabled_transports', None)
@@ -272,8 +423,59 @@ class Endpoint(object):
             for label in transport.get_transports(cors=True):
                 self.disabled_transports.append(label)
 
+    def make_queue_limits(self):
+        """
+        Return the ``QueueLimits`` shared by the sessions of this endpoint or
+        ``None`` if the session queues are unbounded.
+        """
+        if not self.max_queue_messages and not self.max_queue_bytes:
+            return
+
+        return session.QueueLimits(
+            max_messages=self.max_queue_messages,
+            max_bytes=self.max_queue_bytes,
+            policy=self.queue_policy,
+            timeout=self.queue_timeout
+        )
+
+    def make_coalescer(self):
+        """
+        Return a ``Coalescer`` for a new session or ``None`` if frames are to
+        be written as soon as messages arrive.
+        """
+        if not self.coalesce_window:
+            return
+
+        return session.Coalescer(
+            window=self.coalesce_window,
+            max_messages=self.coalesce_messages
+        )
+
+    def negotiate_deflate(self, environ):
+        """
+        Return the ``websocket.PerMessageDeflate`` state for a websocket
+        upgrade request or ``None`` if messages are to be sent uncompressed.
+
+        ``deflate_shared_frames`` implies ``deflate_no_context_takeover`` so
+        that a broadcast message is compressed once for all the sessions.
+        """
+        if not self.permessage_deflate:
+            return
+
+        return websocket.PerMessageDeflate.negotiate(
+            environ,
+            max_window_bits=self.deflate_window_bits,
+            no_context_takeover=(
+                self.deflate_no_context_takeover or self.deflate_shared_frames
+            )
+        )
+
     def make_connection(self, handler, session):
-        return self.connection_class(self, session)
+        conn = self.connection_class(self, session)
+
+        self.connections.add(conn)
+
+        return conn
 
     def transport_allowed(self, transport):
         return transport not in self.disabled_transports
@@ -290,7 +492,21 @@ class Endpoint(object):
         if not self.session_pool:
             self.session_pool = self.pool_class()
 
+        if not self.queue_limits:
+            self.queue_limits = self.make_queue_limits()
+
         self.session_pool.start()
+
+        if not self.heartbeat and self.heartbeat_interval:
+            self.heartbeat = self.heartbeat_class(self.heartbeat_interval)
+
+        if self.heartbeat:
+            self.heartbeat.start()
+
+        # the options are settled, render the static responses
+        self.iframe = router.make_iframe(self.client_url)
+        self.info_template = self.make_info_template()
+
         self.started = True
 
     def stop(self, timeout=None):
@@ -303,10 +519,32 @@ class Endpoint(object):
         self.session_pool.stop()
         self.session_pool = None
 
+        if self.heartbeat:
+            self.heartbeat.stop()
+            self.heartbeat = None
+
+        self.iframe = None
+        self.info_template = None
+
         self.started = False
 
     def make_session(self, session_id):
-        return self.session_class(session_id)
+        kwargs = {}
+
+        if self.queue_limits:
+            kwargs['limits'] = self.queue_limits
+
+        coalescer = self.make_coalescer()
+
+        if coalescer:
+            kwargs['coalescer'] = coalescer
+
+        session = self.session_class(session_id, **kwargs)
+
+        if self.heartbeat:
+            self.heartbeat.add(session)
+
+        return session
 
     def get_session(self, session_id):
         if not self.session_pool:
@@ -374,8 +612,132 @@ class Endpoint(object):
             'server_heartbeat_interval': self.heartbeat_interval
         }
 
+    def make_info_template(self):
+        info = self.get_info()
+        del info['entropy']
+
+        data = protocol.encode(info, self.codec).replace('%', '%%')
+
+        return data[:-1] + ', "entropy": %d}'
+
+    def get_info_json(self, randint=random.randint):
+        """
+        :returns: The JSON encoded ``get_info``, without encoding it for each
+            request.
+        """
+        if self.info_template is None:
+            self.info_template = self.make_info_template()
+
+        return self.info_template % (randint(1, MAX_ENTROPY),)
+
+    def get_iframe(self):
+        """
+        :returns: The ``(html, etag)`` of the iframe page for ``client_url``.
+        """
+        if self.iframe is None:
+            self.iframe = router.make_iframe(self.client_url)
+
+        return self.iframe
+
     def connection_closed(self, connection):
-        pass
+        self.connections.discard(connection)
+        self.channels.unsubscribe(connection)
+
+    def broadcast(self, message, connections=None):
+        """
+        Send a message to many connections, encoding it to JSON only once.
+
+        :param message: The message. Must be JSON encodable.
+        :param connections: An iterable of ``Connection`` objects. Defaults to
+            all the open connections of this endpoint, including those in
+            sibling processes if the application has a bus.
+        :returns: The number of local connections the message was queued for.
+        """
+        encoded = protocol.EncodedMessage(message, codec=self.codec)
+
+        if connections is not None:
+            return self.send_encoded(connections, encoded)
+
+        count = self.send_encoded(list(self.connections), encoded)
+
+        self.relay(None, encoded)
+
+        return count
+
+    def send_encoded(self, connections, encoded):
+        """
+        Queue a ``protocol.EncodedMessage`` on the session of each connection.
+
+        Never waits for room in a full session, see ``offer_messages``.
+        """
+        count = 0
+
+        for conn in connections:
+            session = conn.session
+
+            if not session:
+                continue
+
+            session.offer_messages(encoded)
+            count += 1
+
+        return count
+
+    def subscribe(self, connection, name):
+        """
+        Subscribe a connection to a channel. The subscription is removed when
+        the connection is closed.
+        """
+        self.channels.subscribe(connection, name)
+
+    def unsubscribe(self, connection, name=None):
+        """
+        Unsubscribe a connection from the channel ``name``, or from all channels
+        if ``name`` is ``None``.
+        """
+        self.channels.unsubscribe(connection, name)
+
+    def publish(self, name, message):
+        """
+        Publish a message to all connections subscribed to the channel
+        ``name``. The message is encoded to JSON only once.
+
+        If the application has a bus, the message is also published to the
+        channel in sibling processes.
+
+        :returns: The number of local connections the message was queued for.
+        """
+        encoded = protocol.EncodedMessage(message, codec=self.codec)
+        count = self.channels.publish(name, encoded)
+
+        self.relay(name, encoded)
+
+        return count
+
+    def relay(self, channel_name, encoded):
+        if not self.app:
+            return
+
+        self.app.relay(self, channel_name, encoded)
+
+    def deliver(self, channel_name, encoded):
+        """
+        Deliver a message relayed from a sibling process to the local
+        connections only.
+
+        :param channel_name: The channel or ``None`` for a broadcast.
+        :param encoded: A ``protocol.EncodedMessage``.
+        """
+        if channel_name is None:
+            return self.send_encoded(list(self.connections), encoded)
+
+        return self.channels.publish(channel_name, encoded)
+
+    def get_channel_stats(self):
+        """
+        Return a mapping of channel name -> stats for all active channels.
+        """
+        return self.channels.get_stats()
 
 
 class Server(pywsgi.WSGIServer, Application):
@@ -384,11 +746,36 @@ class Server(pywsgi.WSGIServer, Application):
 
     application = None
 
-    def __init__(self, listener, endpoints=None, options=None, **kwargs):
+    def __init__(self, listener, endpoints=None, options=None, bus=None,
+                 affinity=None, **kwargs):
         kwargs.setdefault('handler_class', handler.Handler)
 
         pywsgi.WSGIServer.__init__(self, listener, **kwargs)
-        Application.__init__(self, endpoints, **(options or {}))
+        Application.__init__(
+            self,
+            endpoints,
+            bus=bus,
+            affinity=affinity,
+            **(options or {})
+        )
+
+    def start(self):
+        """
+        Start accepting connections and start the endpoints.
+        """
+        pywsgi.WSGIServer.start(self)
+        Application.start(self)
+
+    def stop(self, timeout=None):
+        """
+        Stop accepting new connections, stop the endpoints (which drains their
+        sessions) and wait up to ``timeout`` seconds for the open requests to
+        finish.
+        """
+        self.close()
+
+        Application.stop(self)
+        pywsgi.WSGIServer.stop(self, timeout)
 
     def add_endpoint(self, name, endpoint):
         super(Server, self).add_endpoint(name, endpoint)
@@ -1,9 +1,11 @@
-from heapq import heappush, heappop
+from heapq import heapify, heappush, heappop
 from datetime import datetime
+import collections
+import math
 import time
 import weakref
 
-from gevent import queue
+from gevent import event, queue
 import gevent
 
 from . import protocol
@@ -61,6 +63,10 @@ class Session(object):
         holds the lock for reading messages from this session.
     :ivar writer: A `weakref.ref` to the transport handler that currently
         holds the lock for writing messages to this session.
+    :ivar last_sent: The timestamp at which messages or a heartbeat were last
+        handed to a reader. A heartbeat is only due an interval after it.
+    :ivar close_status: The ``(code, reason)`` reported to transports that
+        try to use this session after it was closed.
     """
 
     __slots__ = (
@@ -71,7 +77,8 @@ class Session(object):
         '_reader',
         '_writer',
         'conn',
-        'heartbeat_interval',
+        'last_sent',
+        'close_status',
     )
 
     def __init__(self, session_id, ttl_interval=DEFAULT_EXPIRY):
@@ -85,6 +92,8 @@ class Session(object):
         self._writer = None
 
         self.conn = None
+        self.last_sent = 0
+        self.close_status = None
 
     def __del__(self):
         try:
@@ -122,9 +131,17 @@ class Session(object):
         """
         raise NotImplementedError
 
+    def offer_messages(self, *msgs):
+        """
+        Like ``add_messages`` but never blocks the caller. Used to fan a
+        message out to many sessions, where one slow reader must not hold up
+        the others.
+        """
+        self.add_messages(*msgs)
+
     def get_messages(self, timeout=None):
         """
-        Return a list of messages in the order they were added.
+        Return a sequence of messages in the order they were added.
 
         :param timeout: The number of seconds to wait until giving up. If
             ``None``, this method should block until it can return a message.
@@ -150,15 +167,20 @@ class Session(object):
 
         self.conn.session_opened()
 
-    def close(self, reason='closed'):
+    def close(self, reason='closed', status=None):
         """
         Close this session.
 
         :param reason: The final state of this session. See ``state`` for valid
             values.
+        :param status: The ``(code, reason)`` to report when a transport tries
+            to use this session. Defaults to ``protocol.CONN_CLOSED``.
         """
         self.state = reason
 
+        if status:
+            self.close_status = status
+
         if self.conn:
             # only dispatch the close event if we were previously opened
             try:
@@ -297,7 +319,9 @@ class Session(object):
             raise SessionUnavailable(*protocol.CONN_INTERRUPTED)
 
         if self.closed:
-            raise SessionUnavailable(*protocol.CONN_CLOSED)
+            status = self.close_status or protocol.CONN_CLOSED
+
+            raise SessionUnavailable(*status)
 
         if not self._make_owner(owner, read, write):
             raise SessionUnavailable(*protocol.CONN_ALREADY_OPEN)
@@ -308,23 +332,6 @@ class Session(object):
         """
         self._make_owner(None, read, write, owner)
 
-    def run_heartbeat(self):
-        while True:
-            gevent.sleep(self.heartbeat_interval)
-
-            reader = self.read_owner
-
-            if not reader or not self.open:
-                break
-
-            try:
-                reader.send_heartbeat()
-            except Exception:
-                break
-
-    def start_heartbeat(self):
-        return gevent.spawn(self.run_heartbeat)
-
     def __repr__(self):
         locks = ''
 
@@ -343,24 +350,311 @@ class Session(object):
         )
 
 
+class QueueLimits(object):
+    """
+    Bounds the message queue of a session and decides what happens to a
+    message that would overflow it. A single instance is shared by all the
+    sessions of an endpoint.
+
+    Valid policies:
+     - drop_oldest: discard the oldest queued messages to make room.
+     - drop_newest: discard the message being added.
+     - block: block the sender for up to ``timeout`` seconds waiting for a
+       reader to make room, then close the session.
+     - close: close the session with ``protocol.CONN_QUEUE_OVERFLOW``.
+
+    :ivar max_messages: The maximum number of queued messages.
+    :ivar max_bytes: The maximum JSON encoded size of the queued messages.
+    :ivar counters: A mapping of policy -> the number of times it has fired.
+    """
+
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    BLOCK = 'block'
+    CLOSE = 'close'
+
+    policies = (DROP_OLDEST, DROP_NEWEST, BLOCK, CLOSE)
+
+    def __init__(self, max_messages=None, max_bytes=None, policy=DROP_OLDEST,
+                 timeout=5.0):
+        if policy not in self.policies:
+            raise ValueError('Unknown queue policy %r' % (policy,))
+
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.timeout = timeout
+
+        self.counters = dict.fromkeys(self.policies, 0)
+
+    def get_size(self, message):
+        """
+        Return the number of bytes ``message`` counts towards ``max_bytes``.
+        """
+        if isinstance(message, protocol.EncodedMessage):
+            return len(message.json)
+
+        return len(protocol.encode(message))
+
+    def is_full(self, length, queued_bytes, size=0):
+        """
+        Whether a message of ``size`` bytes would overflow a queue holding
+        ``length`` messages totalling ``queued_bytes``.
+        """
+        if self.max_messages and length >= self.max_messages:
+            return True
+
+        if self.max_bytes and queued_bytes + size > self.max_bytes:
+            return True
+
+        return False
+
+
+class Coalescer(object):
+    """
+    Decides how long a reader should hold on to the messages it has taken from
+    a session so that more can be merged into the same frame. The delay adapts
+    to the rate at which the session receives messages: sessions that are not
+    expected to receive another message within ``window`` are not delayed at
+    all.
+
+    Each session has its own instance.
+
+    :ivar window: The maximum number of seconds to wait for more messages.
+    :ivar max_messages: Stop waiting once a frame would hold this many
+        messages. ``None`` for no limit.
+    :ivar rate: The moving average of messages per second.
+    :ivar last_batch: The time the previous batch was taken.
+    """
+
+    __slots__ = (
+        'window',
+        'max_messages',
+        'rate',
+        'last_batch',
+    )
+
+    # the weight of the latest batch in ``rate``
+    smoothing = 0.3
+
+    def __init__(self, window=0.005, max_messages=None):
+        self.window = window
+        self.max_messages = max_messages
+
+        self.rate = 0.0
+        self.last_batch = None
+
+    def get_delay(self, count):
+        """
+        Return the number of seconds to wait for more messages given that
+        ``count`` messages are ready to be written.
+        """
+        max_messages = self.max_messages
+
+        if max_messages and count >= max_messages:
+            return 0
+
+        rate = self.rate
+
+        if rate * self.window < 1:
+            # another message is unlikely to arrive within the window
+            return 0
+
+        if not max_messages:
+            return self.window
+
+        # just long enough to fill the frame
+        return min(self.window, (max_messages - count) / rate)
+
+    def record(self, count, now=None):
+        """
+        Account for a batch of ``count`` messages taken from the session.
+        """
+        if now is None:
+            now = time.time()
+
+        last_batch = self.last_batch
+        self.last_batch = now
+
+        if last_batch is None:
+            return
+
+        elapsed = max(now - last_batch, 1e-6)
+
+        self.rate += self.smoothing * (count / elapsed - self.rate)
+
+
 class MemorySession(Session):
     """
-    In memory session with a ``gevent.pool.Queue`` as the message store.
+    In memory session with a ``gevent.queue.Queue`` as the message store.
+
+    :ivar limits: A ``QueueLimits`` instance bounding the queue, or ``None``
+        for an unbounded queue.
+    :ivar coalescer: A ``Coalescer`` used by transports to merge bursts of
+        messages into one frame, or ``None`` to write them immediately.
+    :ivar sizes: The encoded size of each queued message, oldest first. Only
+        tracked if ``limits.max_bytes`` is set.
+    :ivar queued_bytes: The sum of ``sizes``.
+    :ivar room: An ``Event`` that is set whenever a reader takes messages from
+        the queue. Used to block senders.
     """
 
-    __slots__ = ('queue',)
+    __slots__ = (
+        'queue',
+        'limits',
+        'sizes',
+        'queued_bytes',
+        'room',
+        'coalescer',
+    )
 
-    def __init__(self, *args, **kwargs):
-        super(MemorySession, self).__init__(*args, **kwargs)
+    def __init__(self, session_id, ttl_interval=DEFAULT_EXPIRY, limits=None,
+                 coalescer=None):
+        super(MemorySession, self).__init__(session_id, ttl_interval)
+
+        self.queue = self.make_queue()
+
+        self.limits = limits
+        self.coalescer = coalescer
+        self.sizes = None
+        self.queued_bytes = 0
+        self.room = None
+
+        if limits and limits.max_bytes:
+            self.sizes = collections.deque()
+
+    def make_queue(self):
+        return queue.Queue()
+
+    def queue_length(self):
+        """
+        Return the number of messages waiting in the queue.
+        """
+        return self.queue.qsize()
+
+    def put_message(self, msg):
+        """
+        Append a single message to the queue.
+        """
+        self.queue.put_nowait(msg)
+
+    def discard_oldest(self):
+        """
+        Remove the oldest message from the queue.
+        """
+        self.queue.get_nowait()
+
+    def reserve(self, message, block=True):
+        """
+        Apply ``limits`` before ``message`` is queued.
+
+        :param block: Whether the ``block`` policy may wait for room. If not,
+            a full session is closed straight away.
+        :returns: Whether the message can be queued.
+        """
+        limits = self.limits
+        size = 0
+
+        if self.sizes is not None:
+            size = limits.get_size(message)
+
+        if limits.is_full(self.queue_length(), self.queued_bytes, size):
+            policy = limits.policy
+            limits.counters[policy] += 1
+
+            if policy == limits.DROP_NEWEST:
+                return False
+
+            if policy == limits.DROP_OLDEST:
+                if limits.max_bytes and size > limits.max_bytes:
+                    # the message is too big for the queue on its own, the
+                    # queued messages are kept
+                    return False
+
+                while self.queue_length():
+                    self.discard_oldest()
+                    self.release(1)
+
+                    if not limits.is_full(self.queue_length(),
+                                          self.queued_bytes, size):
+                        break
+            elif policy == limits.BLOCK:
+                if not block or not self.wait_for_room(size, limits.timeout):
+                    self.close(status=protocol.CONN_QUEUE_OVERFLOW)
 
-        self.queue = queue.Queue()
+                    return False
+            else:
+                self.close(status=protocol.CONN_QUEUE_OVERFLOW)
+
+                return False
+
+        if self.sizes is not None:
+            self.sizes.append(size)
+            self.queued_bytes += size
+
+        return True
+
+    def wait_for_room(self, size, timeout):
+        """
+        Block until a message of ``size`` bytes fits in the queue.
+
+        :returns: Whether the message fits.
+        """
+        limits = self.limits
+        deadline = time.time() + timeout
+
+        if not self.room:
+            self.room = event.Event()
+
+        while limits.is_full(self.queue_length(), self.queued_bytes, size):
+            remaining = deadline - time.time()
+
+            if remaining <= 0 or self.closed or self.interrupted:
+                return False
+
+            self.room.clear()
+            self.room.wait(remaining)
+
+        return True
+
+    def release(self, count):
+        """
+        Account for ``count`` messages having left the queue.
+        """
+        sizes = self.sizes
+
+        if sizes is not None:
+            for _ in xrange(count):
+                self.queued_bytes -= sizes.popleft()
+
+        if self.room:
+            self.room.set()
 
     def add_messages(self, *msgs):
+        self.queue_messages(msgs)
+
+    def offer_messages(self, *msgs):
+        self.queue_messages(msgs, block=False)
+
+    def queue_messages(self, msgs, block=True):
+        """
+        Queue ``msgs``, applying ``limits`` to each.
+
+        :param block: See ``reserve``.
+        """
         if not msgs:
             return
 
+        limits = self.limits
+
         for msg in msgs:
-            self.queue.put_nowait(msg)
+            if limits and not self.reserve(msg, block):
+                if self.closed:
+                    break
+
+                continue
+
+            self.put_message(msg)
 
         self.touch()
 
@@ -385,22 +679,106 @@ class MemorySession(Session):
             except queue.Empty:
                 pass
 
+        if messages:
+            self.last_sent = time.time()
+
+            if self.limits:
+                self.release(len(messages))
+
+        return messages
+
+
+class DequeSession(MemorySession):
+    """
+    In memory session with a ``collections.deque`` as the message store.
+
+    Adding messages is a single ``extend`` and a reader takes all pending
+    messages by swapping out the whole buffer. A single ``Event`` wakes up a
+    waiting reader. This avoids the per message overhead of
+    ``gevent.queue.Queue``.
+
+    :ivar ready: Set when there are messages waiting in the buffer.
+    """
+
+    __slots__ = ('ready',)
+
+    def __init__(self, *args, **kwargs):
+        super(DequeSession, self).__init__(*args, **kwargs)
+
+        self.ready = event.Event()
+
+    def make_queue(self):
+        return collections.deque()
+
+    def queue_length(self):
+        return len(self.queue)
+
+    def discard_oldest(self):
+        self.queue.popleft()
+
+    def put_message(self, msg):
+        self.queue.append(msg)
+
+    def queue_messages(self, msgs, block=True):
+        if not msgs:
+            return
+
+        if self.limits:
+            super(DequeSession, self).queue_messages(msgs, block)
+        else:
+            self.queue.extend(msgs)
+            self.touch()
+
+        if self.queue:
+            self.ready.set()
+
+    def get_messages(self, timeout=None):
+        self.touch()
+
+        if not self.queue:
+            # there were no messages pending in the buffer, let's wait
+            self.ready.clear()
+            self.ready.wait(timeout)
+
+            if not self.queue:
+                return []
+
+        messages = self.queue
+        self.queue = collections.deque()
+        self.last_sent = time.time()
+
+        if self.limits:
+            self.release(len(messages))
+
         return messages
 
 
 class Pool(object):
     """
     A garbage collected Session Pool.
+
+    :ivar gc_cycle: The number of seconds between gc runs.
+    :ivar gc_offset: The number of seconds to wait before the first gc cycle
+        starts. Used to stagger the gc runs of multiple pools.
+    :ivar tombstones: The number of entries in the heap that belong to removed
+        sessions. These are skipped by gc and dropped when the heap is
+        compacted.
+    :ivar compact_ratio: The proportion of the heap that must be tombstones
+        before ``remove`` compacts it.
     """
 
-    def __init__(self, gc_cycle=10.0):
+    compact_ratio = 0.5
+
+    def __init__(self, gc_cycle=10.0, gc_offset=0.0):
         self.sessions = {}
         self.cycles = {}
 
         self.pool = []
+        self.tombstones = 0
         self.gcthread = gevent.Greenlet(self._gc_sessions)
 
         self.gc_cycle = gc_cycle
+        self.gc_offset = gc_offset
         self.stopping = False
 
     def __str__(self):
@@ -437,10 +815,19 @@ class Pool(object):
         while self.pool:
             last_checked, session = heappop(self.pool)
 
+            if self.cycles.pop(session, None) != last_checked:
+                # tombstone
+                continue
+
             if session.open:
                 session.interrupt()
 
+        self.tombstones = 0
+
     def _gc_sessions(self):
+        if self.gc_offset:
+            gevent.sleep(self.gc_offset)
+
         while True:
             gevent.sleep(self.gc_cycle)
             self.gc()
@@ -473,13 +860,12 @@ class Pool(object):
         if not session:
             return False
 
-        current_time = self.cycles.pop(session, None)
+        if self.cycles.pop(session, None) is not None:
+            # the heap entry is left in place as a tombstone, removing it here
+            # would be a linear scan of the heap.
+            self.tombstones += 1
 
-        if current_time:
-            try:
-                self.pool.remove((current_time, session))
-            except ValueError:
-                pass
+            self.compact()
 
         if session.open:
             try:
@@ -489,6 +875,29 @@ class Pool(object):
 
         return True
 
+    def compact(self, force=False):
+        """
+        Rebuild the heap without any tombstones. Unless ``force`` is set, this
+        only happens once tombstones make up more than ``compact_ratio`` of the
+        heap, which keeps the cost of ``remove`` amortised O(1).
+        """
+        if not self.tombstones:
+            return
+
+        if not force:
+            if self.tombstones <= len(self.pool) * self.compact_ratio:
+                return
+
+        cycles = self.cycles
+
+        self.pool = [
+            entry for entry in self.pool
+            if cycles.get(entry[1], None) == entry[0]
+        ]
+        heapify(self.pool)
+
+        self.tombstones = 0
+
     def gc(self, time_func=time.time):
         """
         Rearrange the heap flagging active sessions with the id of this
@@ -501,17 +910,28 @@ class Pool(object):
         current_time = time_func()
 
         while self.pool:
-            session = self.pool[0][1]
-            cycle = self.cycles[session]
+            last_checked, session = self.pool[0]
+            cycle = self.cycles.get(session, None)
+
+            if cycle != last_checked:
+                # the session was removed from the pool
+                heappop(self.pool)
+
+                if self.tombstones:
+                    self.tombstones -= 1
+
+                continue
 
             if cycle >= current_time:
                 # we've looped through all sessions
                 break
 
-            last_checked, session = heappop(self.pool)
+            heappop(self.pool)
 
             if session.has_expired(current_time):
-                # Session is to be GC'd immediately
+                # Session is to be GC'd immediately, its heap entry has already
+                # been popped so it must not be counted as a tombstone.
+                del self.cycles[session]
                 self.remove(session.session_id)
 
                 continue
@@ -519,3 +939,398 @@ class Pool(object):
             # Flag the session with the id of this GC cycle
             self.cycles[session] = current_time
             heappush(self.pool, (current_time, session))
+
+
+class TimerWheel(object):
+    """
+    Indexes sessions by ``expires_at`` into fixed width time buckets so that an
+    expiry sweep only visits the sessions whose deadline has passed.
+
+    ``Session.touch`` only bumps ``expires_at``, so the wheel is lazy about it:
+    when a bucket comes due, sessions that have been touched in the mean time
+    are filed under their new deadline instead of being expired.
+
+    :ivar resolution: The width of each bucket in seconds.
+    :ivar buckets: A mapping of bucket index -> set of sessions.
+    :ivar ticks: A heap of the bucket indexes in ``buckets``.
+    :ivar slots: A mapping of session -> bucket index. Sessions that never
+        expire have a bucket index of ``None``.
+    :ivar persistent: The set of sessions that never expire.
+    """
+
+    def __init__(self, resolution=1.0):
+        self.resolution = resolution
+
+        self.buckets = {}
+        self.ticks = []
+        self.slots = {}
+        self.persistent = set()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, session):
+        return session in self.slots
+
+    def get_tick(self, expires_at):
+        """
+        Return the index of the bucket that holds sessions expiring at
+        ``expires_at``. Everything in a bucket is due once the bucket is.
+        """
+        return int(math.ceil(expires_at / self.resolution))
+
+    def add(self, session):
+        """
+        File the session under its current ``expires_at``.
+        """
+        expires_at = session.expires_at
+
+        if not expires_at:
+            self.slots[session] = None
+            self.persistent.add(session)
+
+            return
+
+        tick = self.get_tick(expires_at)
+        bucket = self.buckets.get(tick, None)
+
+        if bucket is None:
+            bucket = self.buckets[tick] = set()
+            heappush(self.ticks, tick)
+
+        bucket.add(session)
+        self.slots[session] = tick
+
+    def remove(self, session):
+        """
+        Remove the session from the wheel.
+
+        :returns: Whether the session was in the wheel.
+        """
+        try:
+            tick = self.slots.pop(session)
+        except KeyError:
+            return False
+
+        if tick is None:
+            self.persistent.discard(session)
+
+            return True
+
+        bucket = self.buckets.get(tick, None)
+
+        if bucket:
+            # the empty bucket is cleaned up when it becomes due
+            bucket.discard(session)
+
+        return True
+
+    def clear(self):
+        """
+        Remove all sessions from the wheel.
+
+        :returns: The list of sessions that were removed.
+        """
+        sessions = self.slots.keys()
+
+        self.buckets.clear()
+        self.slots.clear()
+        self.persistent.clear()
+        self.ticks = []
+
+        return sessions
+
+    def expire(self, now=None):
+        """
+        Remove and return all the sessions that have expired as of ``now``.
+        """
+        now = now or time.time()
+        resolution = self.resolution
+        ticks = self.ticks
+        expired = []
+
+        while ticks and ticks[0] * resolution <= now:
+            bucket = self.buckets.pop(heappop(ticks), None)
+
+            if not bucket:
+                continue
+
+            for session in bucket:
+                if session.has_expired(now):
+                    del self.slots[session]
+                    expired.append(session)
+
+                    continue
+
+                # the session has been touched since it was filed
+                self.add(session)
+
+        if self.persistent:
+            for session in list(self.persistent):
+                if session.has_expired(now):
+                    self.remove(session)
+                    expired.append(session)
+                elif session.expires_at:
+                    # the expiry was set after the session was filed
+                    self.remove(session)
+                    self.add(session)
+
+        return expired
+
+
+class TimerWheelPool(Pool):
+    """
+    A garbage collected Session Pool that uses a ``TimerWheel`` instead of a
+    heap. Each gc cycle only visits sessions that are due to expire.
+    """
+
+    def __init__(self, gc_cycle=10.0, resolution=1.0, gc_offset=0.0):
+        super(TimerWheelPool, self).__init__(gc_cycle, gc_offset)
+
+        self.wheel = TimerWheel(resolution)
+
+    def drain(self):
+        self.sessions.clear()
+
+        for session in self.wheel.clear():
+            if session.opened:
+                session.interrupt()
+
+    def add(self, session, time_func=time.time):
+        if self.stopping:
+            raise RuntimeError('SessionPool is stopping')
+
+        if session.session_id in self.sessions:
+            raise RuntimeError('Adding already existing session %r' % (
+                session.session_id,))
+
+        if not session.new:
+            raise RuntimeError('Session has already expired')
+
+        self.sessions[session.session_id] = session
+
+        self.wheel.add(session)
+
+    def remove(self, session_id):
+        session = self.sessions.pop(session_id, None)
+
+        if not session:
+            return False
+
+        self.wheel.remove(session)
+
+        if session.opened:
+            try:
+                session.interrupt()
+            except Exception:
+                pass
+
+        return True
+
+    def gc(self, time_func=time.time):
+        """
+        Remove all sessions that have expired since the last gc cycle.
+        """
+        for session in self.wheel.expire(time_func()):
+            if self.sessions.get(session.session_id, None) is session:
+                del self.sessions[session.session_id]
+
+            if session.opened:
+                try:
+                    session.interrupt()
+                except Exception:
+                    pass
+
+
+class ShardedPool(object):
+    """
+    A Session Pool that spreads sessions over a number of independent pools
+    (shards) based on the hash of the session id.
+
+    Each shard runs its own gc thread and the start of each gc schedule is
+    staggered across ``gc_cycle``, so a single gc run only ever blocks the hub
+    for the sessions of one shard.
+
+    :ivar shards: The list of pools.
+    :ivar shard_class: The pool class to use for each shard.
+    """
+
+    shard_class = Pool
+
+    def __init__(self, shards=8, gc_cycle=10.0):
+        if shards < 1:
+            raise ValueError('At least one shard is required')
+
+        self.gc_cycle = gc_cycle
+        self.stopping = False
+
+        self.shards = [
+            self.shard_class(
+                gc_cycle=gc_cycle,
+                gc_offset=gc_cycle * index / shards
+            )
+            for index in xrange(shards)
+        ]
+
+    def __str__(self):
+        return str([str(shard) for shard in self.shards])
+
+    def __del__(self):
+        try:
+            self.stop()
+        except:
+            pass
+
+    def get_shard(self, session_id):
+        """
+        Return the shard that owns ``session_id``.
+        """
+        return self.shards[hash(session_id) % len(self.shards)]
+
+    def start(self):
+        """
+        Start the garbage collector for each shard.
+        """
+        for shard in self.shards:
+            shard.start()
+
+    def stop(self):
+        """
+        Manually expire all sessions in all shards.
+        """
+        if self.stopping:
+            return
+
+        self.stopping = True
+
+        for shard in self.shards:
+            shard.stop()
+
+    def drain(self):
+        for shard in self.shards:
+            shard.drain()
+
+    def add(self, session, time_func=time.time):
+        if self.stopping:
+            raise RuntimeError('SessionPool is stopping')
+
+        self.get_shard(session.session_id).add(session, time_func)
+
+    def get(self, session_id):
+        """
+        Get active sessions by their session id.
+        """
+        return self.get_shard(session_id).get(session_id)
+
+    def remove(self, session_id):
+        return self.get_shard(session_id).remove(session_id)
+
+    def gc(self, time_func=time.time):
+        """
+        Run a gc cycle on every shard. Normally each shard does this on its own
+        schedule.
+        """
+        for shard in self.shards:
+            shard.gc(time_func)
+
+
+def send_heartbeat(reader):
+    """
+    Write a heartbeat to ``reader``, a dead connection is noticed by the
+    request greenlet.
+    """
+    try:
+        reader.send_heartbeat()
+    except Exception:
+        pass
+
+
+class HeartbeatScheduler(object):
+    """
+    Sends heartbeats for all the sessions of an endpoint from a single
+    greenlet.
+
+    Sessions are bucketed by the tick at which their next heartbeat is due. On
+    each tick, every due session that has a reader attached and has not been
+    sent anything for an interval gets a heartbeat frame. Each heartbeat is
+    written from its own greenlet so that a client that stopped reading can
+    not hold up the heartbeats of the other sessions.
+
+    :ivar interval: The number of seconds between heartbeats.
+    :ivar resolution: The number of seconds between ticks.
+    :ivar buckets: A mapping of tick -> list of sessions due on that tick.
+    """
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, resolution=1.0):
+        self.interval = interval
+        self.resolution = resolution
+
+        self.buckets = {}
+        self.thread = gevent.Greenlet(self._run)
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.itervalues())
+
+    def start(self):
+        if not self.thread.started:
+            self.thread.start()
+
+    def stop(self):
+        self.thread.kill()
+        self.buckets.clear()
+
+    def get_tick(self, timestamp):
+        return int(timestamp // self.resolution)
+
+    def add(self, session, now=None):
+        """
+        Schedule the next heartbeat for ``session``.
+        """
+        tick = self.get_tick((now or time.time()) + self.interval)
+
+        self.buckets.setdefault(tick, []).append(session)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.resolution)
+            self.tick()
+
+    def tick(self, now=None):
+        """
+        Send a heartbeat to each session that is due.
+
+        Closed sessions and expired sessions without a reader are dropped from
+        the schedule, everything else is rescheduled.
+
+        :returns: The number of heartbeats that were sent.
+        """
+        now = now or time.time()
+        current = self.get_tick(now)
+        due = []
+        sent = 0
+
+        for tick in [tick for tick in self.buckets if tick <= current]:
+            due.extend(self.buckets.pop(tick))
+
+        for session in due:
+            if session.closed or session.interrupted:
+                continue
+
+            reader = session.read_owner
+
+            if not reader:
+                if session.has_expired(now):
+                    continue
+            elif now - session.last_sent < self.interval:
+                # the next heartbeat is due an interval after the last frame
+                self.add(session, session.last_sent)
+
+                continue
+            else:
+                gevent.spawn(send_heartbeat, reader)
+                session.last_sent = now
+                sent += 1
+
+            self.add(session, now)
+
+        return sent
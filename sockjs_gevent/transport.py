@@ -1,12 +1,17 @@
+import errno
 import urlparse
+import zlib
+from cStringIO import StringIO
 from socket import error as sock_err
 
 import gevent
-from gevent import socket, select
-from geventwebsocket import WebSocketError
-from geventwebsocket.handler import WebSocketHandler
+from gevent import lock, socket
 
-from . import protocol, session, util
+from . import protocol, session, util, websocket
+
+
+# wbits that make zlib write a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
 
 
 class TransportError(Exception):
@@ -22,12 +27,19 @@ class BaseTransport(object):
     :ivar writable: Whether this transport supports writing messages to the
         session.
     :ivar streaming: Whether this is a streaming transport
+    :ivar frames: The buffers queued by ``queue_frame`` that are yet to be
+        written to the handler by ``flush``.
+    :ivar write_lock: Held while writing to the client. Heartbeats are sent
+        from the greenlet of the ``HeartbeatScheduler`` and must not be
+        interleaved with the writes of the greenlet serving the request.
     """
 
     __slots__ = (
         'session',
         'handler',
-        'environ'
+        'environ',
+        'frames',
+        'write_lock',
     )
 
     # the direction of the transport. Used in session locking
@@ -51,6 +63,14 @@ class BaseTransport(object):
     # session
     timeout = 5.0
 
+    # static text that wraps each frame, see ``frame_parts``
+    frame_prefix = ''
+    frame_suffix = ''
+
+    # called with a frame, or a piece of a message frame, to escape it for
+    # the transport
+    escape = None
+
     def __init__(self, session, handler, environ):
         """
         Constructor for the transport.
@@ -60,11 +80,33 @@ class BaseTransport(object):
         self.session = session
         self.handler = handler
         self.environ = environ
+        self.frames = []
+        self.write_lock = lock.Semaphore()
 
     @property
     def socket(self):
         return self.readable and self.writable
 
+    @property
+    def endpoint(self):
+        """
+        The endpoint that the session belongs to, if it is bound.
+        """
+        conn = self.session.conn
+
+        if conn:
+            return conn.endpoint
+
+    @property
+    def codec(self):
+        """
+        The JSON codec of the endpoint, ``None`` for the default.
+        """
+        endpoint = self.endpoint
+
+        if endpoint:
+            return endpoint.codec
+
     def do_open(self):
         """
         Encode and write the 'open' frame to the handler.
@@ -75,24 +117,144 @@ class BaseTransport(object):
         """
         Write a close frame to the handler.
         """
-        frame = protocol.close_frame(code, reason)
-        self.handler.write(self.encode_frame(frame))
+        self.queue_frame(protocol.close_frame(code, reason))
+        self.flush()
 
     def write_message_frame(self, messages):
         if not messages:
             return
 
-        frame = self.encode_frame(protocol.message_frame(*messages))
+        self.queue_message_frame(messages)
+        self.flush()
+
+    def get_messages(self, timeout=None):
+        """
+        Take the pending messages from the session, waiting up to ``timeout``
+        seconds for the first one. If the session has a ``coalescer``, wait a
+        little longer while messages are arriving quickly so that they leave in
+        the same frame.
+        """
+        session = self.session
+        messages = session.get_messages(timeout=timeout)
+        coalescer = getattr(session, 'coalescer', None)
+
+        if not messages or not coalescer:
+            return messages
+
+        delay = coalescer.get_delay(len(messages))
+
+        if delay:
+            gevent.sleep(delay)
 
-        self.handler.write(frame)
+            messages.extend(session.get_messages(timeout=0))
+
+        coalescer.record(len(messages))
+
+        return messages
+
+    def frame_parts(self, data):
+        """
+        Return the buffers that make up the frame for ``data``. Deals with the
+        edge cases of formatting the messages for the transports. Things like
+        \n characters and Javascript callback frames.
+        """
+        escape = self.escape
+
+        if escape:
+            data = escape(data)
+
+        return self.frame_prefix, data, self.frame_suffix
+
+    def message_frame_parts(self, messages, parts=None):
+        """
+        Like ``frame_parts`` for the message frame of ``messages`` but without
+        building the frame first, see ``protocol.message_frame_parts``.
+
+        :param parts: The list to append to, a new one by default.
+        :returns: ``parts``
+        """
+        if parts is None:
+            parts = []
+
+        if len(messages) == 1:
+            message = messages[0]
+
+            if isinstance(message, protocol.EncodedMessage):
+                key = self.get_frame_key()
+
+                if key is not None:
+                    # a broadcast, built once for all the sessions that frame
+                    # messages the same way
+                    parts.append(message.get_cached(key, self.build_frame))
+
+                    return parts
+
+        parts.append(self.frame_prefix)
+        protocol.message_frame_parts(messages, self.codec, self.escape, parts)
+        parts.append(self.frame_suffix)
+
+        return parts
+
+    def get_frame_key(self):
+        """
+        Return the key that the complete frame of a single
+        ``protocol.EncodedMessage`` is cached under, or ``None`` if the frame
+        is specific to this request.
+        """
+        return (self.frame_prefix, self.frame_suffix, self.escape)
+
+    def build_frame(self, message):
+        parts = [self.frame_prefix]
+        protocol.message_frame_parts([message], None, self.escape, parts)
+        parts.append(self.frame_suffix)
+
+        return ''.join(parts)
 
     def encode_frame(self, data):
         """
-        Write the data in a frame specifically for this transport. Deals with
-        the edge cases of formatting the messages for the transports. Things
-        like \n characters and Javascript callback frames.
+        Write the data in a frame specifically for this transport.
         """
-        return data
+        return ''.join(self.frame_parts(data))
+
+    def queue_frame(self, data):
+        """
+        Queue a frame to be written by the next ``flush``.
+        """
+        self.frames.extend(self.frame_parts(data))
+
+    def queue_message_frame(self, messages):
+        """
+        Queue the message frame for ``messages``, its pieces are only joined
+        by ``flush``.
+        """
+        self.message_frame_parts(messages, self.frames)
+
+    def flush(self):
+        """
+        Write all the queued frames to the handler in one go.
+        """
+        with self.write_lock:
+            self.write_frames()
+
+    def write_frames(self):
+        """
+        ``flush`` for callers that already hold the ``write_lock``.
+        """
+        frames = self.frames
+
+        if not frames:
+            return
+
+        data = ''.join(frames)
+        del frames[:]
+
+        self.write(data)
+
+    def write(self, data):
+        """
+        Write the body bytes produced by ``flush``.
+        """
+        self.handler.write(data)
 
     def get_headers(self):
         """
@@ -118,14 +280,19 @@ class BaseTransport(object):
         pass
 
     def prepare_request(self):
-        pass
+        """
+        Called before the session is acquired. Return ``False`` to end the
+        request, e.g. after responding with an error.
+        """
 
     def handle(self):
         # ensure that the request has approached us with a valid REQUEST_METHOD
         if self.handler.handle_options(*self.http_options):
             return
 
-        self.prepare_request()
+        if self.prepare_request() is False:
+            # a response has already been written
+            return
 
         if not self.acquire_session():
             # something went wrong trying to lock the session.
@@ -173,34 +340,163 @@ class BaseTransport(object):
         self.session.unlock(self, self.readable, self.writable)
 
     def send_heartbeat(self):
+        """
+        Called from the greenlet of the ``HeartbeatScheduler``. Skipped if the
+        request greenlet is writing, the connection is not idle.
+        """
+        write_lock = self.write_lock
+
+        if not write_lock.acquire(blocking=False):
+            return
+
+        try:
+            self.write_heartbeat()
+        finally:
+            write_lock.release()
+
+    def write_heartbeat(self):
+        """
+        Write a heartbeat frame, the ``write_lock`` is held.
+        """
         raise NotImplementedError
 
 
+class PayloadTooLarge(TransportError):
+    """
+    Raised when a request body is larger than the ``max_payload_size`` of the
+    endpoint.
+    """
+
+
+class PayloadReader(object):
+    """
+    Reads a request body, enforcing a size limit as it goes.
+
+    :ivar length: The number of bytes read so far.
+    """
+
+    __slots__ = (
+        'read_input',
+        'max_size',
+        'length',
+    )
+
+    def __init__(self, read_input, max_size=None):
+        self.read_input = read_input
+        self.max_size = max_size
+        self.length = 0
+
+    def read(self, size=None):
+        max_size = self.max_size
+
+        if max_size:
+            # never read more than one byte past the limit
+            limit = max_size - self.length + 1
+
+            if size is None or size > limit:
+                size = limit
+
+        if size is None:
+            data = self.read_input()
+        else:
+            data = self.read_input(size)
+
+        self.length += len(data)
+
+        if max_size and self.length > max_size:
+            raise PayloadTooLarge('Payload larger than %d bytes' % (max_size,))
+
+        return data
+
+
 class WritingOnlyTransport(BaseTransport):
     """
     Base functionality for a transport that only receives messages from the
     endpoint.
 
-    Decodes the received messages and adds them to the session.
+    Decodes the received messages and adds them to the session one at a time
+    as they are read from the request body.
+
+    :ivar rejected: Whether the request has been answered with a 413 because
+        the body is too large.
     """
 
-    __slots__ = ()
+    __slots__ = ('rejected',)
 
     writable = True
     cookie = True
 
+    def __init__(self, session, handler, environ):
+        super(WritingOnlyTransport, self).__init__(session, handler, environ)
+
+        self.rejected = False
+
+    def get_max_payload_size(self):
+        endpoint = self.endpoint
+
+        if endpoint:
+            return endpoint.max_payload_size
+
+    def make_reader(self):
+        return PayloadReader(
+            self.environ['wsgi.input'].read,
+            self.get_max_payload_size()
+        )
+
     def get_payload(self):
-        return self.environ['wsgi.input'].read()
+        """
+        Return a ``read`` callable for the JSON encoded messages.
+        """
+        return self.make_reader().read
+
+    def prepare_request(self):
+        """
+        Reject a body that is declared to be too large before reading it.
+        """
+        max_size = self.get_max_payload_size()
+
+        if not max_size:
+            return
+
+        try:
+            length = int(self.environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return
+
+        if length > max_size:
+            self.reject_payload(max_size)
+
+            return False
+
+    def reject_payload(self, max_size):
+        """
+        Respond with a 413, the session is left alone.
+        """
+        self.rejected = True
+
+        self.handler.write_response(
+            'Payload larger than %d bytes' % (max_size,),
+            status='413 Request Entity Too Large',
+            headers=self.get_headers()
+        )
 
     def process_request(self):
-        payload = self.get_payload()
+        decoder = protocol.StreamDecoder(self.get_payload(), codec=self.codec)
+        dispatch = self.session.dispatch
 
-        if not payload:
-            raise TransportError('Payload expected')
+        for message in decoder:
+            dispatch(message)
 
-        messages = protocol.decode(payload)
+        if not decoder.length:
+            raise TransportError('Payload expected')
 
-        self.session.dispatch(*messages)
+    def handle_request(self):
+        try:
+            self.process_request()
+        except PayloadTooLarge:
+            # a body without a Content-Length that went over the limit, the
+            # messages before it have been dispatched
+            self.reject_payload(self.get_max_payload_size())
 
 
 class XHRSend(WritingOnlyTransport):
@@ -210,7 +506,7 @@ class XHRSend(WritingOnlyTransport):
     http_options = ['POST']
 
     def finalize_request(self):
-        if self.session.opened:
+        if self.session.opened and not self.rejected:
             self.handler.write_nothing(headers=self.get_headers())
 
 
@@ -221,70 +517,102 @@ class JSONPSend(WritingOnlyTransport):
     http_options = ['POST']
 
     def get_payload(self):
-        payload = super(JSONPSend, self).get_payload()
+        read = super(JSONPSend, self).get_payload()
         content_type = self.environ.get('CONTENT_TYPE', 'text/plain')
 
         if content_type == 'text/plain':
-            return payload
+            return read
+
+        payload = ''
 
         if content_type == 'application/x-www-form-urlencoded':
             # Do we have a Payload?
-            qs = urlparse.parse_qs(payload)
+            qs = urlparse.parse_qs(read())
 
-            return qs.get('d', [None])[0]
+            payload = qs.get('d', [''])[0]
+
+        return StringIO(payload).read
 
     def finalize_request(self):
-        if self.session.opened:
+        if self.session.opened and not self.rejected:
             self.start_response()
             self.handler.write('ok')
 
 
+class ClientAborted(TransportError):
+    """
+    Thrown into the greenlet handling a request when the client has gone away.
+    """
+
+
 class SendingOnlyTransport(BaseTransport):
     readable = True
 
     cookie = True
     cache = False
 
-    def send_heartbeat(self):
-        self.handler.write(self.encode_frame(protocol.HEARTBEAT))
+    def write_heartbeat(self):
+        self.queue_frame(protocol.HEARTBEAT)
+        self.write_frames()
 
-    def produce_messages(self, handler):
+    def produce_messages(self):
         raise NotImplementedError
 
-    def handle_request(self, handler, raw_request_data):
+    def handle_request(self):
         # in a sending only transport, no more data is expected from the client
         # but we need to be notified immediately if the connection has been
-        # aborted by the client.
+        # aborted by the client. A hub watcher on the socket interrupts the
+        # producer, which runs in the request greenlet.
+        watcher = self.watch_connection()
 
-        fd = handler.socket.fileno()
+        try:
+            self.produce_messages()
+        except ClientAborted:
+            raise socket.error(errno.EBADF)
+        finally:
+            watcher.stop()
 
-        # start 2 greenlets, one that checks for an aborted connection
-        # and the other that produces the messages
-        producer = gevent.Greenlet(self.produce_messages, handler)
-        conn_check = gevent.Greenlet(select.select, [fd], [], [fd])
+    def watch_connection(self):
+        """
+        Start watching the client socket for readability. Returns the watcher,
+        which must be stopped when the request is done.
+        """
+        sock = self.handler.socket
+        watcher = gevent.get_hub().loop.io(sock.fileno(), 1)
 
-        threads = [
-            producer,
-            conn_check
-        ]
+        # the raw socket, its methods never yield to the hub
+        raw_sock = getattr(sock, '_sock', sock)
 
-        # start both threads
-        for thread in threads:
-            thread.start()
+        watcher.start(
+            self.connection_readable,
+            watcher,
+            raw_sock,
+            gevent.getcurrent()
+        )
 
-        # wait for one to return
-        ret = util.waitany(threads)
+        return watcher
 
-        if ret == producer:
-            # the producer thread returned first, all good here.
-            conn_check.kill()
+    def connection_readable(self, watcher, raw_sock, producer):
+        """
+        Called by the hub when the client socket becomes readable during the
+        request, which means it was closed or more data has arrived.
+        """
+        try:
+            data = raw_sock.recv(1, socket.MSG_PEEK)
+        except sock_err, exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
 
-            return
+            data = None
 
-        # looks like the connection was aborted
-        producer.kill()
+        watcher.stop()
 
-        raise socket.error(socket.EBADF)
+        if data:
+            # the client is still there and has sent more data (e.g. a
+            # pipelined request), there is nothing more to watch for.
+            return
+
+        producer.throw(ClientAborted())
 
 
 class PollingTransport(SendingOnlyTransport):
@@ -294,51 +622,74 @@ class PollingTransport(SendingOnlyTransport):
 
     content_type = 'application/javascript'
 
-    def prep_response(self, handler):
-        super(PollingTransport, self).prep_response(handler)
+    # whether this request has responded with the open frame
+    open_frame_sent = False
+
+    def prepare_request(self):
+        self.start_response()
+
+    def do_open(self):
+        if not self.session.new:
+            return
+
+        self.queue_frame(protocol.OPEN)
+        self.flush()
 
-        handler.start_response('200 OK')
+        self.open_frame_sent = True
+
+    def handle_request(self):
+        if self.open_frame_sent:
+            # the open frame is the entire response
+            return
 
-    def do_open(self, handler):
-        handler.write(self.encode_frame(protocol.OPEN))
+        super(PollingTransport, self).handle_request()
 
-    def produce_messages(self, handler):
+    def produce_messages(self):
         """
         Spin lock the thread until we have a message on the queue.
         """
-        messages = self.session.get_messages(timeout=self.timeout)
+        messages = self.get_messages(timeout=self.timeout)
 
-        self.write_message_frame(handler, messages)
+        self.write_message_frame(messages)
 
 
 class XHRPolling(PollingTransport):
     http_options = ['POST']
     cors = True
 
-    def encode_frame(self, data):
-        return data + '\n'
+    frame_suffix = '\n'
 
 
 class JSONPolling(PollingTransport):
     http_options = ['GET']
     cors = False
 
-    def encode_frame(self, data):
-        frame = protocol.encode(data)
+    callback = None
+
+    frame_suffix = '");\r\n'
+
+    escape = staticmethod(protocol.escape_js)
 
-        return "%s(%s);\r\n" % (self.callback, frame)
+    @property
+    def frame_prefix(self):
+        return self.callback + '("'
+
+    def get_frame_key(self):
+        # the callback differs for every client, only the escaped message is
+        # shared
+        return None
 
-    def prep_response(self, handler):
-        qs = urlparse.parse_qs(handler.environ.get("QUERY_STRING", ''))
+    def prepare_request(self):
+        qs = urlparse.parse_qs(self.environ.get('QUERY_STRING', ''))
 
         self.callback = qs.get('c', qs.get('callback', [None]))[0]
 
         if not self.callback:
-            handler.do500('"callback" parameter required')
+            self.handler.internal_error('"callback" parameter required')
 
-            return
+            return False
 
-        return super(JSONPolling, self).prep_response(handler)
+        return super(JSONPolling, self).prepare_request()
 
 
 class StreamingTransport(SendingOnlyTransport):
@@ -347,30 +698,108 @@ class StreamingTransport(SendingOnlyTransport):
     # according to sockjs-protocol, the response limit should be 128KiB
     response_limit = 128 * 1024
 
-    def produce_messages(self, handler):
-        bytes_to_write = self.response_limit + handler.response_length
+    # a gzip ``zlib.compressobj`` when the response is compressed, see
+    # ``Endpoint.gzip_streaming``
+    compressor = None
+    compress_level = 6
 
-        while handler.response_length < bytes_to_write:
-            if not self.session.open:
-                break
+    # the number of body bytes written before compression
+    raw_length = 0
 
-            messages = self.session.get_messages(timeout=self.timeout)
+    def start_response(self, status='200 OK', extra_headers=None):
+        headers = list(extra_headers or [])
+        endpoint = self.endpoint
 
-            if not messages:
-                continue
+        if endpoint and endpoint.gzip_streaming:
+            headers.append(('Vary', 'Accept-Encoding'))
+
+            if util.accepts_encoding(self.environ, 'gzip'):
+                self.compressor = zlib.compressobj(
+                    self.compress_level,
+                    zlib.DEFLATED,
+                    GZIP_WBITS
+                )
+
+                headers.append(('Content-Encoding', 'gzip'))
+
+        super(StreamingTransport, self).start_response(status, headers)
+
+    def write(self, data):
+        """
+        Sync-flush the compressor after every write so that each frame
+        reaches the client as soon as it is produced.
+        """
+        self.raw_length += len(data)
+        compressor = self.compressor
 
+        if compressor:
+            data = compressor.compress(data)
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        self.handler.write(data)
+
+    def finish_response(self):
+        """
+        Write the gzip trailer, if the response is compressed.
+        """
+        compressor = self.compressor
+
+        if not compressor:
+            return
+
+        self.compressor = None
+
+        try:
+            with self.write_lock:
+                self.handler.write(compressor.flush())
+        except sock_err:
+            pass
+
+    def acquire_session(self):
+        if super(StreamingTransport, self).acquire_session():
+            return True
+
+        self.finish_response()
+
+        return False
+
+    def finalize_request(self):
+        self.finish_response()
+
+    def do_open(self):
+        # written along with the prelude by the first flush
+        if self.session.new:
+            self.queue_frame(protocol.OPEN)
+
+    def produce_messages(self):
+        # the limit applies to the uncompressed text that the client buffers
+        bytes_to_write = self.response_limit + self.raw_length
+
+        while True:
             try:
-                self.write_message_frame(handler, messages)
+                # all the queued frames must reach the client before waiting
+                # for more messages
+                self.flush()
             except sock_err:
                 self.session.interrupt()
 
+                return
+
+            if self.raw_length >= bytes_to_write:
                 break
 
-    def process_request(self):
-        super(StreamingTransport, self).process_request()
+            if not self.session.opened:
+                break
+
+            messages = self.get_messages(timeout=self.timeout)
+
+            if messages:
+                self.queue_message_frame(messages)
 
         if self.session.closed:
-            self.write_close_frame(*protocol.CONN_CLOSED)
+            status = self.session.close_status or protocol.CONN_CLOSED
+
+            self.write_close_frame(*status)
 
 
 class XHRStreaming(StreamingTransport):
@@ -380,24 +809,20 @@ class XHRStreaming(StreamingTransport):
     prelude = 'h' * 2049
     content_type = "application/javascript"
 
-    def encode_frame(self, data):
-        return data + '\n'
-
-    def prep_response(self, handler):
-        super(XHRStreaming, self).prep_response(handler)
-
-        handler.start_response('200 OK')
+    frame_suffix = '\n'
 
-        handler.write(self.encode_frame(self.prelude))
+    def prepare_request(self):
+        self.start_response()
 
-    def do_open(self, handler):
-        handler.write(self.encode_frame(protocol.OPEN))
+        self.queue_frame(self.prelude)
 
 
 class HTMLFile(StreamingTransport):
     content_type = 'text/html'
     http_options = ['GET']
 
+    callback = None
+
     IFRAME_HTML = r"""
 <!doctype html>
 <html><head>
@@ -413,34 +838,25 @@ class HTMLFile(StreamingTransport):
   </script>
 """.strip()
 
-    def encode_frame(self, frame):
-        return '<script>\np("%s");\n</script>\r\n' % frame.replace('"', '\\"')
-
-    def do_open(self, handler):
-        open_frame = self.encode_frame(protocol.OPEN)
-        handler.write(open_frame)
-
-    def prep_response(self, handler):
-        super(HTMLFile, self).prep_response(handler)
-
-        # Start writing
-        handler.start_response("200 OK")
-
-        html = self.IFRAME_HTML % self.callback
-        html = html.rjust(1025)
+    frame_prefix = '<script>\np("'
+    frame_suffix = '");\n</script>\r\n'
 
-        handler.write(html)
+    escape = staticmethod(protocol.escape_js)
 
-    def __call__(self, handler, raw_request_data):
-        qs = urlparse.parse_qs(handler.environ.get("QUERY_STRING", ''))
+    def prepare_request(self):
+        qs = urlparse.parse_qs(self.environ.get('QUERY_STRING', ''))
         self.callback = qs.get('c', [None])[0]
 
         if not self.callback:
-            handler.do500(message='"callback" parameter required')
+            self.handler.internal_error('"callback" parameter required')
 
-            return
+            return False
 
-        super(HTMLFile, self).__call__(handler, raw_request_data)
+        self.start_response()
+
+        html = self.IFRAME_HTML % self.callback
+
+        self.frames.append(html.rjust(1025))
 
 
 class EventSource(StreamingTransport):
@@ -448,18 +864,13 @@ class EventSource(StreamingTransport):
 
     http_options = ['GET']
 
-    def encode_frame(self, data):
-        return "data: %s\r\n\r\n" % data
-
-    def do_open(self, handler):
-        handler.write(self.encode_frame(protocol.OPEN))
-
-    def prep_response(self, handler):
-        super(EventSource, self).prep_response(handler)
+    frame_prefix = 'data: '
+    frame_suffix = '\r\n\r\n'
 
-        handler.start_response("200 OK")
+    def prepare_request(self):
+        self.start_response()
 
-        handler.write('\r\n')
+        self.frames.append('\r\n')
 
 
 # Socket Transports
@@ -469,11 +880,6 @@ class EventSource(StreamingTransport):
 # Sending and receiving are split in two different threads.
 
 
-class WSHandler(WebSocketHandler):
-    def log_request(self):
-        pass
-
-
 class RawWebSocket(BaseTransport):
     readable = True
     writable = True
@@ -482,26 +888,79 @@ class RawWebSocket(BaseTransport):
 
     websocket = None
 
+    # the negotiated ``websocket.PerMessageDeflate`` state, if any
+    deflate = None
+    # whether single broadcast messages are compressed once and shared with
+    # the other sessions, see ``WebSocket.send_messages``
+    shared_frames = False
+
+    # the websocket subprotocols this transport supports, in order of
+    # preference
+    protocols = None
+
+    # the ``codec.Codec`` of the negotiated binary subprotocol, if any
+    binary_codec = None
+
     def send_messages(self, messages):
+        binary_codec = self.binary_codec
+
+        if binary_codec:
+            self.send_binary_messages(messages, binary_codec)
+
+            return
+
         for message in messages:
+            if isinstance(message, protocol.EncodedMessage):
+                message = message.message
+
             self.websocket.send(message)
 
+    def send_binary_messages(self, messages, binary_codec):
+        for message in messages:
+            if isinstance(message, protocol.EncodedMessage):
+                # a broadcast, encoded once for all the sessions that
+                # negotiated the same subprotocol
+                data = message.get_cached(
+                    binary_codec,
+                    lambda encoded: binary_codec.encode(encoded.message)
+                )
+            else:
+                data = binary_codec.encode(message)
+
+            self.websocket.send(data, binary=True)
+
     def dispatch_message(self, message):
+        binary_codec = self.binary_codec
+
+        if binary_codec:
+            if not isinstance(message, str):
+                self.close_websocket(websocket.CLOSE_UNSUPPORTED_DATA)
+
+                return
+
+            try:
+                message = binary_codec.decode(message)
+            except ValueError:
+                self.close_websocket(websocket.CLOSE_INVALID_DATA)
+
+                return
+
         self.session.dispatch(message)
 
     def poll(self):
         """
         Get messages from the session and send them down the socket.
         """
-        while self.session.open:
-            messages = self.session.get_messages(self.timeout)
+        while self.session.opened:
+            messages = self.get_messages(timeout=self.timeout)
 
             if not messages:
                 continue
 
             try:
-                self.send_messages(messages)
-            except WebSocketError:
+                with self.write_lock:
+                    self.send_messages(messages)
+            except websocket.WebSocketError:
                 return
 
     def recv_message(self):
@@ -511,7 +970,7 @@ class RawWebSocket(BaseTransport):
         while self.session.opened:
             try:
                 message = self.recv_message()
-            except WebSocketError:
+            except websocket.WebSocketError:
                 return
 
             if message is None:
@@ -519,7 +978,7 @@ class RawWebSocket(BaseTransport):
 
             self.dispatch_message(message)
 
-    def handle_websocket(self, handler):
+    def handle_websocket(self):
         threads = [
             gevent.spawn(self.poll),
             gevent.spawn(self.put),
@@ -532,100 +991,160 @@ class RawWebSocket(BaseTransport):
         if not ret.successful():
             raise ret.exception
 
-    def finalize_request(self, handler):
-        if self.session.opened:
-            self.session.close()
+    def make_websocket(self):
+        return websocket.WebSocket(self.handler.stream, deflate=self.deflate)
 
-        if self.websocket:
-            self.websocket.close()
+    def negotiate_deflate(self):
+        """
+        Return the permessage-deflate state the endpoint accepts for this
+        request or ``None``.
+        """
+        endpoint = self.endpoint
 
-    def handle_request(self, handler, raw_request_data):
-        self.websocket = None
+        if not endpoint:
+            return
 
-        ws_handler = WSHandler(
-            handler.socket,
-            handler.client_address,
-            handler.server,
-            handler.rfile
-        )
+        deflate = endpoint.negotiate_deflate(self.environ)
 
-        def app(environ, start_response):
-            del ws_handler.application
+        if deflate and endpoint.deflate_shared_frames:
+            self.shared_frames = deflate.cache_key is not None
 
-            handler.__dict__.update(ws_handler.__dict__)
+        return deflate
 
-            self.websocket = getattr(ws_handler, 'websocket', None)
+    def get_binary_codecs(self):
+        """
+        Return the binary codecs the endpoint offers as websocket
+        subprotocols, in order of preference.
+        """
+        endpoint = self.endpoint
 
-            if not self.websocket:
-                handler.bad_request('Can "Upgrade" only to "WebSocket".')
+        if not endpoint:
+            return []
 
-                return []
+        return endpoint.binary_protocols or []
 
-            try:
-                self.handle_websocket(handler)
-            except WebSocketError:
-                pass
+    def get_protocols(self, binary_codecs):
+        """
+        Return the websocket subprotocols to offer, in order of preference.
+        """
+        protocols = [binary_codec.name for binary_codec in binary_codecs]
 
-        # TODO find a better way to do this.
-        ws_handler.__dict__.update(handler.__dict__)
-        ws_handler.application = app
+        return protocols + list(self.protocols or [])
+
+    def prepare_request(self):
+        """
+        Upgrade the connection before the session is touched.
+        """
+        self.deflate = self.negotiate_deflate()
+        binary_codecs = self.get_binary_codecs()
+        headers = []
+
+        if self.deflate:
+            headers.append((
+                'Sec-WebSocket-Extensions',
+                self.deflate.get_response_header()
+            ))
 
         try:
-            ws_handler.run_application()
-        except (sock_err, WebSocketError):
+            subprotocol = websocket.handshake(
+                self.environ,
+                self.handler.stream.write,
+                self.get_protocols(binary_codecs),
+                headers
+            )
+        except websocket.HandshakeError, exc:
+            self.handler.bad_request(str(exc), headers=exc.headers)
+
+            return False
+
+        for binary_codec in binary_codecs:
+            if binary_codec.name == subprotocol:
+                self.binary_codec = binary_codec
+
+                break
+
+        # the connection can not be used for another http request
+        self.handler.close_connection = True
+
+        self.websocket = self.make_websocket()
+
+    def close_websocket(self, *args):
+        with self.write_lock:
+            self.websocket.close(*args)
+
+    def finalize_request(self):
+        if self.session.opened:
+            self.session.close()
+
+        if self.websocket:
+            self.close_websocket()
+
+    def handle_request(self):
+        try:
+            self.handle_websocket()
+        except (sock_err, websocket.WebSocketError):
             pass
 
-    def send_heartbeat(self):
-        self.websocket.send(self.encode_frame(protocol.HEARTBEAT))
+    def write_heartbeat(self):
+        # raw websockets carry the application messages and nothing else
+        pass
 
 
 class WebSocket(RawWebSocket):
-    def write_close_frame(self, handler, code, reason):
+    def get_binary_codecs(self):
+        # SockJS frames are always JSON text
+        return []
+
+    def write_close_frame(self, code, reason):
         if self.websocket:
             frame = protocol.close_frame(code, reason)
 
-            try:
-                self.websocket.send(self.encode_frame(frame))
-            except WebSocketError:
-                pass
+            with self.write_lock:
+                try:
+                    self.websocket.send(self.encode_frame(frame))
+                except (sock_err, websocket.WebSocketError):
+                    pass
 
-            self.websocket.close()
+                self.websocket.close()
 
             return
 
-        super(WebSocket, self).write_close_frame(handler, code, reason)
-
-    def recv_message(self):
-        while self.session.opened:
-            try:
-                return self.websocket.receive()
-            except WebSocketError, e:
-                # specifically have to check for a close frame
-                if 'frame_type=255' in str(e):
-                    return None
-
-                raise
-            except (TypeError, ValueError):
-                continue
-            except (socket.error, AttributeError):
-                return None
+        super(WebSocket, self).write_close_frame(code, reason)
 
     def send_messages(self, messages):
         if not messages:
             return
 
-        frame = self.encode_frame(protocol.message_frame(*messages))
+        if self.shared_frames and len(messages) == 1:
+            message = messages[0]
 
-        self.websocket.send(frame)
+            if isinstance(message, protocol.EncodedMessage):
+                # a broadcast, every session with the same deflate settings
+                # sends the same bytes
+                payload = message.get_cached(
+                    self.deflate.cache_key,
+                    self.compress_frame
+                )
+
+                self.websocket.send_compressed(payload)
+
+                return
+
+        self.websocket.send(''.join(self.message_frame_parts(messages)))
+
+    def compress_frame(self, message):
+        frame = ''.join(self.message_frame_parts([message]))
+
+        return self.deflate.compress(frame)
 
     def dispatch_message(self, message):
         if not message:
             return
 
         try:
-            messages = protocol.decode(message)
+            messages = protocol.decode(message, self.codec)
         except protocol.InvalidJSON:
-            self.websocket.close()
+            self.close_websocket()
 
             return
 
@@ -634,12 +1153,18 @@ class WebSocket(RawWebSocket):
 
         self.session.dispatch(*messages)
 
-    def handle_websocket(self, handler):
-        self.websocket.send(protocol.OPEN)
+    def write_heartbeat(self):
+        self.websocket.send(self.encode_frame(protocol.HEARTBEAT))
+
+    def handle_websocket(self):
+        with self.write_lock:
+            self.websocket.send(protocol.OPEN)
+
+        super(WebSocket, self).handle_websocket()
 
-        super(WebSocket, self).handle_websocket(handler)
+        status = self.session.close_status or protocol.CONN_CLOSED
 
-        self.write_close_frame(handler, *protocol.CONN_CLOSED)
+        self.write_close_frame(*status)
 
 
 transport_types = {
@@ -1,5 +1,6 @@
 import Cookie
 import datetime
+import re
 import sys
 import time
 import traceback
@@ -11,6 +12,12 @@ from . import protocol
 
 DEFAULT_DELTA = datetime.timedelta(days=365)
 
+CORS_CREDENTIALS_HEADER = ('Access-Control-Allow-Credentials', 'true')
+NO_CACHE_HEADER = (
+    'Cache-Control',
+    'no-store, no-cache, must-revalidate, max-age=0'
+)
+
 
 def enable_cors(environ, headers):
     """
@@ -30,10 +37,8 @@ def enable_cors(environ, headers):
     if request_headers:
         headers.append(('Access-Control-Allow-Headers', request_headers))
 
-    headers.extend([
-        ('Access-Control-Allow-Origin', origin),
-        ('Access-Control-Allow-Credentials', 'true')
-    ])
+    headers.append(('Access-Control-Allow-Origin', origin))
+    headers.append(CORS_CREDENTIALS_HEADER)
 
 
 def disable_cache(headers):
@@ -42,9 +47,7 @@ def disable_cache(headers):
 
     :param headers: List of HTTP headers.
     """
-    headers.append(
-        ('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0')
-    )
+    headers.append(NO_CACHE_HEADER)
 
 
 def enable_cache(headers, delta=None, now=datetime.datetime.utcnow):
@@ -67,53 +70,238 @@ def enable_cache(headers, delta=None, now=datetime.datetime.utcnow):
     ])
 
 
+class CachedHeaders(object):
+    """
+    Headers that only change with the time, e.g. ``Expires``. ``build`` is
+    called at most once every ``interval`` seconds and the result shared
+    between responses.
+    """
+
+    __slots__ = (
+        'build',
+        'interval',
+        'clock',
+        'headers',
+        'expires',
+    )
+
+    def __init__(self, build, interval=1.0, clock=time.time):
+        """
+        :param build: Called with no arguments, returns a list of headers.
+        """
+        self.build = build
+        self.interval = interval
+        self.clock = clock
+
+        self.headers = None
+        self.expires = 0
+
+    def get(self):
+        now = self.clock()
+
+        if self.headers is None or now >= self.expires:
+            self.headers = tuple(self.build())
+            self.expires = now + self.interval
+
+        return self.headers
+
+
+def make_cache_headers():
+    headers = []
+
+    enable_cache(headers)
+
+    return headers
+
+
+CACHE_HEADERS = CachedHeaders(make_cache_headers)
+
+
+SESSION_COOKIE = 'JSESSIONID'
+DEFAULT_SESSION_COOKIE = 'JSESSIONID=dummy; Path=/'
+
+# a cookie header made of plain ``name=value`` pairs, i.e. nothing that
+# ``Cookie.SimpleCookie`` would quote, unquote or treat as an attribute
+COOKIE_PAIR = r'[%(chars)s]+=[%(chars)s]*' % {
+    'chars': re.escape(Cookie._LegalChars),
+}
+SIMPLE_COOKIES_RE = re.compile(
+    r'\s*%s(\s*;\s*%s)*\s*;?\s*\Z' % (COOKIE_PAIR, COOKIE_PAIR)
+)
+COOKIE_ATTRIBUTES = frozenset(Cookie.Morsel._reserved)
+
+
+def get_session_cookie(header):
+    """
+    Return the ``Set-Cookie`` value that keeps the client's ``JSESSIONID``
+    (or sets a dummy one) for the request cookie header ``header``.
+
+    Plain headers are scanned directly, anything unusual (quoted values,
+    cookie attributes) is left to ``Cookie.SimpleCookie``. Either way the
+    result is the ``JSESSIONID`` morsel that ``SimpleCookie`` would output.
+    Unlike the original implementation, the other request cookies are not
+    echoed back and a header that ``SimpleCookie`` can not parse gets the
+    dummy cookie instead of an error.
+    """
+    if not header or SESSION_COOKIE not in header:
+        return DEFAULT_SESSION_COOKIE
+
+    if SIMPLE_COOKIES_RE.match(header):
+        value = None
+
+        for item in header.split(';'):
+            name, _, item_value = item.partition('=')
+            name = name.strip()
+
+            if not name:
+                continue
+
+            if name[0] == '$' or name.lower() in COOKIE_ATTRIBUTES:
+                break
+
+            if name == SESSION_COOKIE:
+                # the last one wins, as with SimpleCookie
+                value = item_value.strip()
+        else:
+            if value is None:
+                return DEFAULT_SESSION_COOKIE
+
+            return 'JSESSIONID=%s; Path=/' % (value,)
+
+    try:
+        cookies = Cookie.SimpleCookie(header)
+    except Cookie.CookieError:
+        return DEFAULT_SESSION_COOKIE
+
+    morsel = cookies.get(SESSION_COOKIE)
+
+    if not morsel:
+        return DEFAULT_SESSION_COOKIE
+
+    morsel['path'] = '/'
+
+    return morsel.OutputString()
+
+
 def enable_cookie(environ, headers):
     """
     Return a list of HTTP Headers that will ensure a sticky cookie that load
     balancers can use to ensure that the request goes to the same backend
     server.
     """
-    cookies = Cookie.SimpleCookie(environ.get('HTTP_COOKIE'))
+    headers.append(
+        ('Set-Cookie', get_session_cookie(environ.get('HTTP_COOKIE')))
+    )
 
-    c = cookies.get('JSESSIONID')
 
-    if not c:
-        cookies['JSESSIONID'] = 'dummy'
+def accepts_encoding(environ, coding):
+    """
+    Whether the ``Accept-Encoding`` request header allows ``coding``, e.g.
+    ``gzip``. A ``q`` value of 0 refuses the coding, an explicit entry for
+    ``coding`` takes precedence over ``*``.
+    """
+    header = environ.get('HTTP_ACCEPT_ENCODING', None)
 
-        c = cookies.get('JSESSIONID')
+    if not header:
+        return False
 
-    c['path'] = '/'
+    accepted = {}
 
-    headers.append(
-        ('Set-Cookie', cookies.output(header='').strip())
+    for item in header.split(','):
+        parts = item.split(';')
+        name = parts[0].strip().lower()
+        quality = 1.0
+
+        for param in parts[1:]:
+            key, _, value = param.partition('=')
+
+            if key.strip().lower() != 'q':
+                continue
+
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0
+
+        accepted[name] = quality > 0
+
+    return accepted.get(coding, accepted.get('*', False))
+
+
+class HeaderTemplate(object):
+    """
+    The headers for one combination of ``get_headers`` arguments. Everything
+    that does not depend on the request is worked out once, ``render`` only
+    fills in the CORS echo, the cache dates and the cookie.
+
+    :ivar prefix: The static headers that start every response.
+    """
+
+    __slots__ = (
+        'prefix',
+        'cors',
+        'cache',
+        'cookie',
     )
 
+    def __init__(self, content_type=None, cors=False, cache=None,
+                 cookie=False):
+        prefix = []
 
-def get_headers(environ, content_type=None, cors=False, cache=None,
-                cookie=False):
-    headers = []
+        if content_type:
+            if ';' not in content_type:
+                content_type += '; encoding=UTF-8'
 
-    if content_type:
-        if ';' not in content_type:
-            content_type += '; encoding=UTF-8'
+            prefix.append(('Content-Type', content_type))
 
-        headers.append(
-            ('Content-Type', content_type)
-        )
+        self.prefix = tuple(prefix)
+        self.cors = cors
+        self.cache = cache
+        self.cookie = cookie
+
+    def render(self, environ):
+        """
+        Return a new list of headers for the request in ``environ``.
+        """
+        headers = list(self.prefix)
 
-    if cors:
-        enable_cors(environ, headers)
+        if self.cors:
+            enable_cors(environ, headers)
+
+        cache = self.cache
 
-    if cache is not None:
         if cache:
-            enable_cache(headers)
-        else:
-            disable_cache(headers)
+            headers.extend(CACHE_HEADERS.get())
+        elif cache is not None:
+            headers.append(NO_CACHE_HEADER)
 
-    if cookie:
-        enable_cookie(environ, headers)
+        if self.cookie:
+            enable_cookie(environ, headers)
 
-    return headers
+        return headers
+
+
+# (content_type, cors, cache, cookie) -> HeaderTemplate
+header_templates = {}
+
+
+def get_header_template(content_type=None, cors=False, cache=None,
+                        cookie=False):
+    key = (content_type, cors, cache, cookie)
+
+    try:
+        return header_templates[key]
+    except KeyError:
+        template = header_templates[key] = HeaderTemplate(*key)
+
+        return template
+
+
+def get_headers(environ, content_type=None, cors=False, cache=None,
+                cookie=False):
+    template = get_header_template(content_type, cors, cache, cookie)
+
+    return template.render(environ)
 
 
 class BaseHandler(object):
@@ -0,0 +1,753 @@
+"""
+A minimal RFC 6455 WebSocket implementation that runs directly on the stream
+of a request (see ``handler.HandlerStream``).
+
+Only the server side of the protocol is implemented: client frames must be
+masked, server frames are never masked.
+"""
+
+import base64
+import binascii
+import hashlib
+import struct
+import zlib
+
+from gevent import lock
+
+try:
+    from wsaccel.xormask import XorMaskerSimple
+except ImportError:
+    XorMaskerSimple = None
+
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+SUPPORTED_VERSIONS = ('13', '8', '7')
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xa
+
+OPCODES = frozenset([
+    OPCODE_CONTINUATION,
+    OPCODE_TEXT,
+    OPCODE_BINARY,
+    OPCODE_CLOSE,
+    OPCODE_PING,
+    OPCODE_PONG,
+])
+
+FIN = 0x80
+RSV_BITS = 0x70
+RSV1 = 0x40
+OPCODE_BITS = 0x0f
+MASK = 0x80
+LENGTH_BITS = 0x7f
+
+# close status codes
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED_DATA = 1003
+CLOSE_INVALID_DATA = 1007
+CLOSE_TOO_LARGE = 1009
+
+# every deflate block flushed with Z_SYNC_FLUSH ends with these bytes, RFC 7692
+# has them stripped from the message
+DEFLATE_TAIL = '\x00\x00\xff\xff'
+
+
+class WebSocketError(Exception):
+    """
+    Base class for all WebSocket related errors.
+    """
+
+
+class HandshakeError(WebSocketError):
+    """
+    Raised when the upgrade request is not a valid WebSocket handshake.
+
+    :ivar headers: Extra headers to send with the ``400 Bad Request``
+        response.
+    """
+
+    def __init__(self, message, headers=None):
+        super(HandshakeError, self).__init__(message)
+
+        self.headers = headers or []
+
+
+class ProtocolError(WebSocketError):
+    """
+    Raised when the client violates the WebSocket protocol. The connection is
+    closed with ``code``.
+    """
+
+    def __init__(self, message, code=CLOSE_PROTOCOL_ERROR):
+        super(ProtocolError, self).__init__(message)
+
+        self.code = code
+
+
+class ConnectionClosed(WebSocketError):
+    """
+    Raised when the underlying connection has gone away.
+    """
+
+
+def get_accept_key(key):
+    """
+    Return the ``Sec-WebSocket-Accept`` value for a ``Sec-WebSocket-Key``.
+    """
+    return base64.b64encode(hashlib.sha1(key + GUID).digest())
+
+
+def get_header_tokens(environ, name):
+    """
+    Return the lowercased, comma separated tokens of a request header.
+    """
+    value = environ.get(name, '')
+
+    return [token.strip().lower() for token in value.split(',')]
+
+
+def mask_payload(mask, data):
+    """
+    XOR ``data`` with the 4 byte ``mask``. Masking and unmasking are the same
+    operation.
+    """
+    length = len(data)
+
+    if not length:
+        return data
+
+    if XorMaskerSimple:
+        return XorMaskerSimple(mask).process(data)
+
+    # xor the whole payload at once as one big integer, this is much faster
+    # than a byte at a time in pure python
+    repeats, extra = divmod(length, 4)
+    key = mask * repeats + mask[:extra]
+
+    value = long(binascii.hexlify(data), 16) ^ long(binascii.hexlify(key), 16)
+
+    return binascii.unhexlify('%0*x' % (length * 2, value))
+
+
+def parse_extensions(environ):
+    """
+    Parse the ``Sec-WebSocket-Extensions`` request header.
+
+    :returns: A list of ``(name, params)`` offers in the order they were sent.
+        ``params`` is a list of ``(name, value)`` pairs, value is ``None`` for
+        a parameter without one.
+    """
+    offers = []
+
+    for offer in environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS', '').split(','):
+        parts = offer.split(';')
+        name = parts[0].strip().lower()
+
+        if not name:
+            continue
+
+        params = []
+
+        for param in parts[1:]:
+            key, _, value = param.partition('=')
+            value = value.strip().strip('"')
+
+            params.append((key.strip().lower(), value or None))
+
+        offers.append((name, params))
+
+    return offers
+
+
+def get_window_bits(value):
+    """
+    Validate a ``*_max_window_bits`` extension parameter.
+    """
+    if not value or not value.isdigit() or not 8 <= int(value) <= 15:
+        raise ValueError('Invalid window bits %r' % (value,))
+
+    return int(value)
+
+
+class PerMessageDeflate(object):
+    """
+    The negotiated state of the permessage-deflate extension (RFC 7692).
+
+    :ivar server_max_window_bits: The LZ77 window used to compress messages.
+    :ivar client_max_window_bits: The LZ77 window the client compresses with.
+    :ivar server_no_context_takeover: Compress every message on its own. The
+        compressed form of a message then only depends on the message and
+        ``cache_key``, so it can be shared between connections.
+    :ivar client_no_context_takeover: The client compresses every message on
+        its own.
+    :ivar level: The zlib compression level.
+    :ivar response_params: The parameters to send back to the client.
+    """
+
+    __slots__ = (
+        'server_max_window_bits',
+        'client_max_window_bits',
+        'server_no_context_takeover',
+        'client_no_context_takeover',
+        'level',
+        'response_params',
+        'compressor',
+        'decompressor',
+    )
+
+    name = 'permessage-deflate'
+
+    # messages shorter than this are not worth compressing
+    min_size = 64
+
+    def __init__(self, server_max_window_bits=15, client_max_window_bits=15,
+                 server_no_context_takeover=False,
+                 client_no_context_takeover=False, level=6,
+                 response_params=None):
+        # zlib can not produce raw deflate streams with an 8 bit window
+        self.server_max_window_bits = max(server_max_window_bits, 9)
+        self.client_max_window_bits = client_max_window_bits
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.level = level
+        self.response_params = response_params or []
+
+        self.compressor = None
+        self.decompressor = None
+
+    @classmethod
+    def negotiate(cls, environ, max_window_bits=15, no_context_takeover=False,
+                  level=6):
+        """
+        Accept the first valid permessage-deflate offer in the request.
+
+        :param max_window_bits: The largest LZ77 window to use for either
+            direction. Smaller windows use less memory per connection.
+        :param no_context_takeover: Compress each message on its own even if
+            the client allows context takeover.
+        :returns: A ``PerMessageDeflate`` or ``None`` if no acceptable offer
+            was made.
+        """
+        for name, params in parse_extensions(environ):
+            if name != cls.name:
+                continue
+
+            try:
+                return cls.from_offer(
+                    params,
+                    max_window_bits=max_window_bits,
+                    no_context_takeover=no_context_takeover,
+                    level=level
+                )
+            except ValueError:
+                continue
+
+    @classmethod
+    def from_offer(cls, params, max_window_bits=15, no_context_takeover=False,
+                   level=6):
+        """
+        Build the extension state for a single offer.
+
+        :raises ValueError: The offer is invalid.
+        """
+        names = [name for name, value in params]
+
+        if len(set(names)) != len(names):
+            raise ValueError('Duplicate parameters')
+
+        server_bits = client_bits = max_window_bits
+        server_no_context = no_context_takeover
+        client_no_context = False
+        response = []
+
+        for name, value in params:
+            if name == 'server_no_context_takeover':
+                if value is not None:
+                    raise ValueError(name)
+
+                server_no_context = True
+            elif name == 'client_no_context_takeover':
+                if value is not None:
+                    raise ValueError(name)
+
+                # lets the decompressor be thrown away between messages
+                client_no_context = True
+                response.append((name, None))
+            elif name == 'server_max_window_bits':
+                requested = get_window_bits(value)
+
+                if requested < 9:
+                    # zlib can not compress with an 8 bit window and the
+                    # reply may not exceed the offer, so decline it
+                    raise ValueError('Unsupported window bits %r' % (value,))
+
+                server_bits = max(min(server_bits, requested), 9)
+                response.append((name, str(server_bits)))
+            elif name == 'client_max_window_bits':
+                if value is not None:
+                    client_bits = min(client_bits, get_window_bits(value))
+
+                if client_bits < 15:
+                    response.append((name, str(client_bits)))
+                else:
+                    client_bits = 15
+            else:
+                raise ValueError('Unknown parameter %r' % (name,))
+
+        if server_no_context:
+            response.insert(0, ('server_no_context_takeover', None))
+
+        if 'client_max_window_bits' not in names:
+            # the client did not agree to a smaller window
+            client_bits = 15
+
+        return cls(
+            server_max_window_bits=server_bits,
+            client_max_window_bits=client_bits,
+            server_no_context_takeover=server_no_context,
+            client_no_context_takeover=client_no_context,
+            level=level,
+            response_params=response
+        )
+
+    def get_response_header(self):
+        """
+        Return the ``Sec-WebSocket-Extensions`` response value.
+        """
+        parts = [self.name]
+
+        for name, value in self.response_params:
+            if value is None:
+                parts.append(name)
+            else:
+                parts.append('%s=%s' % (name, value))
+
+        return '; '.join(parts)
+
+    @property
+    def cache_key(self):
+        """
+        Connections with the same ``cache_key`` produce identical compressed
+        messages. ``None`` if messages depend on the connection history.
+        """
+        if not self.server_no_context_takeover:
+            return None
+
+        return (self.name, self.server_max_window_bits, self.level)
+
+    def compress(self, data):
+        """
+        Return the compressed payload of a message.
+        """
+        compressor = self.compressor
+
+        if not compressor:
+            compressor = zlib.compressobj(
+                self.level,
+                zlib.DEFLATED,
+                -self.server_max_window_bits
+            )
+
+            if not self.server_no_context_takeover:
+                self.compressor = compressor
+
+        data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        if data.endswith(DEFLATE_TAIL):
+            data = data[:-4]
+
+        return data
+
+    def decompress(self, data, max_size):
+        """
+        Return the original message of a compressed payload.
+
+        :raises ProtocolError: The message is invalid or bigger than
+            ``max_size``.
+        """
+        decompressor = self.decompressor
+
+        if not decompressor:
+            decompressor = zlib.decompressobj(-self.client_max_window_bits)
+
+            if not self.client_no_context_takeover:
+                self.decompressor = decompressor
+
+        try:
+            data = decompressor.decompress(data + DEFLATE_TAIL, max_size + 1)
+        except zlib.error:
+            raise ProtocolError(
+                'Invalid compressed message',
+                CLOSE_INVALID_DATA
+            )
+
+        if len(data) > max_size or decompressor.unconsumed_tail:
+            raise ProtocolError('Message too large', CLOSE_TOO_LARGE)
+
+        return data
+
+
+def make_header(length, opcode, fin=True, rsv=0):
+    """
+    Return the header of an unmasked frame with a payload of ``length`` bytes.
+    """
+    first = opcode | rsv
+
+    if fin:
+        first |= FIN
+
+    if length < 126:
+        return struct.pack('!BB', first, length)
+
+    if length < 0x10000:
+        return struct.pack('!BBH', first, 126, length)
+
+    return struct.pack('!BBQ', first, 127, length)
+
+
+def handshake(environ, write, protocols=None, headers=None):
+    """
+    Validate the upgrade request in ``environ`` and write the ``101 Switching
+    Protocols`` response.
+
+    :param write: Callable that writes bytes to the client.
+    :param protocols: The subprotocols supported by the server in order of
+        preference.
+    :param headers: Extra response headers, e.g. the accepted extensions.
+    :returns: The negotiated subprotocol, or ``None``.
+    :raises HandshakeError: The request is not a valid WebSocket handshake.
+    """
+    if 'websocket' not in get_header_tokens(environ, 'HTTP_UPGRADE'):
+        raise HandshakeError('Can "Upgrade" only to "WebSocket".')
+
+    if 'upgrade' not in get_header_tokens(environ, 'HTTP_CONNECTION'):
+        raise HandshakeError('"Connection" must be "Upgrade".')
+
+    version = environ.get('HTTP_SEC_WEBSOCKET_VERSION', '').strip()
+
+    if version not in SUPPORTED_VERSIONS:
+        raise HandshakeError('Unsupported WebSocket version.', headers=[
+            ('Sec-WebSocket-Version', SUPPORTED_VERSIONS[0])
+        ])
+
+    key = environ.get('HTTP_SEC_WEBSOCKET_KEY', '').strip()
+
+    try:
+        valid_key = len(base64.b64decode(key)) == 16
+    except TypeError:
+        valid_key = False
+
+    if not valid_key:
+        raise HandshakeError('Invalid Sec-WebSocket-Key.')
+
+    headers = [
+        ('Upgrade', 'websocket'),
+        ('Connection', 'Upgrade'),
+        ('Sec-WebSocket-Accept', get_accept_key(key)),
+    ] + (headers or [])
+
+    protocol = None
+
+    if protocols:
+        requested = get_header_tokens(environ, 'HTTP_SEC_WEBSOCKET_PROTOCOL')
+
+        for protocol in protocols:
+            if protocol in requested:
+                headers.append(('Sec-WebSocket-Protocol', protocol))
+
+                break
+        else:
+            protocol = None
+
+    response = ['HTTP/1.1 101 Switching Protocols\r\n']
+
+    for name, value in headers:
+        response.append('%s: %s\r\n' % (name, value))
+
+    response.append('\r\n')
+
+    write(''.join(response))
+
+    return protocol
+
+
+class WebSocket(object):
+    """
+    A server side WebSocket connection.
+
+    :ivar read: Callable that blocks until exactly ``n`` bytes have been read
+        from the client or the connection is closed.
+    :ivar write: Callable that writes bytes to the client.
+    :ivar closed: Whether a close frame has been sent or received.
+    :ivar close_code: The status code of the close frame from the client.
+    :ivar buffer: A reusable buffer that fragmented messages are assembled
+        in.
+    :ivar deflate: The negotiated ``PerMessageDeflate`` state or ``None``.
+    :ivar write_lock: Held while a frame is written, so that a control frame
+        sent by the reading greenlet can not land inside a data frame.
+    """
+
+    __slots__ = (
+        'read',
+        'write',
+        'closed',
+        'close_code',
+        'buffer',
+        'deflate',
+        'write_lock',
+    )
+
+    # the largest message that will be accepted from the client
+    max_message_size = 16 * 1024 * 1024
+
+    # payloads larger than this are written separately from their header
+    # rather than being copied into a single string
+    copy_threshold = 16 * 1024
+
+    def __init__(self, stream, deflate=None):
+        """
+        :param stream: A file like object with ``read`` and ``write``.
+        :param deflate: A negotiated ``PerMessageDeflate``.
+        """
+        self.read = stream.read
+        self.write = stream.write
+
+        self.closed = False
+        self.close_code = None
+        self.buffer = bytearray()
+        self.deflate = deflate
+        self.write_lock = lock.Semaphore()
+
+    def read_exact(self, size):
+        data = self.read(size)
+
+        if len(data) != size:
+            self.closed = True
+
+            raise ConnectionClosed('Connection closed by the client')
+
+        return data
+
+    def read_frame(self):
+        """
+        Read a single frame from the client.
+
+        :returns: A tuple of ``(fin, opcode, rsv, payload)``.
+        """
+        first, second = struct.unpack('!BB', self.read_exact(2))
+
+        fin = bool(first & FIN)
+        rsv = first & RSV_BITS
+        opcode = first & OPCODE_BITS
+        length = second & LENGTH_BITS
+
+        if opcode not in OPCODES:
+            raise ProtocolError('Unknown opcode %d' % (opcode,))
+
+        if not second & MASK:
+            raise ProtocolError('Client frames must be masked')
+
+        if opcode & 0x8 and (not fin or length > 125):
+            raise ProtocolError('Invalid control frame')
+
+        if length == 126:
+            length, = struct.unpack('!H', self.read_exact(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', self.read_exact(8))
+
+        if length > self.max_message_size:
+            raise ProtocolError('Frame too large', CLOSE_TOO_LARGE)
+
+        mask = self.read_exact(4)
+        payload = mask_payload(mask, self.read_exact(length))
+
+        return fin, opcode, rsv, payload
+
+    def check_rsv(self, rsv, opcode):
+        """
+        Validate the reserved bits of the first frame of a message. Only RSV1
+        is valid, and only once permessage-deflate has been negotiated.
+        """
+        if not rsv:
+            return
+
+        if rsv != RSV1 or not self.deflate:
+            raise ProtocolError('Reserved bits set')
+
+    def decode_message(self, opcode, rsv, payload):
+        """
+        Return the message for a complete payload.
+        """
+        if rsv & RSV1:
+            payload = self.deflate.decompress(payload, self.max_message_size)
+
+        if opcode == OPCODE_TEXT:
+            try:
+                return payload.decode('utf-8')
+            except UnicodeDecodeError:
+                raise ProtocolError('Invalid UTF-8', CLOSE_INVALID_DATA)
+
+        return payload
+
+    def receive(self):
+        """
+        Read the next message from the client. Control frames are handled
+        transparently.
+
+        :returns: A ``unicode`` text message, a ``str`` binary message or
+            ``None`` if the connection has been closed.
+        """
+        if self.closed:
+            return None
+
+        buf = self.buffer
+        opcode = None
+        message_rsv = 0
+
+        try:
+            while True:
+                fin, frame_opcode, rsv, payload = self.read_frame()
+
+                if frame_opcode & 0x8:
+                    if rsv:
+                        raise ProtocolError('Reserved bits set')
+
+                    if frame_opcode == OPCODE_CLOSE:
+                        self.handle_close(payload)
+
+                        return None
+
+                    if frame_opcode == OPCODE_PING:
+                        self.send_frame(payload, OPCODE_PONG)
+
+                    continue
+
+                if frame_opcode == OPCODE_CONTINUATION:
+                    if opcode is None:
+                        raise ProtocolError('Unexpected continuation frame')
+
+                    if rsv:
+                        raise ProtocolError('Reserved bits set')
+                else:
+                    if opcode is not None:
+                        raise ProtocolError('Expected a continuation frame')
+
+                    self.check_rsv(rsv, frame_opcode)
+
+                    opcode = frame_opcode
+                    message_rsv = rsv
+
+                if fin and not buf:
+                    # the common case, a message in a single frame
+                    return self.decode_message(opcode, message_rsv, payload)
+
+                buf.extend(payload)
+
+                if len(buf) > self.max_message_size:
+                    raise ProtocolError('Message too large', CLOSE_TOO_LARGE)
+
+                if fin:
+                    payload = str(buf)
+                    del buf[:]
+
+                    return self.decode_message(opcode, message_rsv, payload)
+        except ProtocolError, exc:
+            del buf[:]
+            self.close(exc.code, str(exc))
+
+            raise
+
+    def handle_close(self, payload):
+        code = CLOSE_NORMAL
+
+        if len(payload) >= 2:
+            code, = struct.unpack('!H', payload[:2])
+
+        self.close_code = code
+
+        # echo the close frame back to the client
+        self.close(code)
+
+    def write_frame(self, payload, opcode, rsv=0):
+        """
+        Write a single unfragmented frame. The caller must hold
+        ``write_lock``.
+        """
+        header = make_header(len(payload), opcode, rsv=rsv)
+
+        if len(payload) > self.copy_threshold:
+            self.write(header)
+            self.write(payload)
+        else:
+            self.write(header + payload)
+
+    def send_frame(self, payload, opcode, rsv=0):
+        """
+        Write a single unfragmented frame.
+        """
+        with self.write_lock:
+            if self.closed:
+                raise WebSocketError('The WebSocket has been closed')
+
+            self.write_frame(payload, opcode, rsv)
+
+    def send(self, message, binary=None):
+        """
+        Send a message to the client. ``unicode`` messages are encoded as
+        UTF-8 text frames, ``str`` messages are sent as text frames unless
+        ``binary`` is set.
+        """
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+
+        if binary:
+            opcode = OPCODE_BINARY
+        else:
+            opcode = OPCODE_TEXT
+
+        deflate = self.deflate
+
+        if deflate and len(message) >= deflate.min_size:
+            self.send_frame(deflate.compress(message), opcode, rsv=RSV1)
+        else:
+            self.send_frame(message, opcode)
+
+    def send_compressed(self, payload, binary=False):
+        """
+        Send a message that has already been compressed with
+        ``deflate.compress``, e.g. one shared between connections.
+        """
+        if binary:
+            opcode = OPCODE_BINARY
+        else:
+            opcode = OPCODE_TEXT
+
+        self.send_frame(payload, opcode, rsv=RSV1)
+
+    def close(self, code=CLOSE_NORMAL, reason=''):
+        """
+        Send a close frame to the client. Safe to call more than once.
+        """
+        if isinstance(reason, unicode):
+            reason = reason.encode('utf-8')
+
+        with self.write_lock:
+            if self.closed:
+                return
+
+            try:
+                payload = struct.pack('!H', code) + reason[:123]
+
+                self.write_frame(payload, OPCODE_CLOSE)
+            except Exception:
+                pass
+            finally:
+                self.closed = True
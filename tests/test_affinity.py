@@ -0,0 +1,289 @@
+"""
+Tests for ``sockjs_gevent.affinity``
+"""
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import shutil
+import tempfile
+from StringIO import StringIO
+
+import mock
+
+from sockjs_gevent import affinity
+
+
+class AffinityTestCase(unittest.TestCase):
+    """
+    Tests for ``affinity.Affinity``
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_affinity(self, worker_id=0, num_workers=4):
+        return affinity.Affinity(
+            self.path,
+            worker_id,
+            num_workers,
+            secret='s3cret'
+        )
+
+    def make_handler(self, headers):
+        handler = mock.Mock()
+        handler.requestline = 'POST /echo/001/abc/xhr_send HTTP/1.1'
+        handler.headers = mock.Mock(headers=headers)
+
+        return handler
+
+    def test_numeric_owner(self):
+        """
+        Numeric server ids are spread across the workers by value.
+        """
+        aff = self.make_affinity()
+
+        self.assertEqual(aff.get_owner('000'), 0)
+        self.assertEqual(aff.get_owner('001'), 1)
+        self.assertEqual(aff.get_owner('007'), 3)
+        self.assertEqual(aff.get_owner('999'), 3)
+
+    def test_string_owner(self):
+        """
+        Any other server id must map to the same worker in every process.
+        """
+        first = self.make_affinity(0)
+        second = self.make_affinity(1)
+
+        for server_id in ['foo', 'bar', 'a1']:
+            owner = first.get_owner(server_id)
+
+            self.assertTrue(0 <= owner < 4)
+            self.assertEqual(owner, second.get_owner(server_id))
+
+    def test_claim(self):
+        """
+        Claimed prefixes take precedence, longest prefix first.
+        """
+        aff = self.make_affinity(worker_id=2)
+
+        aff.claim('1')
+        aff.claim('12', 3)
+
+        self.assertEqual(aff.get_owner('100'), 2)
+        self.assertEqual(aff.get_owner('123'), 3)
+        self.assertEqual(aff.get_owner('000'), 0)
+
+    def test_is_local(self):
+        aff = self.make_affinity(worker_id=1)
+
+        self.assertTrue(aff.is_local('001', {}))
+        self.assertFalse(aff.is_local('002', {}))
+
+    def test_is_local_proxied(self):
+        """
+        A request that has already been proxied must never be proxied again.
+        """
+        aff = self.make_affinity(worker_id=1)
+
+        self.assertTrue(aff.is_local('002', {
+            'HTTP_X_SOCKJS_AFFINITY': 's3cret'
+        }))
+
+    def test_is_local_forged(self):
+        """
+        A client can not skip the routing by setting the header itself.
+        """
+        aff = self.make_affinity(worker_id=1)
+
+        self.assertFalse(aff.is_local('002', {
+            'HTTP_X_SOCKJS_AFFINITY': '2'
+        }))
+
+    def test_shared_secret(self):
+        """
+        Each affinity gets a random secret unless one is shared.
+        """
+        first = affinity.Affinity(self.path, 0, 2)
+        second = affinity.Affinity(self.path, 1, 2)
+
+        self.assertTrue(first.secret)
+        self.assertNotEqual(first.secret, second.secret)
+
+    def test_single_worker(self):
+        aff = self.make_affinity(num_workers=1)
+
+        self.assertTrue(aff.is_local('foo', {}))
+
+    def test_build_request(self):
+        """
+        Hop by hop headers are replaced and the loop guard added.
+        """
+        aff = self.make_affinity(worker_id=2)
+        handler = self.make_handler([
+            'Host: localhost\r\n',
+            'Connection: keep-alive\r\n',
+            'Content-Length: 7\r\n',
+            'X-Foo: bar\r\n',
+            ' baz\r\n',
+            'X-SockJS-Affinity: 3\r\n',
+        ])
+
+        request = aff.build_request(handler, {
+            'REMOTE_ADDR': '10.0.0.1'
+        }, 7)
+
+        self.assertEqual(request, '\r\n'.join([
+            'POST /echo/001/abc/xhr_send HTTP/1.0',
+            'Host: localhost',
+            'X-Foo: bar',
+            ' baz',
+            'Connection: close',
+            'Content-Length: 7',
+            'X-SockJS-Affinity: s3cret',
+            'X-Forwarded-For: 10.0.0.1',
+            '',
+            ''
+        ]))
+
+    def test_build_upgrade_request(self):
+        aff = self.make_affinity(worker_id=2)
+        handler = self.make_handler([
+            'Upgrade: websocket\r\n',
+            'Connection: Upgrade\r\n',
+        ])
+
+        request = aff.build_request(handler, {
+            'HTTP_UPGRADE': 'websocket',
+        })
+
+        self.assertEqual(request, '\r\n'.join([
+            'POST /echo/001/abc/xhr_send HTTP/1.1',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'X-SockJS-Affinity: s3cret',
+            '',
+            ''
+        ]))
+
+    def test_proxy_unavailable(self):
+        """
+        A missing sibling must result in a 503 response.
+        """
+        aff = self.make_affinity(worker_id=0)
+        handler = mock.Mock()
+
+        aff.proxy(handler, {'wsgi.input': StringIO('')}, '001')
+
+        handler.write_response.assert_called_with(
+            'Worker 1 is unavailable',
+            status='503 Service Unavailable',
+            content_type='text/plain'
+        )
+
+    def test_proxy_too_large(self):
+        """
+        A body over the limit of the endpoint is rejected before it is read.
+        """
+        aff = self.make_affinity(worker_id=0)
+        handler = mock.Mock()
+        body = mock.Mock()
+
+        aff.proxy(handler, {
+            'CONTENT_LENGTH': '11',
+            'wsgi.input': body,
+        }, '001', 10)
+
+        handler.write_response.assert_called_with(
+            'Payload larger than 10 bytes',
+            status='413 Request Entity Too Large',
+            content_type='text/plain'
+        )
+        self.assertFalse(body.read.called)
+
+    def test_proxy_chunked_too_large(self):
+        """
+        A body of an unknown length is read no further than the limit.
+        """
+        aff = self.make_affinity(worker_id=0)
+        handler = mock.Mock()
+        body = StringIO('x' * 100)
+
+        aff.proxy(handler, {'wsgi.input': body}, '001', 10)
+
+        handler.write_response.assert_called_with(
+            'Payload larger than 10 bytes',
+            status='413 Request Entity Too Large',
+            content_type='text/plain'
+        )
+        self.assertEqual(body.tell(), 11)
+
+    def test_parse_response_head(self):
+        """
+        Hop by hop headers are left to the handler of the client.
+        """
+        aff = self.make_affinity()
+
+        self.assertEqual(aff.parse_response_head('\r\n'.join([
+            'HTTP/1.0 200 OK',
+            'Content-Type: text/plain',
+            'Connection: close',
+            'Content-Length: 3',
+        ])), ('200 OK', [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', '3'),
+        ]))
+
+    def test_pipe_response(self):
+        """
+        The response of the owner goes through ``start_response``.
+        """
+        aff = self.make_affinity()
+        handler = mock.Mock()
+        upstream = mock.Mock()
+        upstream.recv.side_effect = [
+            'HTTP/1.0 200 OK\r\nConnection: close\r\n',
+            '\r\nfo',
+            'o',
+            '',
+        ]
+
+        aff.pipe_response(handler, upstream)
+
+        handler.start_response.assert_called_with('200 OK', [])
+
+        writer = handler.start_response.return_value
+
+        self.assertEqual(writer.call_args_list, [
+            mock.call('fo'),
+            mock.call('o'),
+        ])
+
+    def test_pipe_invalid_response(self):
+        aff = self.make_affinity()
+        handler = mock.Mock()
+        upstream = mock.Mock()
+        upstream.recv.side_effect = ['garbage', '']
+
+        aff.pipe_response(handler, upstream)
+
+        handler.write_response.assert_called_with(
+            'Invalid response from the owning worker',
+            status='502 Bad Gateway',
+            content_type='text/plain'
+        )
+        self.assertFalse(handler.start_response.called)
+
+    def test_pipe(self):
+        aff = self.make_affinity()
+        chunks = ['foo', 'bar', '']
+        written = []
+
+        aff.pipe(lambda size: chunks.pop(0), written.append)
+
+        self.assertEqual(written, ['foo', 'bar'])
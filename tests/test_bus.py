@@ -0,0 +1,142 @@
+"""
+Tests for ``sockjs_gevent.bus``
+"""
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import errno
+import shutil
+import tempfile
+
+import gevent
+from gevent import socket
+import mock
+
+from sockjs_gevent import bus
+
+
+class BusTestCase(unittest.TestCase):
+    """
+    Tests for ``bus.Bus``
+    """
+
+    def test_packet(self):
+        """
+        Packets must survive a round trip untouched.
+        """
+        b = bus.Bus()
+        data = '{"foo":"bar\\nbaz"}'
+
+        packet = b.encode_packet('echo', None, data)
+
+        self.assertEqual(b.decode_packet(packet), ('echo', None, data))
+
+    def test_receive(self):
+        """
+        Received messages must be handed to the bound application.
+        """
+        app = mock.Mock()
+        b = bus.Bus()
+
+        b.receive('echo', 'spam', '"foo"')
+
+        b.bind(app)
+        b.receive('echo', 'spam', '"foo"')
+
+        app.receive_from_bus.assert_called_once_with('echo', 'spam', '"foo"')
+
+
+class UnixSocketBusTestCase(unittest.TestCase):
+    """
+    Tests for ``bus.UnixSocketBus``
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.buses = []
+
+    def tearDown(self):
+        for b in self.buses:
+            b.stop()
+
+        shutil.rmtree(self.path)
+
+    def make_bus(self, name):
+        b = bus.UnixSocketBus(self.path, name)
+        b.bind(mock.Mock())
+        b.start()
+
+        self.buses.append(b)
+
+        return b
+
+    def test_publish(self):
+        """
+        A published message must reach every sibling but not the sender.
+        """
+        foo = self.make_bus('foo')
+        bar = self.make_bus('bar')
+        baz = self.make_bus('baz')
+
+        foo.publish('echo', None, '[1,2]')
+
+        gevent.sleep(0.1)
+
+        self.assertFalse(foo.app.receive_from_bus.called)
+        bar.app.receive_from_bus.assert_called_with('echo', None, '[1,2]')
+        baz.app.receive_from_bus.assert_called_with('echo', None, '[1,2]')
+
+    def test_receive_errors(self):
+        """
+        A failed read, an invalid packet or a failed delivery must not stop
+        the bus from receiving.
+        """
+        foo = bus.UnixSocketBus(self.path, 'foo')
+        foo.bind(mock.Mock())
+        foo.app.receive_from_bus.side_effect = [RuntimeError('boom'), None]
+
+        packet = foo.encode_packet('echo', None, '[1,2]')
+
+        foo.socket = mock.Mock()
+        foo.socket.recv.side_effect = [
+            socket.error(errno.EINTR, 'Interrupted'),
+            'garbage',
+            packet,
+            packet,
+            socket.error(errno.EBADF, 'Bad file descriptor'),
+        ]
+
+        with mock.patch.object(bus, 'logger') as logger:
+            foo._recv_packets()
+
+        self.assertEqual(foo.app.receive_from_bus.call_count, 2)
+        self.assertEqual(logger.exception.call_count, 2)
+        self.assertEqual(logger.warning.call_count, 1)
+
+    def test_publish_too_large(self):
+        """
+        Messages that do not fit in a datagram must be rejected.
+        """
+        foo = self.make_bus('foo')
+
+        self.assertRaises(
+            bus.BusError,
+            foo.publish, 'echo', None, 'x' * foo.max_size
+        )
+
+    def test_stop(self):
+        """
+        Stopping a bus must remove its socket.
+        """
+        import os
+
+        foo = self.make_bus('foo')
+
+        self.assertTrue(os.path.exists(foo.address))
+
+        foo.stop()
+
+        self.assertFalse(os.path.exists(foo.address))
@@ -0,0 +1,130 @@
+"""
+Tests for ``sockjs_gevent.channel``
+"""
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from sockjs_gevent import channel, protocol
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.messages = []
+
+    def offer_messages(self, *msgs):
+        self.messages.extend(msgs)
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.session = FakeSession()
+
+
+class RegistryTestCase(unittest.TestCase):
+    """
+    Tests for ``channel.Registry``
+    """
+
+    def make_registry(self):
+        return channel.Registry()
+
+    def test_subscribe(self):
+        """
+        Subscribing must create the channel and record the subscription.
+        """
+        registry = self.make_registry()
+        conn = FakeConnection()
+
+        registry.subscribe(conn, 'foo')
+        registry.subscribe(conn, 'bar')
+        registry.subscribe(conn, 'foo')
+
+        self.assertIn('foo', registry)
+        self.assertEqual(registry.get_channel('foo').subscribers, set([conn]))
+        self.assertEqual(registry.get_subscriptions(conn), set(['foo', 'bar']))
+
+    def test_unsubscribe(self):
+        """
+        The last unsubscribe must discard the channel.
+        """
+        registry = self.make_registry()
+        foo = FakeConnection()
+        bar = FakeConnection()
+
+        registry.subscribe(foo, 'spam')
+        registry.subscribe(bar, 'spam')
+
+        registry.unsubscribe(foo, 'spam')
+
+        self.assertEqual(registry.get_channel('spam').subscribers, set([bar]))
+        self.assertEqual(registry.get_subscriptions(foo), set())
+
+        registry.unsubscribe(bar, 'spam')
+
+        self.assertNotIn('spam', registry)
+        self.assertEqual(registry.subscriptions, {})
+
+        # unknown subscriptions are a noop
+        registry.unsubscribe(bar, 'spam')
+        registry.unsubscribe(bar)
+
+    def test_unsubscribe_all(self):
+        """
+        Unsubscribing without a name must remove all subscriptions.
+        """
+        registry = self.make_registry()
+        conn = FakeConnection()
+
+        registry.subscribe(conn, 'foo')
+        registry.subscribe(conn, 'bar')
+
+        registry.unsubscribe(conn)
+
+        self.assertEqual(registry.channels, {})
+        self.assertEqual(registry.subscriptions, {})
+
+    def test_publish(self):
+        """
+        Publishing must queue a single encoded message on every subscriber.
+        """
+        registry = self.make_registry()
+        foo = FakeConnection()
+        bar = FakeConnection()
+        closed = FakeConnection()
+        closed.session = None
+
+        for conn in (foo, bar, closed):
+            registry.subscribe(conn, 'spam')
+
+        self.assertEqual(registry.publish('spam', {'eggs': 1}), 2)
+        self.assertEqual(registry.publish('missing', 'foo'), 0)
+
+        encoded, = foo.session.messages
+
+        self.assertIsInstance(encoded, protocol.EncodedMessage)
+        self.assertEqual(encoded.message, {'eggs': 1})
+        self.assertIs(bar.session.messages[0], encoded)
+
+        self.assertEqual(registry.get_stats(), {
+            'spam': {
+                'subscribers': 3,
+                'published': 1,
+                'delivered': 2,
+            }
+        })
+
+    def test_publish_encoded(self):
+        """
+        An already encoded message must not be encoded again.
+        """
+        registry = self.make_registry()
+        conn = FakeConnection()
+        encoded = protocol.EncodedMessage('foo')
+
+        registry.subscribe(conn, 'spam')
+        registry.publish('spam', encoded)
+
+        self.assertIs(conn.session.messages[0], encoded)
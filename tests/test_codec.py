@@ -0,0 +1,210 @@
+"""
+Tests for ``sockjs_gevent.codec``
+"""
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import json
+
+import mock
+
+from sockjs_gevent import codec, protocol
+
+
+def make_upper_codec():
+    """
+    A user codec that upper cases all strings it decodes.
+    """
+    def decode(data):
+        return json.loads(data.upper())
+
+    return codec.Codec('upper', json.dumps, decode)
+
+
+class RegistryTestCase(unittest.TestCase):
+    """
+    Tests for the codec registry.
+    """
+
+    def test_builtins(self):
+        self.assertIn('json', codec.registry)
+        self.assertIn(codec.default, codec.registry.values())
+
+    def test_get_codec(self):
+        upper = make_upper_codec()
+
+        self.assertIs(codec.get_codec('json'), codec.registry['json'])
+        self.assertIs(codec.get_codec(upper), upper)
+        self.assertRaises(ValueError, codec.get_codec, 'foo')
+
+    def test_register(self):
+        upper = make_upper_codec()
+
+        with mock.patch.dict(codec.registry):
+            codec.register(upper)
+
+            self.assertIs(codec.get_codec('upper'), upper)
+
+        self.assertNotIn('upper', codec.registry)
+
+    def test_set_default(self):
+        upper = make_upper_codec()
+
+        with mock.patch.object(codec, 'default', codec.default):
+            codec.set_default(upper)
+
+            self.assertEqual(protocol.decode('["foo"]'), [u'FOO'])
+
+        self.assertEqual(protocol.decode('["foo"]'), [u'foo'])
+
+
+class BinaryRegistryTestCase(unittest.TestCase):
+    """
+    Tests for the binary codec registry.
+    """
+
+    def test_register_binary(self):
+        binary = codec.Codec('binary', str, str)
+
+        with mock.patch.dict(codec.binary_registry):
+            codec.register_binary(binary)
+
+            self.assertIs(codec.get_binary_codec('binary'), binary)
+
+        self.assertNotIn('binary', codec.binary_registry)
+        self.assertNotIn('binary', codec.registry)
+        self.assertIs(codec.get_binary_codec(binary), binary)
+        self.assertRaises(ValueError, codec.get_binary_codec, 'binary')
+
+    def test_json_is_not_binary(self):
+        self.assertRaises(ValueError, codec.get_binary_codec, 'json')
+
+    def test_strict_decoder(self):
+        """
+        Any error raised by the wrapped decoder becomes a ``ValueError``.
+        """
+        def loads(data):
+            raise KeyError(data)
+
+        decode = codec.strict_decoder(loads)
+
+        self.assertRaises(ValueError, decode, 'foo')
+        self.assertEqual(codec.strict_decoder(json.loads)('[1]'), [1])
+
+    def test_builtins_round_trip(self):
+        for binary in codec.binary_registry.values():
+            message = [u'caf\xe9', 1, {u'foo': None}]
+
+            data = binary.encode(message)
+
+            self.assertIsInstance(data, str)
+            self.assertEqual(binary.decode(data), message)
+            self.assertRaises(ValueError, binary.decode, '\xc1')
+
+    def test_builtins_text(self):
+        """
+        A ``str`` reaches the client as text, as it does over JSON.
+        """
+        for binary in codec.binary_registry.values():
+            message = binary.decode(binary.encode(['foo', {'bar': 'baz'}]))
+
+            self.assertEqual(message, [u'foo', {u'bar': u'baz'}])
+            self.assertIsInstance(message[0], unicode)
+            self.assertIsInstance(message[1].keys()[0], unicode)
+            self.assertIsInstance(message[1].values()[0], unicode)
+
+    def test_decode_strings(self):
+        message = codec.decode_strings([
+            'caf\xc3\xa9',
+            ('foo',),
+            {'bar': ['baz', 1, None]},
+        ])
+
+        self.assertEqual(message, [
+            u'caf\xe9',
+            [u'foo'],
+            {u'bar': [u'baz', 1, None]},
+        ])
+        self.assertIsInstance(message[1][0], unicode)
+        self.assertIsInstance(message[2].keys()[0], unicode)
+        self.assertIsInstance(message[2][u'bar'][0], unicode)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """
+    Tests for ``codec.benchmark`` and friends.
+    """
+
+    def test_is_correct(self):
+        self.assertTrue(codec.is_correct(codec.registry['json']))
+        self.assertFalse(codec.is_correct(make_upper_codec()))
+
+    def test_unicode_output(self):
+        """
+        Codecs must produce ``str``.
+        """
+        lossy = codec.Codec(
+            'lossy',
+            lambda obj: unicode(json.dumps(obj)),
+            json.loads
+        )
+
+        self.assertFalse(codec.is_correct(lossy))
+
+    def test_benchmark(self):
+        stdlib = codec.registry['json']
+        results = codec.benchmark([stdlib, make_upper_codec()], number=1)
+
+        self.assertEqual(len(results), 1)
+        self.assertIs(results[0][1], stdlib)
+
+    def test_get_fastest(self):
+        stdlib = codec.registry['json']
+
+        with mock.patch.object(codec, 'fastest', None):
+            with mock.patch.object(codec, 'benchmark') as benchmark:
+                benchmark.return_value = [(0.1, stdlib)]
+
+                self.assertIs(codec.get_codec('fastest'), stdlib)
+                self.assertIs(codec.get_codec('fastest'), stdlib)
+
+        self.assertEqual(benchmark.call_count, 1)
+
+
+class ProtocolCodecTestCase(unittest.TestCase):
+    """
+    Tests for the codec arguments of ``protocol``.
+    """
+
+    def test_decode(self):
+        self.assertEqual(
+            protocol.decode('["foo"]', make_upper_codec()),
+            [u'FOO']
+        )
+
+    def test_decode_unicode(self):
+        self.assertEqual(protocol.decode(u'["caf\xe9"]'), [u'caf\xe9'])
+
+    def test_decode_empty(self):
+        self.assertRaises(protocol.InvalidJSON, protocol.decode, '')
+
+    def test_encoded_message(self):
+        """
+        An ``EncodedMessage`` is decoded with the codec it was built with.
+        """
+        message = protocol.EncodedMessage.from_json(
+            '"foo"', make_upper_codec())
+
+        self.assertEqual(message.message, u'FOO')
+
+    def test_message_frame(self):
+        encode = mock.Mock(return_value='["x"]')
+        custom = codec.Codec('custom', encode, json.loads)
+
+        frame = protocol.message_frame('foo', codec=custom)
+
+        self.assertEqual(frame, 'a["x"]')
+        encode.assert_called_once_with(('foo',))
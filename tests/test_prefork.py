@@ -0,0 +1,161 @@
+"""
+Tests for ``sockjs_gevent.prefork``
+"""
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import signal
+import socket
+
+import mock
+
+from sockjs_gevent import prefork
+
+
+class MakeListenerTestCase(unittest.TestCase):
+    """
+    Tests for ``prefork.make_listener``
+    """
+
+    def test_listen(self):
+        """
+        The listener must be bound, listening and non-blocking.
+        """
+        sock = prefork.make_listener(('127.0.0.1', 0))
+
+        try:
+            self.assertNotEqual(sock.getsockname()[1], 0)
+            self.assertEqual(sock.gettimeout(), 0.0)
+        finally:
+            sock.close()
+
+    @unittest.skipIf(prefork.SO_REUSEPORT is None, 'SO_REUSEPORT unsupported')
+    def test_reuse_port(self):
+        """
+        Two listeners with ``reuse_port`` must be able to share an address.
+        """
+        first = prefork.make_listener(('127.0.0.1', 0), reuse_port=True)
+
+        try:
+            second = prefork.make_listener(
+                first.getsockname(),
+                reuse_port=True
+            )
+            second.close()
+
+            self.assertTrue(first.getsockopt(
+                socket.SOL_SOCKET, prefork.SO_REUSEPORT))
+        finally:
+            first.close()
+
+
+class ImportFactoryTestCase(unittest.TestCase):
+    """
+    Tests for ``prefork.import_factory``
+    """
+
+    def test_import(self):
+        self.assertIs(
+            prefork.import_factory('sockjs_gevent.prefork:make_listener'),
+            prefork.make_listener
+        )
+
+    def test_bad_path(self):
+        with self.assertRaises(ValueError):
+            prefork.import_factory('sockjs_gevent.prefork')
+
+
+class MasterTestCase(unittest.TestCase):
+    """
+    Tests for ``prefork.Master``
+    """
+
+    def make_master(self, **kwargs):
+        master = prefork.Master(mock.Mock(), ('127.0.0.1', 0), **kwargs)
+        master.restart_delay = 0
+
+        return master
+
+    def test_default_workers(self):
+        master = self.make_master()
+
+        self.assertEqual(master.num_workers, prefork.get_cpu_count())
+
+    def test_reap_restarts(self):
+        """
+        A worker that exits while the master is running must be restarted
+        with the same worker id.
+        """
+        master = self.make_master(workers=2)
+        master.workers = {100: 0, 101: 1}
+
+        with mock.patch.object(master, 'spawn') as spawn:
+            master.reap(101, 0)
+
+        spawn.assert_called_once_with(1)
+        self.assertEqual(master.workers, {100: 0})
+
+    def test_reap_stopping(self):
+        """
+        Workers must not be restarted once the master is stopping.
+        """
+        master = self.make_master(workers=1)
+        master.workers = {100: 0}
+        master.stopping = True
+
+        with mock.patch.object(master, 'spawn') as spawn:
+            master.reap(100, 0)
+
+        self.assertFalse(spawn.called)
+        self.assertEqual(master.workers, {})
+
+    def test_reap_unknown(self):
+        master = self.make_master(workers=1)
+
+        with mock.patch.object(master, 'spawn') as spawn:
+            master.reap(100, 0)
+
+        self.assertFalse(spawn.called)
+
+    @mock.patch('os.kill')
+    @mock.patch('os.waitpid')
+    def test_shutdown(self, waitpid, kill):
+        """
+        Workers get SIGTERM and, after draining, are reaped.
+        """
+        master = self.make_master(workers=2)
+        master.workers = {100: 0, 101: 1}
+
+        waitpid.side_effect = [(100, 0), (101, 0)]
+
+        master.shutdown()
+
+        self.assertEqual(
+            sorted(kill.call_args_list),
+            sorted([
+                mock.call(100, signal.SIGTERM),
+                mock.call(101, signal.SIGTERM)
+            ])
+        )
+        self.assertEqual(master.workers, {})
+
+    @mock.patch('os.kill')
+    @mock.patch('os.waitpid')
+    def test_shutdown_timeout(self, waitpid, kill):
+        """
+        Workers that do not drain within the timeout are killed.
+        """
+        master = self.make_master(workers=1, shutdown_timeout=0)
+        master.workers = {100: 0}
+
+        master.shutdown()
+
+        self.assertFalse(waitpid.called)
+        kill.assert_has_calls([
+            mock.call(100, signal.SIGTERM),
+            mock.call(100, signal.SIGKILL)
+        ])
+        self.assertEqual(master.workers, {})
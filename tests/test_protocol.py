@@ -0,0 +1,258 @@
+"""
+Tests for ``sockjs_gevent.protocol``
+"""
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import json
+from StringIO import StringIO
+
+from sockjs_gevent import codec, protocol
+
+
+class MessageFrameTestCase(unittest.TestCase):
+    """
+    Tests for ``protocol.message_frame``
+    """
+
+    def test_plain(self):
+        """
+        Plain messages must be encoded as a JSON array.
+        """
+        frame = protocol.message_frame('foo', 1)
+
+        self.assertEqual(frame[0], 'a')
+        self.assertEqual(protocol.decode(frame[1:]), ['foo', 1])
+
+    def test_encoded(self):
+        """
+        Pre-encoded messages must be spliced into the frame as is.
+        """
+        encoded = protocol.EncodedMessage({'foo': 'bar'})
+
+        self.assertEqual(encoded.json, protocol.encode({'foo': 'bar'}))
+
+        frame = protocol.message_frame(encoded)
+
+        self.assertEqual(frame, 'a[' + encoded.json + ']')
+
+    def test_mixed(self):
+        """
+        Pre-encoded and plain messages can share a frame.
+        """
+        encoded = protocol.EncodedMessage('foo')
+
+        frame = protocol.message_frame('bar', encoded, 2)
+
+        self.assertEqual(frame, 'a["bar","foo",2]')
+
+
+class EscapeJSTestCase(unittest.TestCase):
+    """
+    Tests for ``protocol.escape_js``
+    """
+
+    def assertEscaped(self, data, expected):
+        escaped = protocol.escape_js(data)
+
+        self.assertEqual(escaped, expected)
+        self.assertIsInstance(escaped, str)
+
+        # the escaped text is a valid string literal for the original
+        if isinstance(data, str):
+            data = data.decode('utf-8')
+
+        self.assertEqual(json.loads('"' + escaped + '"'), data)
+
+    def test_plain(self):
+        self.assertEscaped('a[1,2]', 'a[1,2]')
+
+    def test_quotes(self):
+        self.assertEscaped('a["x"]', 'a[\\"x\\"]')
+
+    def test_backslash(self):
+        """
+        An escaped quote in the JSON must stay inside the string literal.
+        """
+        self.assertEscaped('["\\""]', '[\\"\\\\\\"\\"]')
+
+    def test_control(self):
+        self.assertEscaped('\n\r\x00', '\\n\\r\\u0000')
+
+    def test_script(self):
+        self.assertEscaped(
+            '["</script><!--"]',
+            '[\\"\\u003c/script>\\u003c!--\\"]'
+        )
+
+    def test_line_separators(self):
+        """
+        U+2028 and U+2029 end a JavaScript string literal.
+        """
+        self.assertEscaped(u'\u2028\u2029', '\\u2028\\u2029')
+        self.assertEscaped('\xe2\x80\xa8\xe2\x80\xa9', '\\u2028\\u2029')
+
+    def test_non_ascii(self):
+        self.assertEscaped(u'caf\xe9', 'caf\\u00e9')
+
+
+class MessageFramePartsTestCase(unittest.TestCase):
+    """
+    Tests for ``protocol.message_frame_parts``
+    """
+
+    def test_pieces(self):
+        """
+        Pre-encoded messages are kept as separate buffers.
+        """
+        encoded = protocol.EncodedMessage('foo')
+
+        parts = protocol.message_frame_parts(['bar', encoded])
+
+        self.assertEqual(parts, ['a[', '"bar"', ',', '"foo"', ']'])
+        self.assertIs(parts[3], encoded.json)
+
+    def test_append(self):
+        parts = ['<']
+
+        result = protocol.message_frame_parts(['foo'], parts=parts)
+
+        self.assertIs(result, parts)
+        self.assertEqual(parts, ['<', 'a["foo"]'])
+
+    def test_escape(self):
+        """
+        Only the messages are escaped, the escaped form of an encoded message
+        is shared.
+        """
+        encoded = protocol.EncodedMessage('foo')
+        escape = lambda data: data.replace('"', "'")
+
+        for i in xrange(2):
+            parts = protocol.message_frame_parts(
+                [encoded, 'bar'], escape=escape)
+
+            self.assertEqual(''.join(parts), "a['foo','bar']")
+
+        self.assertEqual(encoded.cache, {escape: "'foo'"})
+        self.assertEqual(
+            protocol.message_frame_parts(['bar'], escape=escape),
+            ["a['bar']"]
+        )
+
+
+class EncodedMessageTestCase(unittest.TestCase):
+    """
+    Tests for ``protocol.EncodedMessage``
+    """
+
+    def test_get_cached(self):
+        encoded = protocol.EncodedMessage('foo')
+        calls = []
+
+        def build(message):
+            calls.append(message)
+
+            return message.json + '!'
+
+        self.assertEqual(encoded.get_cached('a', build), '"foo"!')
+        self.assertEqual(encoded.get_cached('a', build), '"foo"!')
+        self.assertEqual(encoded.get_cached('b', build), '"foo"!')
+        self.assertEqual(calls, [encoded, encoded])
+
+
+class StreamDecoderTestCase(unittest.TestCase):
+    """
+    Tests for ``protocol.StreamDecoder``
+    """
+
+    codec = codec.get_codec('json')
+
+    def decode(self, data, chunk_size=8192):
+        return list(protocol.StreamDecoder(
+            StringIO(data).read,
+            chunk_size,
+            codec=self.codec
+        ))
+
+    def test_decode(self):
+        data = '[1, -1.5e3, "ab\\"c", {"a": [1, null]}, true, "caf\xc3\xa9"]'
+        expected = [1, -1500.0, u'ab"c', {u'a': [1, None]}, True, u'caf\xe9']
+
+        for chunk_size in [1, 2, 3, 7, 8192]:
+            self.assertEqual(self.decode(data, chunk_size), expected)
+
+    def test_empty(self):
+        self.assertEqual(self.decode(''), [])
+        self.assertEqual(self.decode(' [ ] '), [])
+
+    def test_invalid(self):
+        for data in [' ', 'x', '{}', '[1,]', '[,1]', '[1 2]', '[1] x', '[1',
+                     '[tru]']:
+            for chunk_size in [1, 8192]:
+                self.assertRaises(
+                    protocol.InvalidJSON,
+                    self.decode,
+                    data,
+                    chunk_size
+                )
+
+    def test_incremental(self):
+        """
+        Each message is yielded before the rest of the payload is read.
+        """
+        stream = StringIO('["foo", "bar"]')
+        decoder = iter(protocol.StreamDecoder(stream.read, 8, self.codec))
+
+        self.assertEqual(next(decoder), u'foo')
+        self.assertEqual(stream.tell(), 8)
+
+    def test_large_value(self):
+        """
+        A value much larger than the chunk size is not parsed for every chunk.
+        """
+        stream = StringIO('["' + 'x' * 100000 + '"]')
+        sizes = []
+
+        def read(size):
+            sizes.append(size)
+
+            return stream.read(size)
+
+        result = list(protocol.StreamDecoder(read, 16, self.codec))
+
+        self.assertEqual(result, [u'x' * 100000])
+        self.assertLess(len(sizes), 20)
+
+
+class WholeStreamDecoderTestCase(StreamDecoderTestCase):
+    """
+    Tests for ``protocol.StreamDecoder`` with a codec that has no
+    ``raw_decode``.
+    """
+
+    codec = codec.Codec('whole', json.dumps, json.loads)
+
+    def test_incremental(self):
+        """
+        The whole payload is read before the first message is yielded.
+        """
+        stream = StringIO('["foo", "bar"]')
+        decoder = iter(protocol.StreamDecoder(stream.read, 8, self.codec))
+
+        self.assertEqual(next(decoder), u'foo')
+        self.assertEqual(stream.tell(), 14)
+
+    def test_codec(self):
+        """
+        The payload is decoded with the codec.
+        """
+        decode = lambda data: ['decoded', data]
+        whole = codec.Codec('whole', json.dumps, decode)
+
+        decoder = protocol.StreamDecoder(StringIO(' [1] ').read, codec=whole)
+
+        self.assertEqual(list(decoder), ['decoded', '[1]'])
@@ -166,7 +166,7 @@ class InfoTestCase(RequestHandlerTestCase):
         handler = self.make_handler(environ, app.start_response)
         endpoint = mock.Mock()
 
-        endpoint.get_info.return_value = {'foo': 'bar'}
+        endpoint.get_info_json.return_value = '{"foo": "bar"}'
 
         result = handler.do_info(endpoint)
 
@@ -248,6 +248,8 @@ class IframeTestCase(RequestHandlerTestCase):
         endpoint = mock.Mock()
 
         endpoint.client_url = 'http://unittest/foobar'
+        endpoint.get_iframe.return_value = router.make_iframe(
+            endpoint.client_url)
 
         result = handler.do_iframe(endpoint)
 
@@ -273,7 +275,8 @@ class IframeTestCase(RequestHandlerTestCase):
         handler = self.make_handler(environ, app.start_response)
         endpoint = mock.Mock()
 
-        endpoint.client_url = 'http://unittest/foobar'
+        endpoint.get_iframe.return_value = router.make_iframe(
+            'http://unittest/foobar')
 
         result = handler.do_iframe(endpoint)
 
@@ -637,4 +640,37 @@ class RequestRouterTestCase(unittest.TestCase):
 
         handler = self.run_path(app, path)
 
-        handler.do_transport.assert_called_with(None, None, 'rawwebsocket')
+        handler.do_transport.assert_called_with(
+            app.endpoints['foo'], None, None, 'rawwebsocket'
+        )
+
+    def test_affinity_local(self):
+        """
+        Requests for a server_id owned by this process are handled locally.
+        """
+        endpoint = mock.Mock()
+        app = self.make_app(foo=endpoint)
+        app.affinity = mock.Mock()
+        app.affinity.is_local.return_value = True
+
+        handler = self.run_path(app, '/foo/bar/baz/gak')
+
+        app.affinity.is_local.assert_called_with('bar', {
+            'PATH_INFO': '/foo/bar/baz/gak'
+        })
+        handler.do_transport.assert_called_with(endpoint, 'bar', 'baz', 'gak')
+
+    def test_affinity_proxy(self):
+        """
+        Requests for a server_id owned by a sibling process are proxied.
+        """
+        app = self.make_app()
+        app.affinity = mock.Mock()
+        app.affinity.is_local.return_value = False
+
+        handler = self.run_path(app, '/foo/bar/baz/gak')
+
+        app.affinity.proxy.assert_called_with(handler, {
+            'PATH_INFO': '/foo/bar/baz/gak'
+        }, 'bar', app.endpoints['foo'].max_payload_size)
+        self.assertFalse(handler.do_transport.called)
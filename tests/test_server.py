@@ -7,9 +7,11 @@ try:
 except ImportError:
     import unittest
 
+import json
+
 import mock
 
-from sockjs_gevent import server
+from sockjs_gevent import codec, router, server
 
 
 class ApplicationTestCase(unittest.TestCase):
@@ -119,6 +121,145 @@ class ApplicationTestCase(unittest.TestCase):
             app.__del__()
 
 
+class ApplicationBusTestCase(unittest.TestCase):
+    """
+    Tests for the message bus integration of ``server.Application``
+    """
+
+    def make_app(self, **endpoints):
+        bus = mock.Mock()
+
+        return server.Application(endpoints, bus=bus)
+
+    def test_bind(self):
+        """
+        The bus must be bound to the application and follow its lifecycle.
+        """
+        app = self.make_app()
+
+        app.bus.bind.assert_called_with(app)
+
+        app.start()
+        self.assertTrue(app.bus.start.called)
+
+        app.stop()
+        self.assertTrue(app.bus.stop.called)
+
+    def test_broadcast_relay(self):
+        """
+        A broadcast to all connections must be published on the bus.
+        """
+        from sockjs_gevent import protocol
+
+        endpoint = server.Endpoint()
+        app = self.make_app(echo=endpoint)
+
+        endpoint.broadcast({'foo': 'bar'})
+
+        app.bus.publish.assert_called_with(
+            'echo', None, protocol.encode({'foo': 'bar'}))
+
+        # a broadcast to specific connections stays local
+        app.bus.publish.reset_mock()
+        endpoint.broadcast('foo', [])
+
+        self.assertFalse(app.bus.publish.called)
+
+    def test_publish_relay(self):
+        """
+        A channel publish must be published on the bus.
+        """
+        endpoint = server.Endpoint()
+        app = self.make_app(echo=endpoint)
+
+        endpoint.publish('spam', 'eggs')
+
+        app.bus.publish.assert_called_with('echo', 'spam', '"eggs"')
+
+    def test_relay_failure(self):
+        """
+        A failure to relay on the bus must not affect local delivery.
+        """
+        from sockjs_gevent import bus
+
+        endpoint = server.Endpoint()
+        app = self.make_app(echo=endpoint)
+        conn = endpoint.make_connection(None, mock.Mock())
+        conn.subscribe('spam')
+
+        app.bus.publish.side_effect = bus.BusError('Message too large')
+
+        with mock.patch.object(server.logger, 'exception') as exception:
+            self.assertEqual(endpoint.broadcast('ham'), 1)
+            self.assertEqual(endpoint.publish('spam', 'eggs'), 1)
+
+        self.assertEqual(exception.call_count, 2)
+
+        calls = conn.session.offer_messages.call_args_list
+
+        self.assertEqual(calls[0][0][0].message, 'ham')
+        self.assertEqual(calls[1][0][0].message, 'eggs')
+
+    def test_receive_from_bus(self):
+        """
+        Messages from the bus must only be delivered locally.
+        """
+        endpoint = server.Endpoint()
+        app = self.make_app(echo=endpoint)
+        conn = endpoint.make_connection(None, mock.Mock())
+
+        conn.subscribe('spam')
+
+        app.receive_from_bus('echo', 'spam', '"eggs"')
+        app.receive_from_bus('echo', None, '"ham"')
+        app.receive_from_bus('missing', None, '"ham"')
+
+        calls = conn.session.offer_messages.call_args_list
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0][0][0].message, 'eggs')
+        self.assertEqual(calls[1][0][0].message, 'ham')
+        self.assertFalse(app.bus.publish.called)
+
+    def test_receive_from_bus_codec(self):
+        """
+        Messages from the bus are decoded with the codec of the endpoint.
+        """
+        endpoint = server.Endpoint()
+        endpoint.codec = mock.Mock()
+        endpoint.codec.decode.return_value = 'decoded'
+        app = self.make_app(echo=endpoint)
+        conn = endpoint.make_connection(None, mock.Mock())
+
+        app.receive_from_bus('echo', None, '"ham"')
+
+        message = conn.session.offer_messages.call_args[0][0]
+
+        self.assertIs(message.codec, endpoint.codec)
+        self.assertEqual(message.message, 'decoded')
+
+
+class ApplicationAffinityTestCase(unittest.TestCase):
+    """
+    Tests for the session affinity integration of ``server.Application``
+    """
+
+    def test_bind(self):
+        """
+        The affinity must be bound to the application and follow its
+        lifecycle.
+        """
+        app = server.Application(affinity=mock.Mock())
+
+        app.affinity.bind.assert_called_with(app)
+
+        app.start()
+        self.assertTrue(app.affinity.start.called)
+
+        app.stop()
+        self.assertTrue(app.affinity.stop.called)
+
+
 class ServerTestCase(unittest.TestCase):
     """
     Tests for ``server.Server``.
@@ -354,6 +495,67 @@ class EndpointTestCase(unittest.TestCase):
         self.assertIs(sentinel, result)
         connection_class.assert_called_with(endpoint, session)
 
+    def test_connections(self):
+        """
+        The endpoint must track its connections until they are closed.
+        """
+        endpoint = self.make_endpoint()
+
+        conn = endpoint.make_connection(None, mock.Mock())
+
+        self.assertEqual(endpoint.connections, set([conn]))
+
+        conn.close()
+
+        self.assertEqual(endpoint.connections, set())
+
+    def test_broadcast(self):
+        """
+        A broadcast must queue the same pre-encoded message on each session.
+        """
+        from sockjs_gevent import protocol
+
+        endpoint = self.make_endpoint()
+        foo = endpoint.make_connection(None, mock.Mock())
+        bar = endpoint.make_connection(None, mock.Mock())
+        closed = endpoint.make_connection(None, None)
+
+        result = endpoint.broadcast({'spam': 'eggs'})
+
+        self.assertEqual(result, 2)
+
+        encoded = foo.session.offer_messages.call_args[0][0]
+
+        self.assertIsInstance(encoded, protocol.EncodedMessage)
+        self.assertEqual(encoded.message, {'spam': 'eggs'})
+        bar.session.offer_messages.assert_called_with(encoded)
+
+        # only to the supplied connections
+        self.assertEqual(endpoint.broadcast('foo', [foo]), 1)
+        self.assertEqual(endpoint.broadcast('foo', [closed]), 0)
+
+    def test_channels(self):
+        """
+        Channel subscriptions must be removed when the connection is closed.
+        """
+        endpoint = self.make_endpoint()
+        foo = endpoint.make_connection(None, mock.Mock())
+        bar = endpoint.make_connection(None, mock.Mock())
+
+        foo.subscribe('spam')
+        endpoint.subscribe(bar, 'spam')
+
+        self.assertEqual(endpoint.publish('spam', 'eggs'), 2)
+        self.assertEqual(endpoint.get_channel_stats()['spam']['subscribers'], 2)
+
+        foo.session_closed()
+
+        self.assertEqual(endpoint.publish('spam', 'eggs'), 1)
+
+        bar.unsubscribe('spam')
+
+        self.assertEqual(endpoint.get_channel_stats(), {})
+
     def test_transport_allowed(self):
         """
         Basic sanity checks for ``Endpoint.transport_allowed``.
@@ -391,6 +593,44 @@ class EndpointTestCase(unittest.TestCase):
 
         endpoint.start()
 
+    def test_start_heartbeat(self):
+        """
+        Starting the endpoint must start a single heartbeat scheduler that new
+        sessions are registered with.
+        """
+        heartbeat_class = mock.Mock()
+        heartbeat = heartbeat_class.return_value
+        endpoint = self.make_endpoint(heartbeat_interval=12.0)
+
+        endpoint.pool_class = mock.Mock()
+        endpoint.heartbeat_class = heartbeat_class
+
+        endpoint.start()
+
+        heartbeat_class.assert_called_with(12.0)
+        self.assertIs(endpoint.heartbeat, heartbeat)
+        self.assertTrue(heartbeat.start.called)
+
+        session = endpoint.make_session('foobar')
+
+        heartbeat.add.assert_called_with(session)
+
+        endpoint.stop()
+
+        self.assertTrue(heartbeat.stop.called)
+        self.assertIsNone(endpoint.heartbeat)
+
+    def test_no_heartbeat(self):
+        """
+        A heartbeat interval of ``None`` disables heartbeats.
+        """
+        endpoint = self.make_endpoint(heartbeat_interval=None)
+
+        endpoint.pool_class = mock.Mock()
+        endpoint.start()
+
+        self.assertIsNone(endpoint.heartbeat)
+
     def test_stop(self):
         """
         Stopping a started endpoint must stop the session pool
@@ -431,6 +671,88 @@ class EndpointTestCase(unittest.TestCase):
 
         session_class.assert_called_with('foobar')
 
+    def test_make_session_queue_limits(self):
+        """
+        Sessions must share the queue limits of the endpoint.
+        """
+        endpoint = self.make_endpoint(max_queue_messages=10)
+        session_class = endpoint.session_class = mock.Mock()
+
+        endpoint.pool_class = mock.Mock()
+        endpoint.start()
+
+        limits = endpoint.queue_limits
+
+        self.assertEqual(limits.max_messages, 10)
+        self.assertIsNone(limits.max_bytes)
+        self.assertEqual(limits.policy, 'drop_oldest')
+
+        endpoint.make_session('foobar')
+
+        session_class.assert_called_with('foobar', limits=limits)
+
+    def test_make_session_coalescer(self):
+        """
+        Each session must get its own coalescer when a window is configured.
+        """
+        endpoint = self.make_endpoint(coalesce_window=0.01,
+                                      coalesce_messages=50)
+        session_class = endpoint.session_class = mock.Mock()
+
+        endpoint.make_session('foo')
+        first = session_class.call_args[1]['coalescer']
+
+        endpoint.make_session('bar')
+        second = session_class.call_args[1]['coalescer']
+
+        self.assertIsNot(first, second)
+        self.assertEqual(first.window, 0.01)
+        self.assertEqual(first.max_messages, 50)
+
+    def test_negotiate_deflate(self):
+        environ = {'HTTP_SEC_WEBSOCKET_EXTENSIONS': 'permessage-deflate'}
+
+        self.assertIsNone(self.make_endpoint().negotiate_deflate(environ))
+
+        endpoint = self.make_endpoint(permessage_deflate=True,
+                                      deflate_window_bits=10)
+        deflate = endpoint.negotiate_deflate(environ)
+
+        self.assertEqual(deflate.server_max_window_bits, 10)
+        self.assertFalse(deflate.server_no_context_takeover)
+
+    def test_negotiate_deflate_shared_frames(self):
+        """
+        Shared frames can only be used without context takeover.
+        """
+        environ = {'HTTP_SEC_WEBSOCKET_EXTENSIONS': 'permessage-deflate'}
+        endpoint = self.make_endpoint(permessage_deflate=True,
+                                      deflate_shared_frames=True)
+
+        deflate = endpoint.negotiate_deflate(environ)
+
+        self.assertTrue(deflate.server_no_context_takeover)
+
+    def test_codec(self):
+        self.assertIsNone(self.make_endpoint().codec)
+
+        endpoint = self.make_endpoint(codec='json')
+
+        self.assertIs(endpoint.codec, codec.registry['json'])
+        self.assertRaises(ValueError, self.make_endpoint, codec='foo')
+
+    def test_binary_protocols(self):
+        self.assertIsNone(self.make_endpoint().binary_protocols)
+
+        binary = codec.Codec('binary', str, str)
+
+        with mock.patch.dict(codec.binary_registry, binary=binary):
+            endpoint = self.make_endpoint(binary_protocols=['binary'])
+
+        self.assertEqual(endpoint.binary_protocols, [binary])
+        self.assertRaises(ValueError, self.make_endpoint,
+                          binary_protocols=['foo'])
+
     def test_get_session_not_started(self):
         """
         Calling ``get_session`` when the endpoint has not been started must
@@ -511,6 +833,42 @@ class EndpointTestCase(unittest.TestCase):
             'server_heartbeat_interval': heartbeat_interval
         })
 
+    def test_get_info_json(self):
+        endpoint = self.make_endpoint(heartbeat_interval=10.0)
+        randint = mock.Mock()
+        randint.return_value = 54
+
+        result = json.loads(endpoint.get_info_json(randint))
+
+        self.assertEqual(result, {
+            'cookie_needed': False,
+            'websocket': True,
+            'origins': ['*:*'],
+            'entropy': 54,
+            'server_heartbeat_interval': 10.0
+        })
+        randint.assert_called_with(1, server.MAX_ENTROPY)
+
+    def test_static_responses(self):
+        """
+        The iframe and info responses are rendered when the endpoint starts.
+        """
+        endpoint = self.make_endpoint(client_url='http://foo/sockjs.js')
+
+        endpoint.start()
+
+        self.assertEqual(
+            endpoint.iframe,
+            router.make_iframe('http://foo/sockjs.js')
+        )
+        self.assertIs(endpoint.get_iframe(), endpoint.iframe)
+        self.assertIsNotNone(endpoint.info_template)
+
+        endpoint.stop()
+
+        self.assertIsNone(endpoint.iframe)
+        self.assertIsNone(endpoint.info_template)
+
     def test_get_info_no_websocket(self):
         """
         If websocket is in the disabled_transports list, get_info must return
@@ -85,6 +85,53 @@ class PoolTestCase(unittest.TestCase):
         self.assertEqual(pool.sessions, {})
         self.assertEqual(pool.cycles, {})
 
+    def test_remove_tombstone(self):
+        """
+        Removing a session must leave a tombstone in the heap until enough of
+        the heap is dead to make compaction worthwhile.
+        """
+        pool = self.make_pool()
+        foo = self.make_session('foo')
+        bar = self.make_session('bar')
+        baz = self.make_session('baz')
+
+        pool.add(foo, lambda: 1)
+        pool.add(bar, lambda: 2)
+        pool.add(baz, lambda: 3)
+
+        self.assertTrue(pool.remove('foo'))
+
+        self.assertEqual(pool.tombstones, 1)
+        self.assertEqual(len(pool.pool), 3)
+        self.assertEqual(pool.cycles, {bar: 2, baz: 3})
+
+        self.assertTrue(pool.remove('bar'))
+
+        # compacted
+        self.assertEqual(pool.tombstones, 0)
+        self.assertEqual(pool.pool, [(3, baz)])
+
+    def test_gc_tombstone(self):
+        """
+        gc must skip over tombstones in the heap.
+        """
+        pool = self.make_pool()
+        foo = self.make_session('foo')
+        bar = self.make_session('bar')
+        baz = self.make_session('baz')
+
+        pool.add(foo, lambda: 1)
+        pool.add(bar, lambda: 2)
+        pool.add(baz, lambda: 3)
+
+        pool.remove('foo')
+
+        pool.gc(lambda: 10)
+
+        self.assertEqual(pool.tombstones, 0)
+        self.assertEqual(sorted(pool.pool), sorted([(10, bar), (10, baz)]))
+        self.assertEqual(pool.sessions, {'bar': bar, 'baz': baz})
+
     def test_remove_open_session(self):
         """
         If the pool removes an open session, ensure it is interrupted.
@@ -132,3 +179,627 @@ class PoolTestCase(unittest.TestCase):
             'foo': foo,
             'bar': bar,
         })
+
+
+class TimerWheelTestCase(unittest.TestCase):
+    """
+    Tests for `session.TimerWheel`
+    """
+
+    def make_wheel(self, *args, **kwargs):
+        return session.TimerWheel(*args, **kwargs)
+
+    def make_session(self, session_id, expires_at):
+        s = session.MemorySession(session_id)
+        s.expires_at = expires_at
+
+        return s
+
+    def test_add(self):
+        """
+        Sessions must be bucketed by their expiry.
+        """
+        wheel = self.make_wheel(resolution=2.0)
+        foo = self.make_session('foo', 101.5)
+        bar = self.make_session('bar', 0)
+
+        wheel.add(foo)
+        wheel.add(bar)
+
+        self.assertEqual(len(wheel), 2)
+        self.assertEqual(wheel.buckets, {51: set([foo])})
+        self.assertEqual(wheel.ticks, [51])
+        self.assertEqual(wheel.persistent, set([bar]))
+
+    def test_remove(self):
+        """
+        Removing a session must clean up correctly.
+        """
+        wheel = self.make_wheel()
+        foo = self.make_session('foo', 100)
+
+        wheel.add(foo)
+
+        self.assertTrue(wheel.remove(foo))
+        self.assertFalse(wheel.remove(foo))
+        self.assertNotIn(foo, wheel)
+        self.assertEqual(wheel.buckets, {100: set()})
+
+    def test_expire(self):
+        """
+        Only sessions that are due must be expired.
+        """
+        wheel = self.make_wheel()
+        foo = self.make_session('foo', 100)
+        bar = self.make_session('bar', 200)
+
+        wheel.add(foo)
+        wheel.add(bar)
+
+        self.assertEqual(wheel.expire(99.0), [])
+        self.assertEqual(wheel.expire(100.0), [foo])
+        self.assertEqual(wheel.buckets, {200: set([bar])})
+        self.assertNotIn(foo, wheel)
+
+    def test_expire_touched(self):
+        """
+        A session that has been touched since it was added must be moved to its
+        new bucket rather than expired.
+        """
+        wheel = self.make_wheel()
+        foo = self.make_session('foo', 100)
+
+        wheel.add(foo)
+        foo.expires_at = 150
+
+        self.assertEqual(wheel.expire(120.0), [])
+        self.assertEqual(wheel.buckets, {150: set([foo])})
+        self.assertEqual(wheel.expire(150.0), [foo])
+
+    def test_expire_closed_persistent(self):
+        """
+        A session that never expires must be removed once it is closed.
+        """
+        wheel = self.make_wheel()
+        foo = self.make_session('foo', 0)
+
+        wheel.add(foo)
+
+        self.assertEqual(wheel.expire(100.0), [])
+
+        foo.close()
+
+        self.assertEqual(wheel.expire(100.0), [foo])
+        self.assertEqual(len(wheel), 0)
+
+
+class TimerWheelPoolTestCase(unittest.TestCase):
+    """
+    Tests for `session.TimerWheelPool`
+    """
+
+    def make_pool(self, *args, **kwargs):
+        return session.TimerWheelPool(*args, **kwargs)
+
+    def make_session(self, session_id):
+        return session.MemorySession(session_id)
+
+    def test_add_remove(self):
+        """
+        Sessions must be indexed by the wheel for as long as they are in the
+        pool.
+        """
+        pool = self.make_pool()
+        foo = self.make_session('foo')
+
+        pool.add(foo)
+
+        self.assertIs(pool.get('foo'), foo)
+        self.assertIn(foo, pool.wheel)
+        self.assertRaises(RuntimeError, pool.add, self.make_session('foo'))
+
+        self.assertTrue(pool.remove('foo'))
+        self.assertFalse(pool.remove('foo'))
+        self.assertNotIn(foo, pool.wheel)
+
+    def test_gc(self):
+        """
+        Expired sessions must be removed and interrupted.
+        """
+        pool = self.make_pool()
+        foo = self.make_session('foo')
+        bar = self.make_session('bar')
+
+        foo.expires_at = 100
+        bar.expires_at = 200
+
+        pool.add(foo)
+        pool.add(bar)
+
+        foo.state = 'open'
+
+        pool.gc(lambda: 150)
+
+        self.assertIsNone(pool.get('foo'))
+        self.assertTrue(foo.interrupted)
+        self.assertIs(pool.get('bar'), bar)
+
+
+class ShardedPoolTestCase(unittest.TestCase):
+    """
+    Tests for `session.ShardedPool`
+    """
+
+    def make_pool(self, *args, **kwargs):
+        return session.ShardedPool(*args, **kwargs)
+
+    def make_session(self, session_id):
+        return session.MemorySession(session_id)
+
+    def test_create(self):
+        """
+        The gc schedule of each shard must be staggered.
+        """
+        pool = self.make_pool(shards=4, gc_cycle=8.0)
+
+        self.assertEqual(len(pool.shards), 4)
+        self.assertEqual(
+            [shard.gc_offset for shard in pool.shards],
+            [0.0, 2.0, 4.0, 6.0]
+        )
+
+        for shard in pool.shards:
+            self.assertEqual(shard.gc_cycle, 8.0)
+
+        self.assertRaises(ValueError, self.make_pool, shards=0)
+
+    def test_add_session(self):
+        """
+        A session must be added to the shard that owns its session id.
+        """
+        pool = self.make_pool(shards=4)
+        foo = self.make_session('foo')
+
+        pool.add(foo)
+
+        shard = pool.get_shard('foo')
+
+        self.assertIs(shard.get('foo'), foo)
+        self.assertIs(pool.get('foo'), foo)
+        self.assertIsNone(pool.get('bar'))
+
+        self.assertRaises(RuntimeError, pool.add, self.make_session('foo'))
+
+    def test_remove(self):
+        """
+        Removing a session must clean up the owning shard.
+        """
+        pool = self.make_pool(shards=4)
+        foo = self.make_session('foo')
+
+        pool.add(foo)
+
+        self.assertTrue(pool.remove('foo'))
+        self.assertFalse(pool.remove('foo'))
+        self.assertEqual(pool.get_shard('foo').sessions, {})
+
+    def test_gc(self):
+        """
+        gc must visit all shards.
+        """
+        pool = self.make_pool(shards=4)
+        sessions = [self.make_session(str(i)) for i in range(10)]
+
+        for s in sessions:
+            pool.add(s)
+
+        sessions[3].close()
+        sessions[7].close()
+
+        pool.gc()
+
+        self.assertIsNone(pool.get('3'))
+        self.assertIsNone(pool.get('7'))
+        self.assertIs(pool.get('5'), sessions[5])
+
+    def test_stop(self):
+        """
+        Stopping the pool must stop all shards.
+        """
+        pool = self.make_pool(shards=2)
+
+        pool.stop()
+
+        for shard in pool.shards:
+            self.assertTrue(shard.stopping)
+
+        self.assertRaises(RuntimeError, pool.add, self.make_session('foo'))
+
+
+def spawn(func, *args):
+    # runs the greenlet of a heartbeat straight away
+    func(*args)
+
+
+class HeartbeatSchedulerTestCase(unittest.TestCase):
+    """
+    Tests for `session.HeartbeatScheduler`
+    """
+
+    class Reader(object):
+        def __init__(self):
+            self.heartbeats = 0
+
+        def send_heartbeat(self):
+            self.heartbeats += 1
+
+    def make_scheduler(self, *args, **kwargs):
+        return session.HeartbeatScheduler(*args, **kwargs)
+
+    def make_session(self, session_id, reader=None):
+        s = session.MemorySession(session_id)
+        s.state = 'open'
+        s.read_owner = reader
+
+        return s
+
+    def test_add(self):
+        """
+        Sessions must be bucketed by the tick of their next heartbeat.
+        """
+        scheduler = self.make_scheduler(interval=25.0)
+        foo = self.make_session('foo')
+
+        scheduler.add(foo, 100.0)
+
+        self.assertEqual(scheduler.buckets, {125: [foo]})
+        self.assertEqual(len(scheduler), 1)
+
+    @mock.patch('gevent.spawn', spawn)
+    def test_tick(self):
+        """
+        Only due sessions must get a heartbeat.
+        """
+        reader = self.Reader()
+        scheduler = self.make_scheduler(interval=10.0)
+        foo = self.make_session('foo', reader)
+        bar = self.make_session('bar', reader)
+
+        scheduler.add(foo, 100.0)
+        scheduler.add(bar, 105.0)
+
+        self.assertEqual(scheduler.tick(109.0), 0)
+        self.assertEqual(scheduler.tick(110.0), 1)
+        self.assertEqual(reader.heartbeats, 1)
+
+        # rescheduled
+        self.assertEqual(scheduler.buckets, {115: [bar], 120: [foo]})
+
+    @mock.patch('gevent.spawn', spawn)
+    def test_tick_active(self):
+        """
+        A session that has sent a frame since its last heartbeat gets the next
+        one an interval after that frame.
+        """
+        reader = self.Reader()
+        scheduler = self.make_scheduler(interval=10.0)
+        foo = self.make_session('foo', reader)
+
+        scheduler.add(foo, 100.0)
+        foo.last_sent = 105.0
+
+        self.assertEqual(scheduler.tick(110.0), 0)
+        self.assertEqual(scheduler.buckets, {115: [foo]})
+
+        self.assertEqual(scheduler.tick(115.0), 1)
+        self.assertEqual(foo.last_sent, 115.0)
+        self.assertEqual(scheduler.buckets, {125: [foo]})
+
+    @mock.patch('gevent.spawn')
+    def test_tick_spawns(self, spawn):
+        """
+        Every heartbeat is written from its own greenlet, a stalled client
+        can not hold up the others.
+        """
+        readers = [self.Reader(), self.Reader()]
+        scheduler = self.make_scheduler(interval=10.0)
+        foo = self.make_session('foo', readers[0])
+        bar = self.make_session('bar', readers[1])
+
+        scheduler.add(foo, 100.0)
+        scheduler.add(bar, 100.0)
+
+        self.assertEqual(scheduler.tick(110.0), 2)
+        self.assertEqual(spawn.call_args_list, [
+            mock.call(session.send_heartbeat, readers[0]),
+            mock.call(session.send_heartbeat, readers[1]),
+        ])
+
+    def test_tick_closed(self):
+        """
+        Closed sessions must be dropped from the schedule.
+        """
+        scheduler = self.make_scheduler(interval=10.0)
+        foo = self.make_session('foo', self.Reader())
+
+        scheduler.add(foo, 100.0)
+        foo.close()
+
+        self.assertEqual(scheduler.tick(110.0), 0)
+        self.assertEqual(len(scheduler), 0)
+
+    def test_tick_no_reader(self):
+        """
+        Sessions without a reader are kept until they expire.
+        """
+        scheduler = self.make_scheduler(interval=10.0)
+        foo = self.make_session('foo')
+
+        foo.expires_at = 115.0
+        scheduler.add(foo, 100.0)
+
+        self.assertEqual(scheduler.tick(110.0), 0)
+        self.assertEqual(scheduler.buckets, {120: [foo]})
+
+        self.assertEqual(scheduler.tick(120.0), 0)
+        self.assertEqual(len(scheduler), 0)
+
+
+class BoundedMemorySessionTestCase(unittest.TestCase):
+    """
+    Tests for `session.MemorySession` with `session.QueueLimits`
+    """
+
+    session_class = session.MemorySession
+
+    def make_session(self, session_id='foo', **kwargs):
+        limits = session.QueueLimits(**kwargs)
+        s = self.session_class(session_id, limits=limits)
+        s.state = 'open'
+
+        return s
+
+    def test_unknown_policy(self):
+        """
+        An unknown policy must be rejected.
+        """
+        self.assertRaises(ValueError, session.QueueLimits, policy='foo')
+
+    def test_drop_oldest(self):
+        """
+        The oldest messages must make room for new ones.
+        """
+        s = self.make_session(max_messages=2)
+
+        s.add_messages('a', 'b', 'c')
+
+        self.assertEqual(list(s.get_messages()), ['b', 'c'])
+        self.assertEqual(s.limits.counters['drop_oldest'], 1)
+
+    def test_drop_newest(self):
+        """
+        New messages must be discarded when the queue is full.
+        """
+        s = self.make_session(max_messages=2, policy='drop_newest')
+
+        s.add_messages('a', 'b', 'c', 'd')
+
+        self.assertEqual(list(s.get_messages()), ['a', 'b'])
+        self.assertEqual(s.limits.counters['drop_newest'], 2)
+
+    def test_max_bytes(self):
+        """
+        The queue must be bounded by the encoded size of the messages.
+        """
+        s = self.make_session(max_bytes=10)
+
+        # each message is 5 bytes once encoded
+        s.add_messages('aaa', 'bbb', 'ccc')
+
+        self.assertEqual(s.queued_bytes, 10)
+        self.assertEqual(list(s.get_messages()), ['bbb', 'ccc'])
+        self.assertEqual(s.queued_bytes, 0)
+
+    def test_max_bytes_oversized(self):
+        """
+        A message that cannot fit in an empty queue must be dropped.
+        """
+        s = self.make_session(max_bytes=4)
+
+        s.add_messages('a', 'abcdef')
+
+        self.assertEqual(list(s.get_messages()), ['a'])
+        self.assertEqual(s.queued_bytes, 0)
+
+    def test_max_bytes_oversized_keeps_queue(self):
+        """
+        Dropping an oversized message must not evict the queued ones.
+        """
+        s = self.make_session(max_bytes=15)
+
+        s.add_messages('aaa', 'bbb', 'ccc')
+        s.add_messages('x' * 20)
+
+        self.assertEqual(s.queued_bytes, 15)
+        self.assertEqual(list(s.get_messages()), ['aaa', 'bbb', 'ccc'])
+        self.assertEqual(s.limits.counters['drop_oldest'], 1)
+
+    def test_close(self):
+        """
+        The close policy must close the session with a dedicated status.
+        """
+        from sockjs_gevent import protocol
+
+        s = self.make_session(max_messages=1, policy='close')
+
+        s.add_messages('a', 'b', 'c')
+
+        self.assertTrue(s.closed)
+        self.assertEqual(s.limits.counters['close'], 1)
+
+        with self.assertRaises(session.SessionUnavailable) as ctx:
+            s.lock(object(), True, False)
+
+        self.assertEqual(
+            (ctx.exception.code, ctx.exception.reason),
+            protocol.CONN_QUEUE_OVERFLOW
+        )
+
+    def test_block_timeout(self):
+        """
+        A blocked sender that times out must close the session.
+        """
+        s = self.make_session(max_messages=1, policy='block', timeout=0)
+
+        s.add_messages('a', 'b')
+
+        self.assertTrue(s.closed)
+        self.assertEqual(s.limits.counters['block'], 1)
+
+    def test_offer_does_not_block(self):
+        """
+        Fanning out to a full session must close it rather than wait.
+        """
+        from sockjs_gevent import protocol
+
+        s = self.make_session(max_messages=1, policy='block', timeout=60)
+
+        with mock.patch.object(self.session_class, 'wait_for_room') as wait:
+            s.offer_messages('a', 'b')
+
+        self.assertFalse(wait.called)
+        self.assertTrue(s.closed)
+        self.assertEqual(s.close_status, protocol.CONN_QUEUE_OVERFLOW)
+
+    def test_offer_messages(self):
+        s = self.make_session(max_messages=2, policy='block')
+
+        s.offer_messages('a', 'b')
+
+        self.assertEqual(list(s.get_messages()), ['a', 'b'])
+        self.assertFalse(s.closed)
+
+
+class DequeSessionTestCase(unittest.TestCase):
+    """
+    Tests for `session.DequeSession`
+    """
+
+    def make_session(self, session_id='foo', **kwargs):
+        return session.DequeSession(session_id, **kwargs)
+
+    def test_add_messages(self):
+        """
+        Messages must be buffered in order and wake up the reader.
+        """
+        s = self.make_session()
+
+        self.assertFalse(s.ready.is_set())
+
+        s.add_messages('a', 'b')
+        s.add_messages('c')
+
+        self.assertEqual(list(s.queue), ['a', 'b', 'c'])
+        self.assertTrue(s.ready.is_set())
+
+    def test_get_messages(self):
+        """
+        Getting messages must take the whole buffer.
+        """
+        s = self.make_session()
+
+        s.add_messages('a', 'b')
+        buf = s.queue
+
+        messages = s.get_messages()
+
+        self.assertIs(messages, buf)
+        self.assertEqual(list(messages), ['a', 'b'])
+        self.assertEqual(s.queue_length(), 0)
+        self.assertTrue(s.last_sent)
+
+    def test_get_messages_timeout(self):
+        """
+        No messages must return an empty sequence once the timeout expires.
+        """
+        s = self.make_session()
+
+        self.assertEqual(list(s.get_messages(timeout=0)), [])
+        self.assertEqual(s.last_sent, 0)
+
+
+class BoundedDequeSessionTestCase(BoundedMemorySessionTestCase):
+    """
+    Tests for `session.DequeSession` with `session.QueueLimits`
+    """
+
+    session_class = session.DequeSession
+
+
+class CoalescerTestCase(unittest.TestCase):
+    """
+    Tests for ``session.Coalescer``
+    """
+
+    def feed(self, coalescer, rate, batches=20):
+        """
+        Record ``batches`` single message batches arriving at ``rate``
+        messages per second.
+        """
+        now = (coalescer.last_batch or 1000.0) + 1.0 / rate
+
+        for _ in xrange(batches):
+            coalescer.record(1, now)
+            now += 1.0 / rate
+
+    def test_idle(self):
+        """
+        A session without history must not be delayed.
+        """
+        coalescer = session.Coalescer(window=0.01)
+
+        self.assertEqual(coalescer.get_delay(1), 0)
+
+    def test_slow(self):
+        """
+        Sessions receiving messages slower than the window are not delayed.
+        """
+        coalescer = session.Coalescer(window=0.01)
+
+        self.feed(coalescer, 10)
+
+        self.assertEqual(coalescer.get_delay(1), 0)
+
+    def test_fast(self):
+        """
+        Sessions receiving messages faster than the window wait for the full
+        window.
+        """
+        coalescer = session.Coalescer(window=0.01)
+
+        self.feed(coalescer, 1000)
+
+        self.assertTrue(coalescer.rate > 500)
+        self.assertEqual(coalescer.get_delay(1), 0.01)
+
+    def test_max_messages(self):
+        """
+        The delay is just long enough to fill a frame of ``max_messages``.
+        """
+        coalescer = session.Coalescer(window=0.01, max_messages=5)
+        coalescer.rate = 1000.0
+
+        self.assertAlmostEqual(coalescer.get_delay(1), 0.004)
+        self.assertEqual(coalescer.get_delay(5), 0)
+
+    def test_adapts(self):
+        """
+        A session that slows down stops being delayed.
+        """
+        coalescer = session.Coalescer(window=0.01)
+
+        self.feed(coalescer, 1000)
+        self.assertTrue(coalescer.get_delay(1))
+
+        self.feed(coalescer, 5)
+        self.assertEqual(coalescer.get_delay(1), 0)
@@ -3,9 +3,13 @@ try:
 except ImportError:
     import unittest
 
+import json
+import zlib
+from StringIO import StringIO
+
 import mock
 
-from sockjs_gevent import transport
+from sockjs_gevent import codec, protocol, server, transport, websocket
 
 
 class StopRequest(Exception):
@@ -282,3 +286,995 @@ class HandlerTestCase(unittest.TestCase):
         self.assertRaises(RuntimeError, tport.handle)
 
         self.assertFalse(handler.finalized)
+
+
+class WritingOnlyTransportTestCase(unittest.TestCase):
+    """
+    Tests for ``transport.WritingOnlyTransport``
+    """
+
+    def make_transport(self, body, klass=transport.XHRSend,
+                       max_payload_size=None, codec=None, **environ):
+        session = mock.Mock()
+        session.conn.endpoint.max_payload_size = max_payload_size
+        session.conn.endpoint.codec = codec
+        handler = mock.Mock()
+        handler.handle_options.return_value = False
+
+        environ['wsgi.input'] = StringIO(body)
+
+        return klass(session, handler, environ)
+
+    def test_dispatch(self):
+        """
+        Each message is dispatched on its own.
+        """
+        tport = self.make_transport('["foo", {"bar": 1}]')
+
+        tport.handle_request()
+
+        self.assertEqual(tport.session.dispatch.call_args_list, [
+            mock.call(u'foo'),
+            mock.call({u'bar': 1}),
+        ])
+
+    def test_codec(self):
+        """
+        The body is decoded with the codec of the endpoint.
+        """
+        decode = mock.Mock(return_value=['decoded'])
+        tport = self.make_transport(
+            '["foo"]',
+            codec=codec.Codec('test', json.dumps, decode)
+        )
+
+        tport.handle_request()
+
+        decode.assert_called_with('["foo"]')
+        tport.session.dispatch.assert_called_with('decoded')
+
+    def test_payload_expected(self):
+        tport = self.make_transport('')
+
+        self.assertRaises(transport.TransportError, tport.handle_request)
+
+    def test_invalid(self):
+        tport = self.make_transport('["foo", x]')
+
+        self.assertRaises(protocol.InvalidJSON, tport.handle_request)
+        tport.session.dispatch.assert_called_once_with(u'foo')
+
+    def test_content_length_too_large(self):
+        """
+        A body declared to be too large is rejected before it is read.
+        """
+        tport = self.make_transport(
+            '["foo"]',
+            max_payload_size=5,
+            CONTENT_LENGTH='7',
+            REQUEST_METHOD='POST'
+        )
+
+        tport.handle()
+
+        self.assertEqual(
+            tport.handler.write_response.call_args[1]['status'],
+            '413 Request Entity Too Large'
+        )
+        self.assertFalse(tport.session.lock.called)
+        self.assertEqual(tport.environ['wsgi.input'].tell(), 0)
+
+    def test_streamed_too_large(self):
+        """
+        A body without a Content-Length that goes over the limit gets the
+        same 413, the session is not interrupted.
+        """
+        tport = self.make_transport(
+            '["' + 'x' * 100 + '"]',
+            max_payload_size=50,
+            REQUEST_METHOD='POST'
+        )
+        tport.session.new = False
+        tport.session.opened = True
+
+        tport.handle()
+
+        self.assertEqual(
+            tport.handler.write_response.call_args[1]['status'],
+            '413 Request Entity Too Large'
+        )
+        self.assertEqual(tport.environ['wsgi.input'].tell(), 51)
+        self.assertFalse(tport.session.interrupt.called)
+        self.assertFalse(tport.handler.write_nothing.called)
+        self.assertTrue(tport.session.unlock.called)
+
+    def test_within_limit(self):
+        tport = self.make_transport('["foo"]', max_payload_size=7,
+                                    CONTENT_LENGTH='7')
+
+        self.assertIsNot(tport.prepare_request(), False)
+
+        tport.handle_request()
+
+        tport.session.dispatch.assert_called_once_with(u'foo')
+
+    def test_jsonp_form(self):
+        tport = self.make_transport(
+            'd=%5B%22foo%22%5D',
+            klass=transport.JSONPSend,
+            CONTENT_TYPE='application/x-www-form-urlencoded'
+        )
+
+        tport.handle_request()
+
+        tport.session.dispatch.assert_called_once_with(u'foo')
+
+    def test_jsonp_form_missing(self):
+        tport = self.make_transport(
+            'x=1',
+            klass=transport.JSONPSend,
+            CONTENT_TYPE='application/x-www-form-urlencoded'
+        )
+
+        self.assertRaises(transport.TransportError, tport.handle_request)
+
+
+class SendingOnlyTransportTestCase(unittest.TestCase):
+    """
+    Tests for ``transport.SendingOnlyTransport``
+    """
+
+    def make_transport(self, klass=transport.SendingOnlyTransport):
+        return klass(mock.Mock(), mock.Mock(), {})
+
+    @mock.patch('gevent.get_hub')
+    def test_single_watcher(self, get_hub):
+        """
+        A single io watcher must be started for the duration of the request
+        and the messages produced in the request greenlet.
+        """
+        watcher = get_hub.return_value.loop.io.return_value
+        tport = self.make_transport()
+        tport.handler.socket.fileno.return_value = 123
+        tport.produce_messages = mock.Mock()
+
+        tport.handle_request()
+
+        get_hub.return_value.loop.io.assert_called_with(123, 1)
+        self.assertTrue(watcher.start.called)
+        tport.produce_messages.assert_called_with()
+        watcher.stop.assert_called_with()
+
+    @mock.patch('gevent.get_hub')
+    def test_client_aborted(self, get_hub):
+        """
+        An aborted client must surface as a ``socket.error``.
+        """
+        import socket
+
+        watcher = get_hub.return_value.loop.io.return_value
+        tport = self.make_transport()
+        tport.produce_messages = mock.Mock(
+            side_effect=transport.ClientAborted)
+
+        self.assertRaises(socket.error, tport.handle_request)
+        watcher.stop.assert_called_with()
+
+    def test_connection_closed(self):
+        """
+        EOF on the socket must abort the producer.
+        """
+        tport = self.make_transport()
+        watcher = mock.Mock()
+        raw_sock = mock.Mock()
+        producer = mock.Mock()
+
+        raw_sock.recv.return_value = ''
+
+        tport.connection_readable(watcher, raw_sock, producer)
+
+        self.assertTrue(watcher.stop.called)
+        self.assertTrue(producer.throw.called)
+
+        exc = producer.throw.call_args[0][0]
+
+        self.assertIsInstance(exc, transport.ClientAborted)
+
+    def test_connection_data(self):
+        """
+        Data from the client stops the watcher but does not abort the request.
+        """
+        tport = self.make_transport()
+        watcher = mock.Mock()
+        raw_sock = mock.Mock()
+        producer = mock.Mock()
+
+        raw_sock.recv.return_value = 'G'
+
+        tport.connection_readable(watcher, raw_sock, producer)
+
+        self.assertTrue(watcher.stop.called)
+        self.assertFalse(producer.throw.called)
+
+    def test_connection_spurious(self):
+        """
+        A spurious wake up must leave the watcher running.
+        """
+        import errno
+        import socket
+
+        tport = self.make_transport()
+        watcher = mock.Mock()
+        raw_sock = mock.Mock()
+        producer = mock.Mock()
+
+        raw_sock.recv.side_effect = socket.error(errno.EAGAIN)
+
+        tport.connection_readable(watcher, raw_sock, producer)
+
+        self.assertFalse(watcher.stop.called)
+        self.assertFalse(producer.throw.called)
+
+
+class PollingTransportTestCase(unittest.TestCase):
+    """
+    Tests for ``transport.PollingTransport``
+    """
+
+    def make_transport(self):
+        handler = mock.Mock()
+        handler.handle_options.return_value = False
+        session = mock.Mock()
+        session.conn = None
+
+        return transport.XHRPolling(session, handler, {})
+
+    def test_open(self):
+        """
+        The first poll of a new session responds with just the open frame.
+        """
+        tport = self.make_transport()
+        tport.session.new = True
+        tport.produce_messages = mock.Mock()
+
+        tport.handle()
+
+        tport.handler.write.assert_called_with('o\n')
+        self.assertFalse(tport.produce_messages.called)
+
+    @mock.patch('gevent.get_hub')
+    def test_poll(self, get_hub):
+        """
+        Polling an open session writes the queued messages.
+        """
+        tport = self.make_transport()
+        tport.session.new = False
+        tport.session.coalescer = None
+        tport.session.get_messages.return_value = ['foo']
+
+        tport.handle()
+
+        tport.session.get_messages.assert_called_with(timeout=tport.timeout)
+        tport.handler.write.assert_called_with('a["foo"]\n')
+
+    def test_jsonp_callback_required(self):
+        """
+        JSONPolling without a callback must not touch the session.
+        """
+        handler = mock.Mock()
+        handler.handle_options.return_value = False
+        session = mock.Mock()
+
+        tport = transport.JSONPolling(session, handler, {})
+
+        tport.handle()
+
+        self.assertTrue(handler.internal_error.called)
+        self.assertFalse(session.lock.called)
+
+
+class FrameTestCase(unittest.TestCase):
+    """
+    Tests for the frame encoding and buffering of the transports.
+    """
+
+    def make_transport(self, klass, environ=None):
+        session = mock.Mock()
+        session.conn = None
+
+        return klass(session, mock.Mock(), environ or {})
+
+    def test_encode_frame(self):
+        """
+        Frames must be wrapped as the protocol demands.
+        """
+        def encode(klass, data, **attrs):
+            tport = self.make_transport(klass)
+
+            for name, value in attrs.iteritems():
+                setattr(tport, name, value)
+
+            return tport.encode_frame(data)
+
+        self.assertEqual(encode(transport.XHRPolling, 'o'), 'o\n')
+        self.assertEqual(encode(transport.XHRStreaming, 'o'), 'o\n')
+        self.assertEqual(
+            encode(transport.EventSource, 'o'), 'data: o\r\n\r\n')
+        self.assertEqual(
+            encode(transport.JSONPolling, 'a["x"]', callback='cb'),
+            'cb("a[\\"x\\"]");\r\n'
+        )
+        self.assertEqual(
+            encode(transport.HTMLFile, 'a["x"]'),
+            '<script>\np("a[\\"x\\"]");\n</script>\r\n'
+        )
+
+    def test_htmlfile_escape(self):
+        """
+        Messages can not break out of the string literal or the script block.
+        """
+        tport = self.make_transport(transport.HTMLFile)
+
+        tport.queue_message_frame(['\\"</script>'])
+
+        self.assertEqual(
+            ''.join(tport.frames),
+            '<script>\np("a[\\"\\\\\\\\\\\\\\"\\u003c/script>\\"]");\n'
+            '</script>\r\n'
+        )
+
+    def test_queue_message_frame(self):
+        """
+        Message frames queued in pieces must match the frames built whole.
+        """
+        encoded = protocol.EncodedMessage({'foo': '"bar"\\'})
+        messages = ['x', encoded, 1]
+        frame = protocol.message_frame(*messages)
+
+        for klass in (transport.XHRPolling, transport.JSONPolling,
+                      transport.EventSource, transport.HTMLFile):
+            tport = self.make_transport(klass)
+            tport.callback = 'cb'
+
+            tport.queue_message_frame(messages)
+
+            self.assertEqual(''.join(tport.frames), tport.encode_frame(frame))
+
+    def test_shared_frame(self):
+        """
+        The frame of a single broadcast message is built once per framing.
+        """
+        encoded = protocol.EncodedMessage('"foo"')
+
+        for klass in (transport.XHRStreaming, transport.EventSource,
+                      transport.HTMLFile):
+            first = self.make_transport(klass)
+            second = self.make_transport(klass)
+
+            first.queue_message_frame([encoded])
+            second.queue_message_frame([encoded])
+
+            self.assertEqual(
+                first.frames,
+                [first.encode_frame(protocol.message_frame(encoded))]
+            )
+            self.assertIs(first.frames[0], second.frames[0])
+
+        self.assertEqual(len(encoded.cache), 4)
+
+    def test_jsonp_frame_not_shared(self):
+        """
+        Only the escaped message of a jsonp frame is shared, the callback is
+        specific to the client.
+        """
+        encoded = protocol.EncodedMessage('foo')
+        frames = []
+
+        for callback in ('cb1', 'cb2'):
+            tport = self.make_transport(transport.JSONPolling)
+            tport.callback = callback
+
+            tport.queue_message_frame([encoded])
+
+            frames.append(''.join(tport.frames))
+
+        self.assertEqual(frames, [
+            'cb1("a[\\"foo\\"]");\r\n',
+            'cb2("a[\\"foo\\"]");\r\n',
+        ])
+        self.assertEqual(encoded.cache.keys(), [protocol.escape_js])
+
+    def test_deque_session(self):
+        """
+        The deque of messages from a ``DequeSession`` must be framed.
+        """
+        from sockjs_gevent.session import DequeSession
+
+        s = DequeSession('foo')
+        s.add_messages('foo', 'bar')
+
+        tport = transport.XHRPolling(s, mock.Mock(), {})
+        tport.write_message_frame(s.get_messages(timeout=0))
+
+        tport.handler.write.assert_called_once_with('a["foo", "bar"]\n')
+
+    def test_flush_coalesces(self):
+        """
+        Queued frames must be written to the handler in a single write.
+        """
+        tport = self.make_transport(transport.XHRStreaming)
+
+        tport.queue_frame('o')
+        tport.queue_frame('a["foo"]')
+        tport.queue_frame('h')
+
+        self.assertFalse(tport.handler.write.called)
+
+        tport.flush()
+
+        tport.handler.write.assert_called_once_with('o\na["foo"]\nh\n')
+        self.assertEqual(tport.frames, [])
+
+    def test_flush_empty(self):
+        tport = self.make_transport(transport.XHRStreaming)
+
+        tport.flush()
+
+        self.assertFalse(tport.handler.write.called)
+
+    @mock.patch('gevent.get_hub')
+    def test_streaming_first_write(self, get_hub):
+        """
+        The prelude and the open frame of a new streaming session must go out
+        in the same write.
+        """
+        handler = mock.Mock()
+        handler.handle_options.return_value = False
+        handler.response_length = 0
+        session = mock.Mock()
+        session.conn = None
+        session.new = True
+        session.closed = False
+        session.opened = True
+        session.coalescer = None
+
+        tport = transport.XHRStreaming(session, handler, {})
+
+        def get_messages(timeout=None):
+            # end the response after the first batch
+            session.opened = False
+
+            return ['foo']
+
+        session.get_messages.side_effect = get_messages
+
+        tport.handle()
+
+        self.assertEqual(handler.write.call_args_list, [
+            mock.call('h' * 2049 + '\no\n'),
+            mock.call('a["foo"]\n'),
+        ])
+
+    @mock.patch('gevent.get_hub')
+    def test_streaming_overflow(self, get_hub):
+        """
+        The reader attached when the queue overflows is told why the session
+        was closed.
+        """
+        handler = mock.Mock()
+        handler.handle_options.return_value = False
+        handler.response_length = 0
+        session = mock.Mock()
+        session.conn = None
+        session.new = False
+        session.closed = False
+        session.opened = True
+        session.coalescer = None
+
+        tport = transport.XHRStreaming(session, handler, {})
+
+        def get_messages(timeout=None):
+            session.opened = False
+            session.closed = True
+            session.close_status = protocol.CONN_QUEUE_OVERFLOW
+
+            return []
+
+        session.get_messages.side_effect = get_messages
+
+        tport.handle()
+
+        self.assertEqual(
+            handler.write.call_args_list[-1],
+            mock.call('c[3001,"Message queue overflow"]\n')
+        )
+
+
+class GzipTestCase(unittest.TestCase):
+    """
+    Tests for the gzip compression of the streaming transports.
+    """
+
+    def make_transport(self, klass, environ, gzip_streaming=True):
+        handler = mock.Mock()
+        handler.handle_options.return_value = False
+        session = mock.Mock()
+        session.new = True
+        session.closed = False
+        session.opened = True
+        session.coalescer = None
+        session.conn.endpoint = server.Endpoint(gzip_streaming=gzip_streaming)
+
+        def get_messages(timeout=None):
+            # end the response after the first batch
+            session.opened = False
+
+            return ['foo']
+
+        session.get_messages.side_effect = get_messages
+
+        return klass(session, handler, environ)
+
+    def get_headers(self, tport):
+        return tport.handler.start_response.call_args[0][1]
+
+    @mock.patch('gevent.get_hub')
+    def test_gzip(self, get_hub):
+        tport = self.make_transport(
+            transport.XHRStreaming,
+            {'HTTP_ACCEPT_ENCODING': 'gzip, deflate'}
+        )
+
+        tport.handle()
+
+        headers = self.get_headers(tport)
+
+        self.assertIn(('Content-Encoding', 'gzip'), headers)
+        self.assertIn(('Vary', 'Accept-Encoding'), headers)
+
+        writes = [args[0] for args, kwargs in
+                  tport.handler.write.call_args_list]
+        decompressor = zlib.decompressobj(transport.GZIP_WBITS)
+
+        # every write can be decoded as soon as it arrives
+        self.assertEqual(
+            decompressor.decompress(writes[0]),
+            'h' * 2049 + '\no\n'
+        )
+        self.assertEqual(decompressor.decompress(writes[1]), 'a["foo"]\n')
+
+        decompressor.decompress(''.join(writes[2:]))
+
+        self.assertEqual(decompressor.unused_data, '')
+        self.assertIsNone(tport.compressor)
+        self.assertLess(len(writes[0]), 100)
+
+    @mock.patch('gevent.get_hub')
+    def test_not_accepted(self, get_hub):
+        tport = self.make_transport(
+            transport.EventSource,
+            {'HTTP_ACCEPT_ENCODING': 'gzip;q=0'}
+        )
+
+        tport.handle()
+
+        headers = self.get_headers(tport)
+
+        self.assertNotIn(('Content-Encoding', 'gzip'), headers)
+        self.assertIn(('Vary', 'Accept-Encoding'), headers)
+        self.assertEqual(tport.handler.write.call_args_list, [
+            mock.call('\r\ndata: o\r\n\r\n'),
+            mock.call('data: a["foo"]\r\n\r\n'),
+        ])
+
+    @mock.patch('gevent.get_hub')
+    def test_disabled(self, get_hub):
+        tport = self.make_transport(
+            transport.XHRStreaming,
+            {'HTTP_ACCEPT_ENCODING': 'gzip'},
+            gzip_streaming=False
+        )
+
+        tport.handle()
+
+        headers = self.get_headers(tport)
+
+        self.assertNotIn(('Content-Encoding', 'gzip'), headers)
+        self.assertNotIn(('Vary', 'Accept-Encoding'), headers)
+
+    def test_response_limit(self):
+        """
+        The response limit counts the bytes before compression.
+        """
+        tport = self.make_transport(
+            transport.XHRStreaming,
+            {'HTTP_ACCEPT_ENCODING': 'gzip'}
+        )
+
+        tport.start_response()
+        tport.write('x' * 1000)
+
+        self.assertEqual(tport.raw_length, 1000)
+
+
+class HeartbeatTestCase(unittest.TestCase):
+    """
+    Tests for the heartbeats of the http transports.
+    """
+
+    def make_transport(self):
+        session = mock.Mock()
+        session.conn = None
+
+        return transport.XHRStreaming(session, mock.Mock(), {})
+
+    def test_send_heartbeat(self):
+        tport = self.make_transport()
+
+        tport.send_heartbeat()
+
+        tport.handler.write.assert_called_once_with('h\n')
+        self.assertFalse(tport.write_lock.locked())
+
+    def test_heartbeat_while_writing(self):
+        tport = self.make_transport()
+
+        with tport.write_lock:
+            tport.send_heartbeat()
+
+        self.assertFalse(tport.handler.write.called)
+        self.assertEqual(tport.frames, [])
+
+
+class CoalesceTestCase(unittest.TestCase):
+    """
+    Tests for ``transport.BaseTransport.get_messages``
+    """
+
+    def make_transport(self, coalescer):
+        session = mock.Mock()
+        session.coalescer = coalescer
+
+        return transport.BaseTransport(session, mock.Mock(), {})
+
+    def test_no_coalescer(self):
+        tport = self.make_transport(None)
+        tport.session.get_messages.return_value = ['foo']
+
+        self.assertEqual(tport.get_messages(timeout=5), ['foo'])
+        tport.session.get_messages.assert_called_once_with(timeout=5)
+
+    @mock.patch('gevent.sleep')
+    def test_no_delay(self, sleep):
+        """
+        When the coalescer does not ask for a delay, the messages are returned
+        straight away.
+        """
+        coalescer = mock.Mock()
+        coalescer.get_delay.return_value = 0
+
+        tport = self.make_transport(coalescer)
+        tport.session.get_messages.return_value = ['foo']
+
+        self.assertEqual(tport.get_messages(timeout=5), ['foo'])
+
+        coalescer.get_delay.assert_called_with(1)
+        coalescer.record.assert_called_with(1)
+        self.assertFalse(sleep.called)
+
+    @mock.patch('gevent.sleep')
+    def test_delay(self, sleep):
+        """
+        Messages that arrive during the delay must join the batch.
+        """
+        coalescer = mock.Mock()
+        coalescer.get_delay.return_value = 0.005
+
+        tport = self.make_transport(coalescer)
+        tport.session.get_messages.side_effect = [['foo'], ['bar', 'baz']]
+
+        messages = tport.get_messages(timeout=5)
+
+        self.assertEqual(messages, ['foo', 'bar', 'baz'])
+        sleep.assert_called_with(0.005)
+        tport.session.get_messages.assert_called_with(timeout=0)
+        coalescer.record.assert_called_with(3)
+
+
+class RawWebSocketTestCase(unittest.TestCase):
+    """
+    Tests for ``transport.RawWebSocket``
+    """
+
+    def make_transport(self, environ, klass=transport.RawWebSocket):
+        handler = mock.Mock()
+        handler.handle_options.return_value = False
+        handler.stream.written = []
+        handler.stream.write.side_effect = handler.stream.written.append
+
+        session = mock.Mock()
+        session.conn = None
+
+        return klass(session, handler, environ)
+
+    def test_bad_handshake(self):
+        """
+        A failed handshake must respond with a 400 before the session is
+        touched.
+        """
+        tport = self.make_transport({})
+
+        tport.handle()
+
+        tport.handler.bad_request.assert_called_with(
+            'Can "Upgrade" only to "WebSocket".', headers=[])
+        self.assertFalse(tport.session.lock.called)
+        self.assertIsNone(tport.websocket)
+
+    def test_handshake(self):
+        """
+        A successful handshake upgrades the connection.
+        """
+        tport = self.make_transport({
+            'HTTP_UPGRADE': 'websocket',
+            'HTTP_CONNECTION': 'Upgrade',
+            'HTTP_SEC_WEBSOCKET_VERSION': '13',
+            'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+        })
+
+        self.assertIsNot(tport.prepare_request(), False)
+
+        self.assertTrue(tport.handler.close_connection)
+        self.assertIsNotNone(tport.websocket)
+        self.assertTrue(tport.handler.stream.written[0].startswith(
+            'HTTP/1.1 101 Switching Protocols\r\n'))
+
+    def make_environ(self, **headers):
+        environ = {
+            'HTTP_UPGRADE': 'websocket',
+            'HTTP_CONNECTION': 'Upgrade',
+            'HTTP_SEC_WEBSOCKET_VERSION': '13',
+            'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+        }
+
+        environ.update(headers)
+
+        return environ
+
+    def make_deflate_transport(self, shared_frames=False,
+                               klass=transport.WebSocket):
+        environ = self.make_environ(
+            HTTP_SEC_WEBSOCKET_EXTENSIONS='permessage-deflate')
+        tport = self.make_transport(environ, klass)
+
+        endpoint = server.Endpoint(
+            permessage_deflate=True,
+            deflate_shared_frames=shared_frames
+        )
+
+        tport.session.conn = mock.Mock()
+        tport.session.conn.endpoint = endpoint
+
+        self.assertIsNot(tport.prepare_request(), False)
+
+        return tport
+
+    def test_handshake_deflate(self):
+        """
+        permessage-deflate is negotiated when the endpoint enables it.
+        """
+        tport = self.make_deflate_transport(klass=transport.RawWebSocket)
+
+        self.assertIn(
+            'Sec-WebSocket-Extensions: permessage-deflate\r\n',
+            tport.handler.stream.written[0]
+        )
+        self.assertIs(tport.websocket.deflate, tport.deflate)
+        self.assertFalse(tport.shared_frames)
+
+    def test_shared_frames(self):
+        """
+        A broadcast message is compressed once for all sessions.
+        """
+        message = protocol.EncodedMessage(['foo'] * 50)
+        first = self.make_deflate_transport(shared_frames=True)
+        second = self.make_deflate_transport(shared_frames=True)
+
+        self.assertTrue(first.shared_frames)
+
+        with mock.patch.object(websocket.PerMessageDeflate, 'compress') as m:
+            m.return_value = 'compressed'
+
+            first.send_messages([message])
+            second.send_messages([message])
+
+        self.assertEqual(m.call_count, 1)
+
+        for tport in (first, second):
+            self.assertEqual(
+                tport.handler.stream.written[-1],
+                '\xc1\x0acompressed'
+            )
+
+    def test_shared_frames_payload(self):
+        message = protocol.EncodedMessage(['foo'] * 50)
+        tport = self.make_deflate_transport(shared_frames=True)
+
+        tport.send_messages([message])
+
+        payload = tport.handler.stream.written[-1][2:]
+
+        self.assertEqual(
+            websocket.PerMessageDeflate().decompress(payload, 1000),
+            protocol.message_frame(message)
+        )
+
+    def test_raw_heartbeat(self):
+        """
+        Raw websockets only carry application messages.
+        """
+        tport = self.make_transport(self.make_environ())
+        tport.prepare_request()
+
+        tport.send_heartbeat()
+
+        self.assertEqual(len(tport.handler.stream.written), 1)
+
+    def test_heartbeat(self):
+        tport = self.make_transport(self.make_environ(), transport.WebSocket)
+        tport.prepare_request()
+
+        tport.send_heartbeat()
+
+        self.assertEqual(tport.handler.stream.written[-1], '\x81\x01h')
+
+    def test_heartbeat_while_writing(self):
+        """
+        No heartbeat is interleaved with the writes of the request greenlet.
+        """
+        tport = self.make_transport(self.make_environ(), transport.WebSocket)
+        tport.prepare_request()
+
+        with tport.write_lock:
+            tport.send_heartbeat()
+
+        self.assertEqual(len(tport.handler.stream.written), 1)
+        self.assertFalse(tport.write_lock.locked())
+
+
+def make_binary_codec():
+    """
+    A stand in for msgpack that prefixes JSON with a marker byte.
+    """
+    def decode(data):
+        if data[:1] != '\x00':
+            raise ValueError(data)
+
+        return json.loads(data[1:])
+
+    return codec.Codec(
+        'x-test-binary',
+        lambda message: '\x00' + json.dumps(message),
+        decode
+    )
+
+
+class BinaryProtocolTestCase(unittest.TestCase):
+    """
+    Tests for the binary subprotocols of ``transport.RawWebSocket``
+    """
+
+    def make_transport(self, binary_codec=None, requested='x-test-binary',
+                       klass=transport.RawWebSocket):
+        environ = {
+            'HTTP_UPGRADE': 'websocket',
+            'HTTP_CONNECTION': 'Upgrade',
+            'HTTP_SEC_WEBSOCKET_VERSION': '13',
+            'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+        }
+
+        if requested:
+            environ['HTTP_SEC_WEBSOCKET_PROTOCOL'] = requested
+
+        handler = mock.Mock()
+        handler.stream.written = []
+        handler.stream.write.side_effect = handler.stream.written.append
+
+        session = mock.Mock()
+        session.conn.endpoint = server.Endpoint(
+            binary_protocols=[binary_codec or make_binary_codec()]
+        )
+
+        tport = klass(session, handler, environ)
+
+        self.assertIsNot(tport.prepare_request(), False)
+
+        return tport
+
+    def test_negotiate(self):
+        tport = self.make_transport()
+
+        self.assertEqual(tport.binary_codec.name, 'x-test-binary')
+        self.assertIn(
+            'Sec-WebSocket-Protocol: x-test-binary\r\n',
+            tport.handler.stream.written[0]
+        )
+
+    def test_not_requested(self):
+        """
+        Clients that do not ask for the subprotocol get plain text frames.
+        """
+        tport = self.make_transport(requested=None)
+
+        self.assertIsNone(tport.binary_codec)
+        self.assertNotIn('Sec-WebSocket-Protocol',
+                         tport.handler.stream.written[0])
+
+        tport.send_messages(['foo'])
+
+        self.assertEqual(tport.handler.stream.written[-1], '\x81\x03foo')
+
+    def test_sockjs_websocket(self):
+        """
+        The SockJS framed websocket transport never negotiates one.
+        """
+        tport = self.make_transport(klass=transport.WebSocket)
+
+        self.assertIsNone(tport.binary_codec)
+
+    def test_send(self):
+        tport = self.make_transport()
+
+        tport.send_messages([{'foo': 'bar'}])
+
+        self.assertEqual(
+            tport.handler.stream.written[-1],
+            '\x82\x0f\x00{"foo": "bar"}'
+        )
+
+    def test_send_shared(self):
+        """
+        A broadcast is encoded once for every session using the codec.
+        """
+        binary_codec = make_binary_codec()
+        encode = binary_codec.encode = mock.Mock(return_value='\x00[]')
+        message = protocol.EncodedMessage(['foo'])
+
+        first = self.make_transport(binary_codec)
+        second = self.make_transport(binary_codec)
+
+        first.send_messages([message])
+        second.send_messages([message])
+
+        encode.assert_called_once_with(['foo'])
+
+        for tport in (first, second):
+            self.assertEqual(tport.handler.stream.written[-1],
+                             '\x82\x03\x00[]')
+
+    def test_dispatch(self):
+        tport = self.make_transport()
+
+        tport.dispatch_message('\x00{"foo": "bar"}')
+
+        tport.session.dispatch.assert_called_once_with({u'foo': u'bar'})
+
+    def test_dispatch_text(self):
+        """
+        Text frames are not valid once a binary subprotocol is negotiated.
+        """
+        tport = self.make_transport()
+
+        tport.dispatch_message(u'{"foo": "bar"}')
+
+        self.assertFalse(tport.session.dispatch.called)
+        self.assertTrue(tport.websocket.closed)
+        self.assertEqual(tport.handler.stream.written[-1], '\x88\x02\x03\xeb')
+
+    def test_dispatch_invalid(self):
+        tport = self.make_transport()
+
+        tport.dispatch_message('{"foo": "bar"}')
+
+        self.assertFalse(tport.session.dispatch.called)
+        self.assertEqual(tport.handler.stream.written[-1], '\x88\x02\x03\xef')
@@ -8,8 +8,13 @@ try:
 except ImportError:
     from StringIO import StringIO
 
+import Cookie
+import itertools
+import random
 from datetime import datetime
 
+import mock
+
 from sockjs_gevent import util
 
 
@@ -386,3 +391,259 @@ class WriteTestCase(BaseHandlerTestCase):
         self.assertEqual(result, app.out.write)
         self.assertEqual(app.out.getvalue(), '')
         app.assertStatus('500 Internal Server Error')
+
+
+class AcceptsEncodingTestCase(unittest.TestCase):
+    """
+    Tests for `util.accepts_encoding`
+    """
+
+    def accepts(self, header):
+        environ = {}
+
+        if header is not None:
+            environ['HTTP_ACCEPT_ENCODING'] = header
+
+        return util.accepts_encoding(environ, 'gzip')
+
+    def test_accepted(self):
+        self.assertTrue(self.accepts('gzip'))
+        self.assertTrue(self.accepts('deflate, GZIP;q=0.5'))
+        self.assertTrue(self.accepts('*'))
+
+    def test_refused(self):
+        self.assertFalse(self.accepts(None))
+        self.assertFalse(self.accepts(''))
+        self.assertFalse(self.accepts('deflate, br'))
+        self.assertFalse(self.accepts('gzip;q=0'))
+        self.assertFalse(self.accepts('gzip;q=0.0, *'))
+        self.assertFalse(self.accepts('gzip;q=x'))
+        self.assertFalse(self.accepts('*, gzip;q=0'))
+
+
+class CachedHeadersTestCase(unittest.TestCase):
+    """
+    Tests for `util.CachedHeaders`
+    """
+
+    def test_refresh(self):
+        clock = [100.0]
+        built = []
+
+        def build():
+            built.append(clock[0])
+
+            return [('Expires', str(clock[0]))]
+
+        cached = util.CachedHeaders(build, clock=lambda: clock[0])
+
+        self.assertEqual(cached.get(), (('Expires', '100.0'),))
+
+        clock[0] = 100.9
+        self.assertEqual(cached.get(), (('Expires', '100.0'),))
+
+        clock[0] = 101.0
+        self.assertEqual(cached.get(), (('Expires', '101.0'),))
+        self.assertEqual(built, [100.0, 101.0])
+
+    def test_get_headers(self):
+        """
+        Cached responses share the same cache headers.
+        """
+        build = mock.Mock(return_value=[('Expires', 'now')])
+        cached = util.CachedHeaders(build, clock=lambda: 0)
+
+        with mock.patch.object(util, 'CACHE_HEADERS', cached):
+            first = util.get_headers({}, cache=True)
+            second = util.get_headers({}, cache=True)
+
+        self.assertEqual(first, [('Expires', 'now')])
+        self.assertEqual(second, [('Expires', 'now')])
+        self.assertEqual(build.call_count, 1)
+
+
+class HeaderTemplateTestCase(unittest.TestCase):
+    """
+    Tests for `util.get_headers` and `util.HeaderTemplate`
+    """
+
+    def build_headers(self, environ, content_type, cors, cache, cookie):
+        """
+        Build the headers one piece at a time, as ``get_headers`` did before
+        it was templated.
+        """
+        headers = []
+
+        if content_type:
+            if ';' not in content_type:
+                content_type += '; encoding=UTF-8'
+
+            headers.append(('Content-Type', content_type))
+
+        if cors:
+            util.enable_cors(environ, headers)
+
+        if cache is not None:
+            if cache:
+                headers.extend(util.make_cache_headers())
+            else:
+                util.disable_cache(headers)
+
+        if cookie:
+            util.enable_cookie(environ, headers)
+
+        return headers
+
+    def test_identical(self):
+        environs = [
+            {},
+            {
+                'HTTP_ORIGIN': 'http://example.com',
+                'HTTP_ACCESS_CONTROL_REQUEST_HEADERS': 'x-foo',
+                'HTTP_COOKIE': 'JSESSIONID=abc; foo=bar',
+            },
+            {'HTTP_ORIGIN': 'null'},
+        ]
+        cached = util.CachedHeaders(util.make_cache_headers, clock=lambda: 0)
+
+        combinations = itertools.product(
+            [None, 'text/plain', 'text/html; x=y'],
+            [False, True],
+            [None, False, True],
+            [False, True]
+        )
+
+        with mock.patch.object(util, 'CACHE_HEADERS', cached):
+            for args in combinations:
+                for environ in environs:
+                    self.assertEqual(
+                        util.get_headers(environ, *args),
+                        self.build_headers(environ, *args)
+                    )
+
+    def test_memoized(self):
+        template = util.get_header_template('text/plain', cors=True)
+
+        self.assertIs(util.get_header_template('text/plain', True), template)
+        self.assertIsNot(util.get_header_template('text/html'), template)
+
+    def test_new_list(self):
+        """
+        The rendered headers may be extended by the caller.
+        """
+        first = util.get_headers({}, content_type='text/plain')
+        first.append(('X-Foo', 'bar'))
+
+        self.assertEqual(
+            util.get_headers({}, content_type='text/plain'),
+            [('Content-Type', 'text/plain; encoding=UTF-8')]
+        )
+
+
+def simple_cookie_session(header):
+    """
+    The ``JSESSIONID`` morsel as the original ``SimpleCookie`` based
+    ``enable_cookie`` produced it.
+    """
+    cookies = Cookie.SimpleCookie(header)
+
+    c = cookies.get('JSESSIONID')
+
+    if not c:
+        cookies['JSESSIONID'] = 'dummy'
+
+        c = cookies.get('JSESSIONID')
+
+    c['path'] = '/'
+
+    return c.OutputString()
+
+
+class SessionCookieTestCase(unittest.TestCase):
+    """
+    Tests for `util.get_session_cookie`
+    """
+
+    headers = [
+        None,
+        '',
+        'foo=bar',
+        'JSESSIONID=abc',
+        'JSESSIONID=',
+        ' JSESSIONID=abc ; ',
+        'foo=bar; JSESSIONID=abc.def-1:2; baz=qux',
+        'JSESSIONID=abc; JSESSIONID=def',
+        'jsessionid=abc',
+        'XJSESSIONID=abc',
+        'JSESSIONIDX=abc',
+        'JSESSIONID="quoted value"',
+        'JSESSIONID=a=b',
+        'JSESSIONID=abc; Path=/foo; Domain=example.com',
+        'JSESSIONID=abc; $Path=/foo',
+        'JSESSIONID=abc; secure; HttpOnly',
+        'foo="x; JSESSIONID=abc"',
+        'foo=1 JSESSIONID=abc',
+        'JSESSIONID=abc;;foo=bar',
+        'JSESSIONID=[abc]',
+        'a=' + 'x' * 4096 + '; JSESSIONID=abc',
+    ]
+
+    def test_identical(self):
+        for header in self.headers:
+            self.assertEqual(
+                util.get_session_cookie(header),
+                simple_cookie_session(header),
+                header
+            )
+
+    def test_fuzz(self):
+        rand = random.Random(42)
+        pieces = [
+            'JSESSIONID', '=', ';', ' ', '"', '$', 'a', '1', ',', '\\',
+            'path', 'Path=/', 'secure', '[', ':', '~'
+        ]
+
+        for i in xrange(5000):
+            header = ''.join(
+                rand.choice(pieces) for j in xrange(rand.randint(1, 12))
+            )
+
+            try:
+                expected = simple_cookie_session(header)
+            except Cookie.CookieError:
+                expected = util.DEFAULT_SESSION_COOKIE
+
+            self.assertEqual(
+                util.get_session_cookie(header),
+                expected,
+                header
+            )
+
+    def test_fast_path(self):
+        """
+        Plain headers must not be parsed by ``SimpleCookie``.
+        """
+        with mock.patch.object(util.Cookie, 'SimpleCookie') as simple_cookie:
+            result = util.get_session_cookie('foo=bar; JSESSIONID=abc')
+
+        self.assertEqual(result, 'JSESSIONID=abc; Path=/')
+        self.assertFalse(simple_cookie.called)
+
+    def test_unparseable(self):
+        """
+        Headers that ``SimpleCookie`` chokes on get the dummy cookie.
+        """
+        self.assertEqual(
+            util.get_session_cookie('foo@bar=1; JSESSIONID=abc'),
+            util.DEFAULT_SESSION_COOKIE
+        )
+
+    def test_other_cookies(self):
+        """
+        Only the session cookie is sent back.
+        """
+        headers = []
+
+        util.enable_cookie({'HTTP_COOKIE': 'foo=bar; JSESSIONID=abc'}, headers)
+
+        self.assertEqual(headers, [('Set-Cookie', 'JSESSIONID=abc; Path=/')])
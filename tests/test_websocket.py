@@ -0,0 +1,571 @@
+"""
+Tests for ``sockjs_gevent.websocket``
+"""
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import struct
+
+import gevent
+
+from sockjs_gevent import websocket
+
+
+def make_frame(payload, opcode=websocket.OPCODE_TEXT, fin=True, rsv=0,
+               mask='\x01\x02\x03\x04'):
+    """
+    Build a frame as a client would send it.
+    """
+    first = opcode | rsv
+
+    if fin:
+        first |= websocket.FIN
+
+    length = len(payload)
+
+    if length < 126:
+        header = struct.pack('!BB', first, 0x80 | length)
+    elif length < 0x10000:
+        header = struct.pack('!BBH', first, 0x80 | 126, length)
+    else:
+        header = struct.pack('!BBQ', first, 0x80 | 127, length)
+
+    masked = ''.join(
+        chr(ord(c) ^ ord(mask[i % 4])) for i, c in enumerate(payload)
+    )
+
+    return header + mask + masked
+
+
+class Stream(object):
+    """
+    A fake client connection.
+    """
+
+    def __init__(self, data=''):
+        self.data = data
+        self.written = []
+
+    def read(self, size):
+        chunk, self.data = self.data[:size], self.data[size:]
+
+        return chunk
+
+    def write(self, data):
+        self.written.append(data)
+
+    def get_output(self):
+        return ''.join(self.written)
+
+
+class HandshakeTestCase(unittest.TestCase):
+    """
+    Tests for ``websocket.handshake``
+    """
+
+    def make_environ(self, **headers):
+        environ = {
+            'HTTP_UPGRADE': 'websocket',
+            'HTTP_CONNECTION': 'Upgrade',
+            'HTTP_SEC_WEBSOCKET_VERSION': '13',
+            'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+        }
+
+        environ.update(headers)
+
+        return environ
+
+    def test_accept_key(self):
+        """
+        The example from RFC 6455.
+        """
+        self.assertEqual(
+            websocket.get_accept_key('dGhlIHNhbXBsZSBub25jZQ=='),
+            's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+        )
+
+    def test_handshake(self):
+        stream = Stream()
+
+        result = websocket.handshake(self.make_environ(), stream.write)
+
+        self.assertIsNone(result)
+        self.assertEqual(stream.get_output(), '\r\n'.join([
+            'HTTP/1.1 101 Switching Protocols',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=',
+            '',
+            ''
+        ]))
+
+    def test_connection_tokens(self):
+        """
+        Firefox sends ``Connection: keep-alive, Upgrade``.
+        """
+        stream = Stream()
+        environ = self.make_environ(HTTP_CONNECTION='keep-alive, Upgrade')
+
+        websocket.handshake(environ, stream.write)
+
+        self.assertTrue(stream.written)
+
+    def test_bad_upgrade(self):
+        environ = self.make_environ(HTTP_UPGRADE='foo')
+
+        with self.assertRaises(websocket.HandshakeError) as ctx:
+            websocket.handshake(environ, Stream().write)
+
+        self.assertEqual(
+            str(ctx.exception),
+            'Can "Upgrade" only to "WebSocket".'
+        )
+
+    def test_bad_connection(self):
+        environ = self.make_environ(HTTP_CONNECTION='close')
+
+        with self.assertRaises(websocket.HandshakeError) as ctx:
+            websocket.handshake(environ, Stream().write)
+
+        self.assertEqual(str(ctx.exception), '"Connection" must be "Upgrade".')
+
+    def test_bad_version(self):
+        environ = self.make_environ(HTTP_SEC_WEBSOCKET_VERSION='6')
+
+        with self.assertRaises(websocket.HandshakeError) as ctx:
+            websocket.handshake(environ, Stream().write)
+
+        self.assertEqual(ctx.exception.headers, [
+            ('Sec-WebSocket-Version', '13')
+        ])
+
+    def test_bad_key(self):
+        for key in ['', 'foo', 'Zm9v']:
+            environ = self.make_environ(HTTP_SEC_WEBSOCKET_KEY=key)
+
+            self.assertRaises(
+                websocket.HandshakeError,
+                websocket.handshake,
+                environ,
+                Stream().write
+            )
+
+    def test_protocol(self):
+        stream = Stream()
+        environ = self.make_environ(HTTP_SEC_WEBSOCKET_PROTOCOL='foo, bar')
+
+        result = websocket.handshake(environ, stream.write, ['bar', 'foo'])
+
+        self.assertEqual(result, 'bar')
+        self.assertIn('Sec-WebSocket-Protocol: bar\r\n', stream.get_output())
+
+
+class MaskTestCase(unittest.TestCase):
+    """
+    Tests for ``websocket.mask_payload``
+    """
+
+    def test_mask(self):
+        mask = '\x8a\x01\xff\x10'
+
+        for length in [0, 1, 3, 4, 5, 127, 1000]:
+            data = ''.join(chr(i % 256) for i in xrange(length))
+            expected = ''.join(
+                chr(ord(c) ^ ord(mask[i % 4])) for i, c in enumerate(data)
+            )
+
+            self.assertEqual(websocket.mask_payload(mask, data), expected)
+
+    def test_leading_zeros(self):
+        """
+        Bytes that xor to zero at the start of the payload must be kept.
+        """
+        mask = 'abcd'
+
+        self.assertEqual(websocket.mask_payload(mask, 'abcde'), '\0\0\0\0\x04')
+
+
+class WebSocketTestCase(unittest.TestCase):
+    """
+    Tests for ``websocket.WebSocket``
+    """
+
+    def make_websocket(self, *frames):
+        stream = Stream(''.join(frames))
+
+        return websocket.WebSocket(stream), stream
+
+    def test_receive_text(self):
+        ws, stream = self.make_websocket(make_frame('caf\xc3\xa9'))
+
+        self.assertEqual(ws.receive(), u'caf\xe9')
+
+    def test_receive_binary(self):
+        ws, stream = self.make_websocket(
+            make_frame('\x00\xff', websocket.OPCODE_BINARY))
+
+        self.assertEqual(ws.receive(), '\x00\xff')
+
+    def test_receive_lengths(self):
+        """
+        Extended payload lengths must be parsed.
+        """
+        for length in [125, 126, 65535, 65536]:
+            payload = 'x' * length
+            ws, stream = self.make_websocket(make_frame(payload))
+
+            self.assertEqual(ws.receive(), payload)
+
+    def test_fragmented(self):
+        """
+        Fragments are assembled in the reusable buffer.
+        """
+        ws, stream = self.make_websocket(
+            make_frame('foo', fin=False),
+            make_frame('', websocket.OPCODE_PING),
+            make_frame('bar', websocket.OPCODE_CONTINUATION),
+            make_frame('baz'),
+        )
+
+        buf = ws.buffer
+
+        self.assertEqual(ws.receive(), u'foobar')
+        self.assertEqual(ws.receive(), u'baz')
+        self.assertIs(ws.buffer, buf)
+        self.assertEqual(len(buf), 0)
+
+    def test_ping(self):
+        """
+        A ping must be answered with a pong carrying the same payload.
+        """
+        ws, stream = self.make_websocket(
+            make_frame('hi', websocket.OPCODE_PING),
+            make_frame('foo'),
+        )
+
+        self.assertEqual(ws.receive(), u'foo')
+        self.assertEqual(stream.get_output(), '\x8a\x02hi')
+
+    def test_close(self):
+        """
+        A close frame is echoed and ``receive`` returns ``None``.
+        """
+        ws, stream = self.make_websocket(
+            make_frame(struct.pack('!H', 1001), websocket.OPCODE_CLOSE))
+
+        self.assertIsNone(ws.receive())
+        self.assertTrue(ws.closed)
+        self.assertEqual(ws.close_code, 1001)
+        self.assertEqual(stream.get_output(), '\x88\x02\x03\xe9')
+
+        # subsequent calls do not touch the connection
+        self.assertIsNone(ws.receive())
+
+    def test_connection_closed(self):
+        ws, stream = self.make_websocket(make_frame('foo')[:4])
+
+        self.assertRaises(websocket.ConnectionClosed, ws.receive)
+
+    def test_unmasked(self):
+        ws, stream = self.make_websocket('\x81\x03foo')
+
+        self.assertRaises(websocket.ProtocolError, ws.receive)
+        self.assertEqual(stream.get_output()[:4], '\x88\x1e\x03\xea')
+        self.assertTrue(ws.closed)
+
+    def test_reserved_bits(self):
+        ws, stream = self.make_websocket(make_frame('foo', rsv=0x40))
+
+        self.assertRaises(websocket.ProtocolError, ws.receive)
+
+    def test_invalid_utf8(self):
+        ws, stream = self.make_websocket(make_frame('\xff'))
+
+        with self.assertRaises(websocket.ProtocolError) as ctx:
+            ws.receive()
+
+        self.assertEqual(ctx.exception.code, websocket.CLOSE_INVALID_DATA)
+
+    def test_unexpected_continuation(self):
+        ws, stream = self.make_websocket(
+            make_frame('foo', websocket.OPCODE_CONTINUATION))
+
+        self.assertRaises(websocket.ProtocolError, ws.receive)
+
+    def test_send(self):
+        ws, stream = self.make_websocket()
+
+        ws.send(u'caf\xe9')
+        ws.send('\x00', binary=True)
+
+        self.assertEqual(stream.written, [
+            '\x81\x05caf\xc3\xa9',
+            '\x82\x01\x00',
+        ])
+
+    def test_send_large(self):
+        """
+        Large payloads are written without being copied into the header.
+        """
+        ws, stream = self.make_websocket()
+        payload = 'x' * 70000
+
+        ws.send(payload)
+
+        self.assertEqual(len(stream.written), 2)
+        self.assertEqual(
+            stream.written[0],
+            '\x81\x7f' + struct.pack('!Q', 70000)
+        )
+        self.assertIs(stream.written[1], payload)
+
+    def test_ping_during_large_send(self):
+        """
+        A pong is not written between the header and the payload of a large
+        frame that another greenlet is sending.
+        """
+        stream = Stream(
+            make_frame('hi', websocket.OPCODE_PING) + make_frame('foo'))
+        ws = websocket.WebSocket(stream)
+        payload = 'x' * 70000
+        readers = []
+
+        def write(data):
+            stream.written.append(data)
+
+            if not readers:
+                # answer the ping while the payload is still to be written
+                readers.append(gevent.spawn(ws.receive))
+                gevent.sleep(0)
+
+        ws.write = write
+
+        ws.send(payload)
+
+        self.assertEqual(readers[0].get(), u'foo')
+        self.assertEqual(stream.written, [
+            '\x81\x7f' + struct.pack('!Q', 70000),
+            payload,
+            '\x8a\x02hi',
+        ])
+
+    def test_send_closed(self):
+        ws, stream = self.make_websocket()
+
+        ws.close()
+
+        self.assertRaises(websocket.WebSocketError, ws.send, 'foo')
+
+    def test_close_once(self):
+        ws, stream = self.make_websocket()
+
+        ws.close(1000, 'bye')
+        ws.close()
+
+        self.assertEqual(stream.written, ['\x88\x05\x03\xe8bye'])
+
+
+class PerMessageDeflateTestCase(unittest.TestCase):
+    """
+    Tests for ``websocket.PerMessageDeflate``
+    """
+
+    def negotiate(self, header, **kwargs):
+        environ = {'HTTP_SEC_WEBSOCKET_EXTENSIONS': header}
+
+        return websocket.PerMessageDeflate.negotiate(environ, **kwargs)
+
+    def test_no_offer(self):
+        self.assertIsNone(websocket.PerMessageDeflate.negotiate({}))
+        self.assertIsNone(self.negotiate('x-webkit-deflate-frame'))
+
+    def test_offer(self):
+        deflate = self.negotiate(
+            'permessage-deflate; client_max_window_bits')
+
+        self.assertEqual(deflate.get_response_header(), 'permessage-deflate')
+        self.assertEqual(deflate.server_max_window_bits, 15)
+        self.assertEqual(deflate.client_max_window_bits, 15)
+        self.assertIsNone(deflate.cache_key)
+
+    def test_window_bits(self):
+        deflate = self.negotiate(
+            'permessage-deflate; server_max_window_bits=12; '
+            'client_max_window_bits',
+            max_window_bits=10
+        )
+
+        self.assertEqual(deflate.server_max_window_bits, 10)
+        self.assertEqual(deflate.client_max_window_bits, 10)
+        self.assertEqual(
+            deflate.get_response_header(),
+            'permessage-deflate; server_max_window_bits=10; '
+            'client_max_window_bits=10'
+        )
+
+    def test_client_window_bits_not_offered(self):
+        """
+        The client window can only be limited if the client offers it.
+        """
+        deflate = self.negotiate('permessage-deflate', max_window_bits=10)
+
+        self.assertEqual(deflate.client_max_window_bits, 15)
+        self.assertEqual(deflate.get_response_header(), 'permessage-deflate')
+
+    def test_no_context_takeover(self):
+        deflate = self.negotiate(
+            'permessage-deflate; client_no_context_takeover',
+            no_context_takeover=True
+        )
+
+        self.assertTrue(deflate.server_no_context_takeover)
+        self.assertTrue(deflate.client_no_context_takeover)
+        self.assertIsNotNone(deflate.cache_key)
+        self.assertEqual(
+            deflate.get_response_header(),
+            'permessage-deflate; server_no_context_takeover; '
+            'client_no_context_takeover'
+        )
+
+    def test_invalid_offer(self):
+        """
+        Invalid offers are skipped in favour of the next one.
+        """
+        deflate = self.negotiate(
+            'permessage-deflate; server_max_window_bits=20, '
+            'permessage-deflate; server_max_window_bits=1=, '
+            'permessage-deflate; foo, '
+            'permessage-deflate; server_no_context_takeover; '
+            'server_no_context_takeover, '
+            'permessage-deflate; server_max_window_bits="11"'
+        )
+
+        self.assertEqual(deflate.server_max_window_bits, 11)
+
+    def test_8_bit_window(self):
+        """
+        zlib can not compress with an 8 bit window, so an offer that asks
+        for one is declined and a configured 8 bit window becomes 9 bits.
+        """
+        deflate = self.negotiate(
+            'permessage-deflate; server_max_window_bits=8, '
+            'permessage-deflate; server_max_window_bits=12',
+            max_window_bits=8
+        )
+
+        self.assertEqual(deflate.server_max_window_bits, 9)
+        self.assertEqual(
+            deflate.get_response_header(),
+            'permessage-deflate; server_max_window_bits=9'
+        )
+
+        self.assertIsNone(self.negotiate(
+            'permessage-deflate; server_max_window_bits=8'))
+
+    def test_round_trip(self):
+        deflate = websocket.PerMessageDeflate()
+        inflate = websocket.PerMessageDeflate()
+
+        for message in ['foo' * 100, 'foo' * 100, '']:
+            payload = deflate.compress(message)
+
+            self.assertFalse(payload.endswith(websocket.DEFLATE_TAIL))
+            self.assertEqual(inflate.decompress(payload, 1000), message)
+
+        # context takeover makes repeated messages cheap
+        self.assertLess(
+            len(deflate.compress('bar' * 100)),
+            len(websocket.PerMessageDeflate().compress('bar' * 100))
+        )
+
+    def test_shared(self):
+        """
+        Without context takeover the same message always compresses to the
+        same payload.
+        """
+        deflate = websocket.PerMessageDeflate(server_no_context_takeover=True)
+        other = websocket.PerMessageDeflate(server_no_context_takeover=True)
+
+        deflate.compress('foo' * 100)
+
+        self.assertEqual(
+            deflate.compress('bar' * 100),
+            other.compress('bar' * 100)
+        )
+        self.assertEqual(deflate.cache_key, other.cache_key)
+
+    def test_too_large(self):
+        payload = websocket.PerMessageDeflate().compress('x' * 1000)
+
+        with self.assertRaises(websocket.ProtocolError) as ctx:
+            websocket.PerMessageDeflate().decompress(payload, 999)
+
+        self.assertEqual(ctx.exception.code, websocket.CLOSE_TOO_LARGE)
+
+    def test_invalid_payload(self):
+        with self.assertRaises(websocket.ProtocolError) as ctx:
+            websocket.PerMessageDeflate().decompress('\xff\xff\xff', 100)
+
+        self.assertEqual(ctx.exception.code, websocket.CLOSE_INVALID_DATA)
+
+
+class DeflateWebSocketTestCase(unittest.TestCase):
+    """
+    Tests for ``websocket.WebSocket`` with permessage-deflate.
+    """
+
+    def make_websocket(self, *frames):
+        stream = Stream(''.join(frames))
+        deflate = websocket.PerMessageDeflate()
+
+        return websocket.WebSocket(stream, deflate=deflate), stream
+
+    def test_receive(self):
+        payload = websocket.PerMessageDeflate().compress('caf\xc3\xa9' * 20)
+        ws, stream = self.make_websocket(
+            make_frame(payload[:5], fin=False, rsv=websocket.RSV1),
+            make_frame(payload[5:], websocket.OPCODE_CONTINUATION),
+            make_frame('foo'),
+        )
+
+        self.assertEqual(ws.receive(), u'caf\xe9' * 20)
+        self.assertEqual(ws.receive(), u'foo')
+
+    def test_reserved_bits(self):
+        """
+        Only the first frame of a message may have RSV1 set.
+        """
+        ws, stream = self.make_websocket(
+            make_frame('foo', fin=False),
+            make_frame('foo', websocket.OPCODE_CONTINUATION,
+                       rsv=websocket.RSV1),
+        )
+
+        self.assertRaises(websocket.ProtocolError, ws.receive)
+
+    def test_send(self):
+        ws, stream = self.make_websocket()
+        message = 'foo' * 100
+
+        ws.send('foo')
+        ws.send(message)
+
+        self.assertEqual(stream.written[0], '\x81\x03foo')
+        self.assertEqual(ord(stream.written[1][0]), 0xc1)
+
+        payload = stream.written[1][2:]
+
+        self.assertEqual(
+            websocket.PerMessageDeflate().decompress(payload, 1000),
+            message
+        )
+
+    def test_send_compressed(self):
+        ws, stream = self.make_websocket()
+
+        ws.send_compressed('abc')
+
+        self.assertEqual(stream.written, ['\xc1\x03abc'])